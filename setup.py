@@ -21,10 +21,13 @@ setup(name='smgdatatools',
           'zarr',
           'sqlalchemy',
           'gcsfs',
+          'fsspec',
+          'numcodecs',
           'requests',
       ],
       scripts=[
           'smgdatatools/esgfsearch.py',
           'smgdatatools/etl.py',
-          'smgdatatools/catalog.py'],
+          'smgdatatools/catalog.py',
+          'smgdatatools/mergedb.py'],
 )
@@ -0,0 +1,471 @@
+import calendar
+import datetime
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+from smgdatatools.collector.lib import Collector, StoreStats
+from smgdatatools.model.records import StoreRecord, VariableRecord, DimensionRecord, ChunkTable
+
+try:
+    import eccodes
+except ImportError:
+    eccodes = None
+
+MAGIC = b"GRIB"
+
+# short names of common parameters of the WMO tables by (discipline, category, number)
+PARAMETERS = {
+    (0, 0, 0): "t",
+    (0, 1, 0): "q",
+    (0, 1, 1): "r",
+    (0, 1, 8): "tp",
+    (0, 2, 2): "u",
+    (0, 2, 3): "v",
+    (0, 2, 8): "w",
+    (0, 3, 0): "sp",
+    (0, 3, 1): "prmsl",
+    (0, 3, 4): "z",
+    (0, 3, 5): "gh",
+    (0, 6, 1): "tcc",
+    (2, 0, 0): "lsm",
+    (10, 2, 0): "ci",
+}
+
+# type of the first fixed surface, values are kept in the units of the message (Pa, m)
+LEVEL_TYPES = {
+    1: "surface",
+    100: "isobaricInPa",
+    101: "meanSea",
+    103: "heightAboveGround",
+    105: "hybrid",
+    106: "depthBelowLandLayer",
+}
+
+# level types without a level dimension
+SINGLE_LEVELS = (1, 101, 255)
+
+# indicator of unit of time range, in seconds
+TIME_UNITS = {0: 60, 1: 3600, 2: 86400, 10: 3 * 3600, 11: 6 * 3600, 12: 12 * 3600, 13: 1}
+
+# units of the values of the types of level with a level dimension
+LEVEL_UNITS = {"isobaricInPa": "Pa", "heightAboveGround": "m", "depthBelowLandLayer": "m"}
+
+# valid times are seconds since the epoch in the time coordinates
+EPOCH = datetime.datetime(1970, 1, 1)
+TIME_UNITS_ATTR = "seconds since 1970-01-01 00:00:00"
+
+# calendar units of time range (month, year, decade, normal, century), in months
+CALENDAR_UNITS = {3: 1, 4: 12, 5: 120, 6: 360, 7: 1200}
+
+# product definition templates with the end of the overall time interval (statistically processed fields),
+# octet of the year relative to the start of section 4
+INTERVAL_END = {8: 35, 11: 38}
+
+# product definition templates of ensemble members, octet of the perturbation number
+ENSEMBLE_NUMBER = {1: 36, 11: 36}
+
+Field = namedtuple("Field", ["offset", "length", "discipline", "category", "number", "level_type", "level", "time",
+                             "member", "shape"])
+
+
+def uint(data, start, size):
+    """Unsigned integer at the 1-based octet ``start`` of a section."""
+    return int.from_bytes(data[start - 1:start - 1 + size], "big")
+
+
+def sint(data, start, size):
+    """GRIB signed integer, the sign is the most significant bit."""
+    value = uint(data, start, size)
+    sign = 1 << (8 * size - 1)
+    return -(value & (sign - 1)) if value & sign else value
+
+
+def parse_time(data, start):
+    return datetime.datetime(
+        uint(data, start, 2),
+        uint(data, start + 2, 1),
+        uint(data, start + 3, 1),
+        uint(data, start + 4, 1),
+        uint(data, start + 5, 1),
+        uint(data, start + 6, 1))
+
+
+def valid_time(reference, step, unit):
+    """Reference time plus ``step`` in the indicator of unit of time range ``unit``. Calendar units are added to the
+    month of the reference time, the day is kept unless the month is shorter."""
+    if unit in TIME_UNITS:
+        return reference + datetime.timedelta(seconds=step * TIME_UNITS[unit])
+    elif unit in CALENDAR_UNITS:
+        year, month = divmod(reference.year * 12 + reference.month - 1 + step * CALENDAR_UNITS[unit], 12)
+        return reference.replace(year=year, month=month + 1,
+                                 day=min(reference.day, calendar.monthrange(year, month + 1)[1]))
+
+    raise ValueError("Unknown unit of time range {}".format(unit))
+
+
+def parse_field(offset, length, discipline, sections):
+    """Field of a GRIB2 message from its identification (1), grid (3) and product (4) sections."""
+    reference = parse_time(sections[1], 13)
+
+    grid = sections[3]
+    npoints = uint(grid, 7, 4)
+    shape = (npoints,)
+    if uint(grid, 13, 2) in (0, 40):
+        # regular and Gaussian latitude/longitude grids
+        shape = (uint(grid, 35, 4), uint(grid, 31, 4))
+
+    product = sections[4]
+    template = uint(product, 8, 2)
+    if template in INTERVAL_END:
+        time = parse_time(product, INTERVAL_END[template])
+    else:
+        time = valid_time(reference, sint(product, 19, 4), uint(product, 18, 1))
+
+    level_type = uint(product, 23, 1)
+    level = None
+    if level_type != 255:
+        scale = sint(product, 24, 1)
+        level = sint(product, 25, 4) / 10 ** scale if scale else sint(product, 25, 4)
+
+    member = uint(product, ENSEMBLE_NUMBER[template], 1) if template in ENSEMBLE_NUMBER else None
+
+    return Field(offset, length, discipline, uint(product, 10, 1), uint(product, 11, 1), level_type, level, time,
+                 member, shape)
+
+
+def scan(fh, block_size=65536):
+    """Fields of the GRIB2 messages of a file.
+
+    Only section 0 and the small sections 1, 3, 4 and 5 are read, bitmaps and data sections are skipped. Bytes
+    between messages are searched for the next message, GRIB1 messages and messages whose valid time is unknown
+    are skipped. Messages with several fields are described by their first field. Lengths of messages or sections
+    that are zero or past the end of their message raise ValueError.
+    """
+    fields = list()
+    offset = 0
+    while True:
+        fh.seek(offset)
+        indicator = fh.read(16)
+        if len(indicator) < 16:
+            break
+        elif indicator[:4] != MAGIC:
+            # padding between messages
+            block = indicator + fh.read(block_size)
+            position = block.find(MAGIC, 1)
+            if position < 0:
+                if len(block) < block_size:
+                    break
+                offset += len(block) - 3
+            else:
+                offset += position
+            continue
+
+        edition = indicator[7]
+        length = uint(indicator, 9, 8) if edition == 2 else uint(indicator, 5, 3)
+        if length < 16:
+            raise ValueError("Invalid length {} of the GRIB message at {}".format(length, offset))
+        if edition != 2:
+            logging.warning("Skipping GRIB{} message at {}".format(edition, offset))
+            offset += length
+            continue
+
+        discipline = indicator[6]
+        sections = dict()
+        position = offset + 16
+        while position < offset + length - 4:
+            fh.seek(position)
+            header = fh.read(5)
+            if len(header) < 5:
+                raise ValueError("GRIB message at {} is truncated at {}".format(offset, position))
+            size, number = uint(header, 1, 4), header[4]
+            if size < 5 or position + size > offset + length - 4:
+                raise ValueError("Invalid length {} of section {} of the GRIB message at {}".format(
+                    size,
+                    number,
+                    offset))
+            if number == 4 and 4 in sections:
+                logging.warning("Message at {} has several fields, only the first one is collected".format(offset))
+                break
+            elif number in (1, 3, 4, 5):
+                sections[number] = header + fh.read(size - 5)
+            position += size
+
+        try:
+            fields.append(parse_field(offset, length, discipline, sections))
+        except ValueError as e:
+            logging.warning("Skipping message at {}: {}".format(offset, e))
+        offset += length
+
+    return fields
+
+
+def parameter_name(field):
+    key = (field.discipline, field.category, field.number)
+    return PARAMETERS.get(key, "param{}_{}_{}".format(*key))
+
+
+def level_name(level_type):
+    return LEVEL_TYPES.get(level_type, "level{}".format(level_type))
+
+
+def variables(fields):
+    """Group the fields of a file into variables by parameter and type of level, the name of the variable is the
+    parameter name, suffixed by the type of level when the parameter is found on several types of level."""
+    groups = dict()
+    for field in fields:
+        groups.setdefault((parameter_name(field), field.level_type), list()).append(field)
+
+    names = [parameter for parameter, _ in groups]
+    return {(parameter if names.count(parameter) == 1 else "{}_{}".format(parameter, level_name(level_type))): group
+            for (parameter, level_type), group in groups.items()}
+
+
+def axes(fields):
+    """Axes of the chunk grid of a variable and their values: valid time, then ensemble member and level if any."""
+    first = fields[0]
+    result = [("time", sorted(set(f.time for f in fields)))]
+    members = sorted(set(f.member for f in fields if f.member is not None))
+    if members:
+        result.append(("number", members))
+    if first.level_type not in SINGLE_LEVELS:
+        result.append((level_name(first.level_type), sorted(set(f.level for f in fields if f.level is not None))))
+
+    return result
+
+
+def coordinate_axes(groups):
+    """Coordinate variables of the variables of a file, as the name of the coordinate of every (variable, axis)
+    and the axis and values of every coordinate. Variables with the same values along an axis share the
+    coordinate named after the axis, other values have a coordinate suffixed by the name of their variable."""
+    names, coordinates = dict(), dict()
+    for name, fields in groups.items():
+        for axis, values in axes(fields):
+            coordinate = axis if coordinates.setdefault(axis, (axis, values))[1] == values else \
+                "{}_{}".format(axis, name)
+            coordinates[coordinate] = (axis, values)
+            names[(name, axis)] = coordinate
+
+    return names, coordinates
+
+
+def coordinate_values(axis, values):
+    if axis == "time":
+        return np.array([(t - EPOCH).total_seconds() for t in values], dtype="<f8")
+    elif axis == "number":
+        return np.array(values, dtype="<i8")
+
+    return np.array(values, dtype="<f8")
+
+
+class Grib2Collector(Collector):
+    """GRIB2 files collected by scanning message boundaries and section headers.
+
+    Every message is a chunk, variables group the messages of a parameter and type of level. Valid time, ensemble
+    member and level are dimensions of the chunk grid, followed by the dimensions of the horizontal grid which is
+    a single chunk. Valid times, members and levels are coordinate variables without chunks, their values are
+    taken from the scanned messages, and are also kept as ``GRIB_*`` attributes of the variables. Messages are
+    decoded by a GRIB codec (eccodes) when the data is read.
+    """
+
+    # only section headers are read, with plain range requests
+    io_bound = True
+
+    def __init__(self, drs=None, homogeneous=False, storage=None, variables=None, block_size=65536,
+                 chunk_hash=None, chunk_stats=None):
+        super().__init__(drs, homogeneous, storage, variables, chunk_hash, chunk_stats)
+        self.block_size = block_size
+
+        # fields of the last store scanned, reading its variables and attributes does not scan it again
+        self.scanned = (None, None)
+
+    def open(self, resource, stats=None):
+        if self.storage.is_local(resource):
+            return open(self.storage.path(resource), "rb")
+
+        fh = self.storage.open(resource, cache_type="readahead", block_size=self.block_size)
+        if stats is not None:
+            stats.wrap(fh)
+
+        return fh
+
+    def scan(self, resource, stats=None):
+        with self.open(resource, stats) as fh:
+            fields = scan(fh, self.block_size)
+        self.scanned = (resource, fields)
+
+        return fields
+
+    def fields(self, resource):
+        scanned, fields = self.scanned
+        return fields if scanned == resource else self.scan(resource)
+
+    def variable(self, resource, name):
+        groups = variables(self.fields(resource))
+        names, coordinates = coordinate_axes(groups)
+        if name in coordinates:
+            return self.collect_coordinate(name, *coordinates[name])
+
+        return self.collect_variable(name, groups[name], names)
+
+    def read_variable(self, store, variable):
+        names, coordinates = coordinate_axes(variables(self.fields(store)))
+        if variable in coordinates:
+            return coordinate_values(*coordinates[variable])
+        if eccodes is None:
+            raise ImportError("Reading GRIB messages requires the eccodes package")
+
+        v = self.variable(store, variable)
+        shape = [d.size for d in v.dimensions]
+        counts = [d.chunk_count for d in v.dimensions]
+        # dimensions of the horizontal grid, a message holds the whole grid
+        ngrid = 2 if v.dimensions[-1].scales == ["longitude"] else 1
+
+        values = np.full(shape, np.nan, dtype=v.dtype)
+        with self.open(store) as fh:
+            for location, size, index in v.chunks:
+                fh.seek(location)
+                gid = eccodes.codes_new_from_message(fh.read(size))
+                try:
+                    field = eccodes.codes_get_values(gid)
+                finally:
+                    eccodes.codes_release(gid)
+                coords = np.unravel_index(index, counts)[:-ngrid]
+                values[tuple(int(c) for c in coords)] = field.reshape(shape[-ngrid:])
+
+        return values
+
+    def decode_chunk(self, variable, codecs, data, index):
+        if eccodes is None:
+            raise ImportError("Decoding GRIB messages requires the eccodes package")
+
+        gid = eccodes.codes_new_from_message(data)
+        try:
+            values = eccodes.codes_get_values(gid)
+            # points masked by the bitmap are decoded as the missing value
+            if eccodes.codes_get_long(gid, "bitmapPresent"):
+                values[values == eccodes.codes_get_double(gid, "missingValue")] = np.nan
+            return values
+        finally:
+            eccodes.codes_release(gid)
+
+    def read_attributes(self, store, obj=None):
+        if obj:
+            return dict(self.variable(store, obj).attrs)
+
+        return dict(self.global_attrs(store))
+
+    def collect_record(self, resource):
+        logging.warning("Collecting from {}".format(resource))
+
+        stats = StoreStats()
+        with stats.time("open"):
+            fields = self.scan(resource, stats)
+
+        store = StoreRecord(name=resource, size=self.storage.info(resource)["size"])
+        store.attrs = self.global_attrs(resource)
+
+        groups = variables(fields)
+        names, coordinates = coordinate_axes(groups)
+
+        def dependencies(v):
+            return [names[(v, axis)] for axis, _ in axes(groups[v])] if v in groups else list()
+
+        for name in self.select_variables(list(groups) + list(coordinates), dependencies):
+            with stats.time("chunks"):
+                if name in coordinates:
+                    store.variables.append(self.collect_coordinate(name, *coordinates[name]))
+                else:
+                    store.variables.append(self.collect_variable(name, groups[name], names))
+
+        store.stats = stats.finish()
+
+        return store
+
+    def global_attrs(self, resource):
+        attrs = [("GRIB_edition", "2")]
+        drs = self.parse_drs(resource)
+        for facet in drs:
+            attrs.append((facet, drs[facet]))
+
+        return attrs
+
+    @staticmethod
+    def collect_coordinate(name, axis, values):
+        if axis == "time":
+            attrs = [("standard_name", "time"), ("units", TIME_UNITS_ATTR), ("calendar", "proleptic_gregorian")]
+        elif axis == "number":
+            attrs = [("standard_name", "realization"), ("long_name", "ensemble member numerical id")]
+        else:
+            attrs = [("long_name", axis)] + ([("units", LEVEL_UNITS[axis])] if axis in LEVEL_UNITS else [])
+
+        return VariableRecord(
+            name=name,
+            dtype=coordinate_values(axis, values[:0]).dtype.str,
+            attrs=attrs,
+            dimensions=[DimensionRecord(index=0, size=len(values), scales=[name])])
+
+    def collect_variable(self, name, fields, coordinates):
+        first = fields[0]
+        # chunk grid: one message per time, member and level
+        grid_axes = axes(fields)
+        times = grid_axes[0][1]
+        members = grid_axes[1][1] if len(grid_axes) > 1 and grid_axes[1][0] == "number" else []
+        levels = grid_axes[-1][1] if first.level_type not in SINGLE_LEVELS else []
+        grid = ["latitude", "longitude"] if len(first.shape) == 2 else ["values"]
+
+        variable = VariableRecord(
+            name=name,
+            dtype=np.dtype("float32").str,
+            fillvalue=float("nan"),
+            attrs=[
+                ("GRIB_discipline", str(first.discipline)),
+                ("GRIB_parameterCategory", str(first.category)),
+                ("GRIB_parameterNumber", str(first.number)),
+                ("GRIB_typeOfFirstFixedSurface", str(first.level_type)),
+                ("GRIB_validTimes", ",".join(t.isoformat() for t in times))])
+        if members:
+            variable.attrs.append(("GRIB_numbers", ",".join(str(m) for m in members)))
+        if first.level_type not in SINGLE_LEVELS:
+            variable.attrs.append(("GRIB_levels", ",".join(str(level) for level in levels)))
+
+        for i, (axis, values) in enumerate(grid_axes):
+            variable.dimensions.append(DimensionRecord(
+                index=i, size=len(values), chunk_count=len(values), chunk_shape=1, scales=[coordinates[(name, axis)]]))
+        for j, (axis, size) in enumerate(zip(grid, first.shape)):
+            variable.dimensions.append(DimensionRecord(
+                index=len(grid_axes) + j, size=size, chunk_count=1, chunk_shape=size, scales=[axis]))
+
+        positions = [{value: k for k, value in enumerate(values)} for _, values in grid_axes]
+        counts = [len(values) for _, values in grid_axes]
+        locations, sizes, indexes = list(), list(), list()
+        seen = set()
+        for f in fields:
+            if f.shape != first.shape:
+                logging.warning("Skipping message at {} of {}, its grid differs".format(f.offset, name))
+                continue
+            if members and f.member is None:
+                logging.warning("Skipping message at {} of {}, it is not an ensemble member".format(f.offset, name))
+                continue
+            coords = [positions[0][f.time]]
+            if members:
+                coords.append(positions[1][f.member])
+            if first.level_type not in SINGLE_LEVELS:
+                coords.append(positions[-1][f.level])
+            index = int(np.ravel_multi_index(coords, counts))
+            if index in seen:
+                logging.warning("Skipping duplicated message at {} of {}".format(f.offset, name))
+                continue
+            seen.add(index)
+            locations.append(f.offset)
+            sizes.append(f.length)
+            indexes.append(index)
+
+        order = np.argsort(indexes, kind="stable")
+        variable.chunks = ChunkTable(
+            np.array(locations, dtype=np.int64)[order],
+            np.array(sizes, dtype=np.int64)[order],
+            np.array(indexes, dtype=np.int64)[order])
+
+        return variable
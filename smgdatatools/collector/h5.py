@@ -1,42 +1,205 @@
 import logging
 import math
+import posixpath
 
 import h5py
+import numcodecs
+import numpy as np
 
-from smgdatatools.collector.lib import Collector
-from smgdatatools.model.model import Store, Variable, Dimension, Filter, GlobalAttribute, Attribute, Scale, Chunk, \
-    ChunkShape, FilterProperty, Compressor, CompressorProperty
+from smgdatatools.collector.lib import Collector, StoreStats, references, grid_coordinates, \
+    coordinate_fingerprint, attributes_digest
+from smgdatatools.etl.lib import numcodecs_filters
+from smgdatatools.model.records import StoreRecord, VariableRecord, DimensionRecord, CodecRecord, ChunkTable
+
+
+def chunk_index(dsid, chunks):
+    """Locations, sizes and logical chunk coordinates of the allocated chunks of a chunked dataset.
+
+    The index is built in a single traversal of the chunk B-tree with ``chunk_iter`` when the HDF5 library
+    supports it, ``get_chunk_info`` is only used as a fallback. Chunk coordinates are given in chunk units,
+    i.e. ``chunk_offset // chunks``, so unallocated chunks of sparse datasets are simply absent.
+    """
+    offsets, sizes, coords = list(), list(), list()
+
+    def visit(chunk_info):
+        offsets.append(chunk_info.byte_offset)
+        sizes.append(chunk_info.size)
+        coords.append(chunk_info.chunk_offset)
+
+    if hasattr(dsid, "chunk_iter"):
+        dsid.chunk_iter(visit)
+    else:
+        for i in range(dsid.get_num_chunks()):
+            visit(dsid.get_chunk_info(i))
+
+    coords = np.array(coords, dtype=np.int64).reshape((-1, len(chunks)))
+    return (np.array(offsets, dtype=np.int64),
+            np.array(sizes, dtype=np.int64),
+            coords // np.array(chunks, dtype=np.int64))
+
+
+# names of the HDF5 filters, built-in and registered plugins (https://github.com/HDFGroup/hdf5_plugins)
+FILTER_NAMES = {
+    1: "gzip",
+    2: "shuffle",
+    3: "fletcher32",
+    4: "szip",
+    5: "nbit",
+    6: "scaleoffset",
+    307: "bzip2",
+    32000: "lzf",
+    32001: "blosc",
+    32004: "lz4",
+    32008: "bitshuffle",
+    32015: "zstd",
+}
+
+# filters that compress, the first one of the pipeline is the compressor of the variable
+COMPRESSION_FILTERS = (1, 4, 307, 32000, 32001, 32004, 32015)
+
+
+def filter_pipeline(dsid):
+    """Filters of a dataset in the order they are applied when writing, as (id, flags, cd_values, name) tuples.
+
+    The pipeline is read from the dataset creation property list, filters of plugins that are not available are
+    described too.
+    """
+    dcpl = dsid.get_create_plist()
+    pipeline = list()
+    for i in range(dcpl.get_nfilters()):
+        code, flags, cd_values, name = dcpl.get_filter(i)
+        name = FILTER_NAMES.get(code) or name.decode("utf-8", "replace") or "filter{}".format(code)
+        pipeline.append((code, flags, tuple(cd_values), name))
+
+    return tuple(pipeline)
+
+
+def virtual_chunks(offset, shape, chunks, itemsize):
+    """Locations, sizes and indexes of the virtual chunks of a contiguous C ordered array stored at ``offset``.
+
+    ``chunks`` must be contiguous ranges of bytes, i.e. 1 along the dimensions before the last split dimension
+    and whole along the dimensions after it. When ``chunks`` does not divide ``shape`` the last chunk along the
+    split dimension is a shorter range of the remaining extent, readers clip it to the size of the variable.
+    """
+    strides = np.cumprod((shape[1:] + (1,))[::-1])[::-1] * itemsize
+    counts = [math.ceil(n / c) for n, c in zip(shape, chunks)]
+    coords = np.indices(counts, dtype=np.int64).reshape((len(shape), -1))
+    starts = coords * np.array(chunks, dtype=np.int64)[:, None]
+
+    locations = offset + (starts * strides[:, None]).sum(axis=0)
+    extents = np.minimum(np.array(chunks, dtype=np.int64)[:, None], np.array(shape, dtype=np.int64)[:, None] - starts)
+    sizes = np.prod(extents, axis=0) * itemsize
+
+    return ChunkTable(locations, sizes, np.arange(locations.size, dtype=np.int64))
+
+
+class StorageFile(h5py.File):
+    """HDF5 file read from a file object of the storage layer, the file object is closed with the file."""
+
+    def __init__(self, fh, mode="r", **kwargs):
+        super().__init__(fh, mode, **kwargs)
+        self.fh = fh
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.fh.close()
 
 
 class Hdf5ChunkCollector(Collector):
-    def __init__(self, drs=None, driver=None, chunk_size=None):
-        super().__init__(drs)
+    in_place = True
+
+    def __init__(self, drs=None, driver=None, chunk_size=None, homogeneous=False, storage=None,
+                 cache_type="blockcache", block_size=None, page_buf_size=None, rdcc_nbytes=None, mdc_size=None,
+                 variables=None, chunk_hash=None, chunk_stats=None):
+        super().__init__(drs, homogeneous, storage, variables, chunk_hash, chunk_stats)
         self.driver = driver
         self.drs = drs
         self.chunk_size = Hdf5ChunkCollector.parse_chunk_size_spec(chunk_size)
 
+        # remote files: HDF5 metadata is scattered through the file, caching whole blocks of the fsspec file
+        # turns the many small reads of a traversal into a few range requests
+        self.cache_type = cache_type
+        self.block_size = block_size
+
+        # HDF5 page buffer, raw data chunk cache and metadata cache sizes in bytes
+        self.page_buf_size = page_buf_size
+        self.rdcc_nbytes = rdcc_nbytes
+        self.mdc_size = mdc_size
+
     @staticmethod
     def parse_chunk_size_spec(spec):
+        """Parse the virtual chunk shapes of contiguous variables.
+
+        ``var:c0,c1,...`` gives the chunk shape of the leading dimensions of ``var``, ``var:dim:size`` the chunk
+        size of a single dimension given by index or by name. Specs are separated by ``;`` and several
+        ``var:dim:size`` specs of a variable are combined, e.g. ``tas:time:1;tas:lat:10``. Returns a dict of
+        dimension sizes by variable.
+        """
         chunk_size_spec = {}
         if spec:
             specs = spec.split(";")
             for s in specs:
                 tokens = s.split(":")
                 if len(tokens) == 2:
-                    chunk_size_spec[tokens[0]] = [int(x) for x in tokens[1].split(",")]
+                    sizes = chunk_size_spec.setdefault(tokens[0], {})
+                    sizes.update((i, int(x)) for i, x in enumerate(tokens[1].split(",")))
                 elif len(tokens) == 3:
-                    pass
+                    dim = int(tokens[1]) if tokens[1].isdigit() else tokens[1]
+                    chunk_size_spec.setdefault(tokens[0], {})[dim] = int(tokens[2])
                 else:
                     raise ValueError("Invalid chunk-size spec.")
 
         return chunk_size_spec
 
+    def open(self, resource, stats=None):
+        """Open a file with the HDF5 driver if one was given (e.g. ros3), otherwise local files are opened by path and
+        remote files through a buffered file object of the storage layer. Requests to remote storage are counted in
+        ``stats``."""
+        kwargs = dict()
+        if self.page_buf_size:
+            kwargs["page_buf_size"] = self.page_buf_size
+        if self.rdcc_nbytes:
+            kwargs["rdcc_nbytes"] = self.rdcc_nbytes
+
+        if self.driver:
+            f = h5py.File(resource, "r", driver=self.driver, **kwargs)
+        elif self.storage.is_local(resource):
+            f = h5py.File(self.storage.path(resource), "r", **kwargs)
+        else:
+            options = {"cache_type": self.cache_type}
+            if self.block_size:
+                options["block_size"] = self.block_size
+            fh = self.storage.open(resource, **options)
+            if stats is not None:
+                stats.wrap(fh)
+            try:
+                f = StorageFile(fh, "r", **kwargs)
+            except Exception:
+                fh.close()
+                raise
+
+        if self.mdc_size:
+            config = f.id.get_mdc_config()
+            config.set_initial_size = True
+            config.initial_size = self.mdc_size
+            config.max_size = max(config.max_size, self.mdc_size)
+            config.min_size = min(config.min_size, self.mdc_size)
+            f.id.set_mdc_config(config)
+
+        return f
+
     def read_variable(self, store, variable):
-        with h5py.File(store, driver=self.driver) as f:
+        with self.open(store) as f:
             return f[variable][...]
 
+    def chunk_codecs(self, resource, variable):
+        # the filter pipeline is undone in reverse order
+        return [numcodecs.get_codec(config) for config in reversed(numcodecs_filters(variable))]
+
     def read_attributes(self, store, obj=None):
-        with h5py.File(store, driver=self.driver) as f:
+        with self.open(store) as f:
             if obj:
                 attrs = dict(f[obj].attrs)
             else:
@@ -44,182 +207,250 @@ class Hdf5ChunkCollector(Collector):
 
         return attrs
 
-    def collect(self, store):
-        f = h5py.File(store, driver=self.driver)
+    def datasets(self, f):
+        """Names of the datasets of the file that are collected as variables."""
+        return self.select_variables(list(f), lambda v: self.dependencies(f[v]))
+
+    @staticmethod
+    def dependencies(ds):
+        """Variables referenced by the attributes of a dataset and the dimension scales attached to it."""
+        if not isinstance(ds, h5py.Dataset):
+            return list()
+
+        return references(ds.attrs) + [posixpath.basename(scale.name) for dim in ds.dims for scale in dim.values()]
+
+    def schema(self, f):
+        schema = list()
+        for v in self.datasets(f):
+            ds = f[v]
+            schema.append((
+                v,
+                ds.dtype.str,
+                ds.ndim,
+                ds.chunks,
+                filter_pipeline(ds.id),
+                repr(ds.fillvalue),
+                attributes_digest(ds.attrs, self.ignored_attrs())))
+
+        return tuple(schema)
+
+    def collect_record(self, store):
+        stats = StoreStats()
+        with stats.time("open"):
+            f = self.open(store, stats)
 
         logging.warning("Collecting from {}".format(store))
-        store = Store(name=store, size=0)
+        name = store
 
-        # global attrs
-        attrs = dict(f.attrs)
-        for attr in attrs:
-            if attr in self.ignored_attrs():
-                continue
-            elif isinstance(attrs[attr], str):
-                attribute = GlobalAttribute(
-                    name=attr,
-                    value=attrs[attr],
-                    store_id=store.id)
-                store.attrs.append(attribute)
-            elif isinstance(attrs[attr], bytes):
-                attribute = GlobalAttribute(
-                    name=attr,
-                    value=attrs[attr].decode("utf-8"),
-                    store_id=store.id)
-                store.attrs.append(attribute)
-
-        for v in list(f):
-            variable = Variable(
+        schema = self.schema(f) if self.homogeneous else None
+        prototype = self.prototype(schema)
+        if prototype is not None:
+            store = prototype.copy(name)
+            store.size = self.store_size(name)
+            store.attrs = self.collect_global_attrs(f, name)
+            fingerprints = self.fingerprints(f, [variable.name for variable in store.variables])
+            for variable in store.variables:
+                ds = f[variable.name]
+                variable.fingerprint = fingerprints.get(variable.name)
+                for dimension in variable.dimensions:
+                    dimension.size = ds.shape[dimension.index]
+                    dimension.chunk_count, dimension.chunk_shape = self.chunk_layout(ds, variable.name,
+                                                                                     dimension.index)
+                with stats.time("chunks"):
+                    variable.chunks = self.collect_chunks(ds, variable, name)
+            f.close()
+            store.stats = stats.finish()
+
+            return store
+
+        store = StoreRecord(name=name, size=self.store_size(name))
+        store.attrs = self.collect_global_attrs(f, name)
+
+        datasets = self.datasets(f)
+        fingerprints = self.fingerprints(f, datasets)
+        for v in datasets:
+            ds = f[v]
+            variable = VariableRecord(
                 name=v,
-                dtype=f[v].dtype.str,
-                fillvalue=f[v].fillvalue,
-                store_id=store.id)
-
-            # compressor
-            if f[v].compression:
-                comp = Compressor(
-                    name=f[v].compression)
-                comp.properties.append(CompressorProperty(
-                    name="level",
-                    value=f[v].compression_opts))
-                variable.compressor = comp
-
-            # filters
-            if f[v].shuffle:
-                filt = Filter(
-                    name="shuffle",
-                    variable_id=variable.id)
-                for x in ["elementsize"]:
-                    filt.properties.append(FilterProperty(
-                        name=x,
-                        value=f[v].dtype.itemsize))
-                variable.filters.append(filt)
-            if f[v].fletcher32:
-                filt = Filter(
-                    name="fletcher32",
-                    variable_id=variable.id)
-                for x in ["elementsize"]:
-                    filt.properties.append(FilterProperty(
-                        name=x,
-                        value=f[v].dtype.itemsize))
-                variable.filters.append(filt)
+                dtype=ds.dtype.str,
+                fillvalue=ds.fillvalue,
+                fingerprint=fingerprints.get(v))
+
+            # compressor and filters
+            variable.compressor, variable.filters = self.collect_filters(ds)
 
             # attrs
-            attrs = dict(f[v].attrs)
-            for attr in attrs:
-                if attr in self.ignored_attrs():
-                    continue
-                elif isinstance(attrs[attr], str):
-                    attribute = Attribute(
-                        name=attr,
-                        value=attrs[attr],
-                        variable_id=variable.id)
-                    variable.attrs.append(attribute)
-                elif isinstance(attrs[attr], bytes):
-                    attribute = Attribute(
-                        name=attr,
-                        value=attrs[attr].decode("utf-8"),
-                        variable_id=variable.id)
-                    variable.attrs.append(attribute)
+            attrs = dict(ds.attrs)
+            variable.attrs = self.collect_attrs(attrs)
 
             # dimensions
-            for i, dim in enumerate(f[v].dims):
-                if f[v].chunks:
-                    dimension = Dimension(
-                        index=i,
-                        size=f[v].shape[i],
-                        chunk_count=math.ceil(f[v].shape[i] / f[v].chunks[i]),
-                        variable_id=variable.id)
-                    chunk_shape = ChunkShape(
-                        dimension_id=dimension.id,
-                        shape=f[v].chunks[i],
-                        index=i)
-                    dimension.chunk_shapes.append(chunk_shape)
-                elif v in self.chunk_size:
-                    dimension = Dimension(
-                        index=i,
-                        size=f[v].shape[i],
-                        chunk_count=math.ceil(f[v].shape[i] / self.chunk_size[v][i]),
-                        variable_id=variable.id)
-                    chunk_shape = ChunkShape(
-                        dimension_id=dimension.id,
-                        shape=self.chunk_size[v][i],
-                        index=i)
-                    dimension.chunk_shapes.append(chunk_shape)
-                else:
-                    dimension = Dimension(
-                        index=i,
-                        size=f[v].shape[i],
-                        variable_id=variable.id)
-
-                if "CLASS" in attrs:
-                    if attrs["CLASS"] == b"DIMENSION_SCALE":
-                        scale = Scale(
-                            name=attrs["NAME"].decode("utf-8"),
-                            dimension_id=dimension.id,
-                            variable_id=variable.id)
-                        dimension.scales.append(scale)
-                        variable.scales.append(scale)
-
-                # ToDo: review the model of scales, this adds "This is a netCDF dimension.." to the database
-                # for value in dim.keys():
-                #     scale = Scale(
-                #         name=value,
-                #         dimension_id=dimension.id,
-                #         variable_id=variable.id)
-                for item in dim.items():
-                    scale = Scale(
-                        name=item[1].name.lstrip("/"),
-                        dimension_id=dimension.id,
-                        variable_id=variable.id)
-
-                    dimension.scales.append(scale)
-                    variable.scales.append(scale)
-
+            for i, dim in enumerate(ds.dims):
+                chunk_count, chunk_shape = self.chunk_layout(ds, v, i)
+                dimension = DimensionRecord(
+                    index=i,
+                    size=ds.shape[i],
+                    chunk_count=chunk_count,
+                    chunk_shape=chunk_shape,
+                    scales=self.collect_scales(dim, attrs))
                 variable.dimensions.append(dimension)
 
-            # chunks
-            dsid = f[v].id
-            if f[v].chunks:
-                for i in range(dsid.get_num_chunks()):
-                    chunk_info = dsid.get_chunk_info(i)
-                    chunk = Chunk(
-                        location=chunk_info.byte_offset,
-                        size=chunk_info.size,
-                        index=i,
-                        variable_id=variable.id)
-                    variable.chunks.append(chunk)
-            elif v in self.chunk_size:
-                logging.warning("Forcing chunks from non chunked variable {} at {}".format(
-                    v,
-                    store))
-                nchunks = math.ceil(f[v].shape[0] / self.chunk_size[v][0])
-                for i in range(nchunks):
-                    chunk = Chunk(
-                        location=dsid.get_offset() + i * self.chunk_size[v][0],
-                        size=self.chunk_size[v][0] * f[v].dtype.itemsize,
-                        index=i,
-                        variable_id=variable.id)
-                    variable.chunks.append(chunk)
-            else:
-                logging.warning("Collecting chunks from non chunked variable {} at {}".format(
-                    v,
-                    store))
-                chunk = Chunk(
-                    location=dsid.get_offset(),
-                    size=dsid.get_storage_size(),
-                    index=0,
-                    variable_id=variable.id)
-                variable.chunks.append(chunk)
-                for i, shape in enumerate(f[v].shape):
-                    chunk_shape = ChunkShape(
-                        dimension_id=variable.dimensions[i].id,
-                        index=chunk.index,
-                        shape=shape)
-                    variable.dimensions[i].chunk_shapes.append(chunk_shape)
-
+            with stats.time("chunks"):
+                variable.chunks = self.collect_chunks(ds, variable, name)
             store.variables.append(variable)
 
+        self.add_prototype(schema, store)
         f.close()
+        store.stats = stats.finish()
 
         return store
+
+    def store_size(self, resource):
+        return 0
+
+    @staticmethod
+    def fingerprints(f, datasets):
+        """Fingerprints of the values of the datasets that are one dimensional coordinates. Dimension scales are the
+        coordinate variables, other datasets are named after the first scale attached to each axis."""
+        variables = dict()
+        for v in datasets:
+            ds = f[v]
+            if ds.is_scale and ds.ndim == 1:
+                dimensions = [v]
+            else:
+                dimensions = [next((posixpath.basename(scale.name) for scale in dim.values()), None)
+                              for dim in ds.dims]
+            variables[v] = (dimensions, ds.attrs)
+
+        fingerprints = dict()
+        for v in grid_coordinates(variables):
+            try:
+                fingerprints[v] = coordinate_fingerprint(f[v][()])
+            except OSError as e:
+                logging.warning("Can not fingerprint {}: {}".format(v, e))
+
+        return fingerprints
+
+    def collect_filters(self, ds):
+        """Compressor and filters of the HDF5 filter pipeline of a dataset.
+
+        Every filter keeps its HDF5 ``id``, ``flags``, ``cd_values`` (comma separated) and its ``order`` in the
+        pipeline, so that the pipeline can be rebuilt for references that decode the chunks in place.
+        """
+        compressor = None
+        filters = list()
+        for order, (code, flags, cd_values, name) in enumerate(filter_pipeline(ds.id)):
+            properties = {
+                "id": code,
+                "flags": flags,
+                "cd_values": ",".join(str(x) for x in cd_values),
+                "order": order}
+            if code == 1:
+                properties["level"] = cd_values[0] if cd_values else 4
+            elif code in (2, 3):
+                properties["elementsize"] = ds.dtype.itemsize
+
+            if compressor is None and code in COMPRESSION_FILTERS:
+                compressor = CodecRecord(name=name, properties=properties)
+            else:
+                filters.append(CodecRecord(name=name, properties=properties))
+
+        return compressor, filters
+
+    def collect_attrs(self, attrs):
+        collected = list()
+        for attr in attrs:
+            if attr in self.ignored_attrs():
+                continue
+            elif isinstance(attrs[attr], str):
+                collected.append((attr, attrs[attr]))
+            elif isinstance(attrs[attr], bytes):
+                collected.append((attr, attrs[attr].decode("utf-8")))
+
+        return collected
+
+    def collect_scales(self, dim, attrs):
+        scales = list()
+        if "CLASS" in attrs:
+            if attrs["CLASS"] == b"DIMENSION_SCALE":
+                scales.append(attrs["NAME"].decode("utf-8"))
+
+        # ToDo: review the model of scales, this adds "This is a netCDF dimension.." to the database
+        for item in dim.items():
+            scales.append(item[1].name.lstrip("/"))
+
+        return scales
+
+    def collect_global_attrs(self, f, resource=None):
+        return self.collect_attrs(dict(f.attrs))
+
+    def virtual_chunk_shape(self, ds, v):
+        """Chunk shape of a contiguous variable with a chunk-size spec, None otherwise.
+
+        Dimensions not given in the spec have size 1 before the last dimension given and are whole after it. A
+        virtual chunk must be a contiguous range of bytes, so every dimension before the last one that is split
+        must have size 1.
+        """
+        if ds.chunks or v not in self.chunk_size:
+            return None
+
+        sizes = dict()
+        for dim, size in self.chunk_size[v].items():
+            if not isinstance(dim, int):
+                dim = self.dimension_index(ds, dim)
+            if dim >= ds.ndim or size < 1:
+                raise ValueError("Invalid chunk-size spec for variable {} of shape {}.".format(v, ds.shape))
+            sizes[dim] = size
+
+        last = max(sizes)
+        shape = tuple(max(min(sizes.get(i, 1 if i < last else ds.shape[i]), ds.shape[i]), 1) for i in range(ds.ndim))
+        split = [i for i in range(ds.ndim) if shape[i] < ds.shape[i]]
+        if split and any(shape[i] != 1 for i in range(split[-1])):
+            raise ValueError("Chunk shape {} of variable {} is not contiguous.".format(shape, v))
+
+        return shape
+
+    @staticmethod
+    def dimension_index(ds, name):
+        for i, dim in enumerate(ds.dims):
+            if dim.label == name or any(scale.name.split("/")[-1] == name for scale in dim.values()):
+                return i
+
+        raise ValueError("Variable {} has no dimension {}.".format(ds.name, name))
+
+    def chunk_layout(self, ds, v, i):
+        """Chunk count and chunk shape of dimension i, contiguous variables are a single chunk."""
+        shape = ds.chunks or self.virtual_chunk_shape(ds, v)
+        if shape:
+            return math.ceil(ds.shape[i] / shape[i]), shape[i]
+        else:
+            return None, ds.shape[i]
+
+    def collect_chunks(self, ds, variable, store):
+        dsid = ds.id
+        v = variable.name
+        if ds.chunks:
+            # chunk index is the position of the chunk in the chunk grid, not its position in the B-tree
+            locations, sizes, coords = chunk_index(dsid, ds.chunks)
+            chunk_counts = [d.chunk_count for d in variable.dimensions]
+            if len(coords) > 0 and chunk_counts:
+                indexes = np.ravel_multi_index(coords.T, chunk_counts)
+            else:
+                indexes = np.zeros(len(locations), dtype=np.int64)
+
+            return ChunkTable(locations, sizes, indexes)
+        elif dsid.get_offset() is None:
+            # storage was never allocated, the variable only has fill values
+            return ChunkTable()
+        elif v in self.chunk_size:
+            logging.warning("Forcing chunks from non chunked variable {} at {}".format(
+                v,
+                store))
+            return virtual_chunks(dsid.get_offset(), ds.shape, self.virtual_chunk_shape(ds, v), ds.dtype.itemsize)
+        else:
+            logging.warning("Collecting chunks from non chunked variable {} at {}".format(
+                v,
+                store))
+            return ChunkTable(
+                [dsid.get_offset()],
+                [dsid.get_storage_size()],
+                [0])
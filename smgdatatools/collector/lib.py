@@ -1,28 +1,519 @@
+import contextlib
+import datetime
+import email.utils
+import hashlib
+import logging
+import math
+import os
+import posixpath
 import re
+import time
+
+import fsspec
+import numcodecs
+import numpy as np
+from fsspec.utils import get_protocol
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+LOCAL_PROTOCOLS = ("file", "local")
+
+# storage options used when none are given, public cloud datasets are read anonymously
+DEFAULT_STORAGE_OPTIONS = {
+    "gs": {"token": "anon"},
+    "gcs": {"token": "anon"},
+    "s3": {"anon": True},
+}
+
+# keys of fsspec info dictionaries holding the modification time and the checksum of remote objects
+MTIME_KEYS = ("mtime", "LastModified", "last_modified", "updated", "created")
+CHECKSUM_KEYS = ("md5Hash", "ETag", "etag", "crc32c")
+
+
+CHUNK_HASHES = ("xxh3", "blake2b")
+
+
+def chunk_hasher(name):
+    """Function returning the hex digest of the bytes of a chunk. Hashes are not cryptographic, 128 bits keep
+    collisions negligible in large collections and fit the hash column."""
+    if name == "xxh3":
+        if xxhash is None:
+            raise ValueError("xxh3 chunk hashes require the xxhash package")
+        return xxhash.xxh3_128_hexdigest
+    elif name == "blake2b":
+        return lambda data: hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    raise ValueError("Unknown chunk hash {}".format(name))
+
+
+def chunk_statistics(values, fillvalue=None):
+    """Minimum, maximum, number and sum of the valid values of a decoded chunk. Values equal to ``fillvalue`` and
+    NaN are not valid, minimum and maximum are NaN when no value is valid."""
+    values = np.asarray(values).reshape(-1)
+    if values.dtype.kind == "f":
+        values = values[~np.isnan(values)]
+    if fillvalue is not None and not np.isnan(fillvalue):
+        values = values[values != fillvalue]
+    if not len(values):
+        return math.nan, math.nan, 0, 0.
+
+    return float(values.min()), float(values.max()), len(values), float(values.sum(dtype=np.float64))
+
+
+def timestamp(value):
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    elif isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+        except ValueError:
+            return email.utils.parsedate_to_datetime(value).timestamp()
+
+    return float(value)
+
+
+class StoreStats:
+    """Requests and bytes fetched from storage and time spent in each phase of the collection of a store.
+
+    Phases are ``open``, ``chunks`` (chunk index) and ``metadata``, the time that is not spent in the other two.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.timings = dict()
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def time(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] = self.timings.get(phase, 0.) + time.perf_counter() - start
+
+    def finish(self):
+        total = time.perf_counter() - self.start
+        self.timings["total"] = total
+        self.timings["metadata"] = total - self.timings.get("open", 0.) - self.timings.get("chunks", 0.)
+
+        return self
+
+    def count(self, requests, nbytes=0):
+        self.requests += requests
+        self.bytes += nbytes
+
+    def wrap(self, fh):
+        """Count the requests of a buffered fsspec file, i.e. the fetches that miss its cache. Other file objects
+        (local, memory) are returned unchanged."""
+        cache = getattr(fh, "cache", None)
+        if cache is None or not hasattr(cache, "fetcher"):
+            return fh
+
+        fetcher = cache.fetcher
+
+        def fetch(start, end):
+            data = fetcher(start, end)
+            self.count(1, len(data))
+            return data
+
+        cache.fetcher = fetch
+        return fh
+
+    def __repr__(self):
+        return f"StoreStats(requests={self.requests!r}, bytes={self.bytes!r}, timings={self.timings!r})"
+
+
+class Storage:
+    """Access to the resources of a collection through fsspec, resources are local paths or URLs (s3://, gs://,
+    https://, memory://, ...).
+
+    A filesystem is created once per protocol and per process and reused for every resource, so each worker keeps
+    a single connection pool. ``storage_options`` are passed to the filesystems of remote protocols, connection
+    reuse and concurrency are tuned here for all the collectors.
+    """
+
+    def __init__(self, storage_options=None, concurrency=64):
+        self.storage_options = storage_options
+        self.concurrency = concurrency
+        self.filesystems = dict()
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        # each worker process opens its own filesystems
+        state = self.__dict__.copy()
+        state["filesystems"] = dict()
+        return state
+
+    def is_local(self, resource):
+        return get_protocol(resource) in LOCAL_PROTOCOLS
+
+    def filesystem(self, resource):
+        if self.pid != os.getpid():
+            # forked worker, do not share the connections of the parent
+            self.filesystems = dict()
+            self.pid = os.getpid()
+
+        protocol = get_protocol(resource)
+        if protocol not in self.filesystems:
+            if protocol in LOCAL_PROTOCOLS:
+                options = dict()
+            elif self.storage_options is not None:
+                options = self.storage_options
+            else:
+                options = DEFAULT_STORAGE_OPTIONS.get(protocol, dict())
+            self.filesystems[protocol] = fsspec.filesystem(protocol, **options)
+
+        return self.filesystems[protocol]
+
+    def path(self, resource):
+        return self.filesystem(resource)._strip_protocol(resource)
+
+    def open(self, resource, mode="rb", **kwargs):
+        return self.filesystem(resource).open(self.path(resource), mode, **kwargs)
+
+    def cat(self, resources):
+        """Contents of several objects of the same filesystem keyed by path, missing objects are omitted. Async
+        filesystems fetch them concurrently in a single asyncio batch."""
+        if not resources:
+            return dict()
+
+        fs = self.filesystem(resources[0])
+        paths = [self.path(resource) for resource in resources]
+        if fs.async_impl:
+            return fs.cat(paths, on_error="omit", batch_size=self.concurrency)
+
+        return fs.cat(paths, on_error="omit")
+
+    def cat_ranges(self, resources, starts, ends):
+        """Byte ranges of objects of the same filesystem, None ranges are whole objects."""
+        fs = self.filesystem(resources[0])
+        paths = [self.path(resource) for resource in resources]
+        if fs.async_impl:
+            return fs.cat_ranges(paths, starts, ends, batch_size=self.concurrency)
+
+        return fs.cat_ranges(paths, starts, ends)
+
+    def ls(self, resource):
+        return self.filesystem(resource).ls(self.path(resource), detail=True)
+
+    def find(self, resource):
+        return list(self.filesystem(resource).find(self.path(resource), detail=True).values())
+
+    def info(self, resource):
+        return self.filesystem(resource).info(self.path(resource))
+
+    def fingerprint(self, resource, checksum=False):
+        """Size, modification time and, optionally, checksum of a resource.
+
+        The checksum of local files is their SHA-256, remote objects are not read and the checksum reported by the
+        object store (MD5, ETag) is used instead. Resources whose modification time is unknown have no fingerprint
+        and are always collected.
+        """
+        if self.is_local(resource):
+            path = self.path(resource)
+            if not os.path.isfile(path):
+                return None, None, None
+
+            stat = os.stat(path)
+            digest = None
+            if checksum:
+                sha256 = hashlib.sha256()
+                with open(path, "rb") as fh:
+                    for block in iter(lambda: fh.read(1 << 20), b""):
+                        sha256.update(block)
+                digest = sha256.hexdigest()
+
+            return stat.st_size, stat.st_mtime, digest
+
+        try:
+            info = self.info(resource)
+        except (FileNotFoundError, IsADirectoryError):
+            return None, None, None
+
+        return self.info_fingerprint(info, checksum)
+
+    def fingerprints(self, resources, checksum=False):
+        """Fingerprints of several resources keyed by resource, in order.
+
+        Remote objects are fingerprinted from a single listing of each of their directories instead of a request
+        per object, objects missing from the listing are fingerprinted on their own.
+        """
+        resources = list(resources)
+        directories = dict()
+        for resource in resources:
+            if not self.is_local(resource):
+                key = (get_protocol(resource), posixpath.dirname(self.path(resource)))
+                directories.setdefault(key, list()).append(resource)
+
+        listings = dict()
+        for (_, directory), members in directories.items():
+            fs = self.filesystem(members[0])
+            try:
+                infos = fs.ls(directory, detail=True)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for info in infos:
+                listings[fs._strip_protocol(info["name"])] = info
+
+        fingerprints = dict()
+        for resource in resources:
+            info = None if self.is_local(resource) else listings.get(self.path(resource))
+            if info is not None:
+                fingerprints[resource] = self.info_fingerprint(info, checksum)
+            else:
+                fingerprints[resource] = self.fingerprint(resource, checksum)
+
+        return fingerprints
+
+    @staticmethod
+    def info_fingerprint(info, checksum=False):
+        """Fingerprint of a remote object from its fsspec info or listing entry."""
+        mtime = next((timestamp(info[k]) for k in MTIME_KEYS if info.get(k) is not None), None)
+        if info.get("type") != "file" or mtime is None:
+            return None, None, None
+
+        digest = None
+        if checksum:
+            digest = next((str(info[k]).strip('"') for k in CHECKSUM_KEYS if info.get(k)), None)
+
+        return info["size"], mtime, digest
+
+
+# attributes naming the other variables that a variable needs (CF conventions)
+DEPENDENCY_ATTRS = ("coordinates", "bounds", "climatology", "grid_mapping")
+
+
+def references(attrs):
+    """Names of the variables referenced by the attributes of a variable. Values are lists of names separated by
+    spaces, ``grid_mapping`` may also have the extended ``crs: x y`` form."""
+    names = list()
+    for attr in DEPENDENCY_ATTRS:
+        value = attrs.get(attr)
+        if isinstance(value, bytes):
+            value = value.decode("utf-8")
+        if isinstance(value, str):
+            names.extend(token.rstrip(":") for token in value.split())
+
+    return names
+
+
+def coordinates(variables):
+    """Names of the coordinates of a store, ``variables`` maps every variable name to its dimension names and
+    attributes. Coordinates are the coordinate variables (one dimensional, named after their dimension), their
+    bounds and the auxiliary coordinates listed by ``coordinates`` attributes."""
+    names = set()
+    for name, (dimensions, attrs) in variables.items():
+        if list(dimensions) == [name]:
+            names.add(name)
+            names.update(references({"bounds": attrs.get("bounds")}))
+        names.update(references({"coordinates": attrs.get("coordinates")}))
+
+    return [name for name in variables if name in names]
+
+
+def grid_coordinates(variables):
+    """Names of the one dimensional coordinates of a store, whose values are fingerprinted to compare the grids of
+    stores. Bounds and two dimensional auxiliary coordinates can be as large as the data and are not read."""
+    return [name for name in coordinates(variables) if len(variables[name][0]) == 1]
+
+
+def coordinate_fingerprint(values):
+    """Digest of the values of a coordinate. Values are widened to 64 bits little endian first, so the same grid
+    stored with a different byte order or precision has the same fingerprint."""
+    values = np.ma.getdata(values)
+    if values.dtype.kind == "f":
+        values = values.astype("<f8")
+    elif values.dtype.kind in "iub":
+        values = values.astype("<i8")
+    elif values.dtype.kind in "OSU":
+        values = values.astype(str)
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update("{}{}".format(values.dtype.str, values.shape).encode())
+    digest.update(np.ascontiguousarray(values).tobytes())
+
+    return digest.hexdigest()
+
+
+def attributes_digest(attrs, ignored=()):
+    """Digest of the attributes of a variable, stores of a homogeneous collection only share a prototype if the
+    attributes of their variables (units, calendar, fill value, packing...) are the same."""
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(attrs):
+        if name in ignored:
+            continue
+        value = attrs[name]
+        digest.update(repr((name, value.tolist() if isinstance(value, np.ndarray) else value)).encode())
+
+    return digest.hexdigest()
 
 
 class Collector:
-    def __init__(self, drs=None):
+    # collection mostly waits on the network and releases the GIL meanwhile, so it scales with threads. HDF5 and
+    # netCDF-C calls are serialized by a global lock in h5py and netCDF4, collectors based on them use processes.
+    io_bound = False
+
+    # chunk locations are byte offsets in the store, so chunks can be read in place
+    in_place = False
+
+    def __init__(self, drs=None, homogeneous=False, storage=None, variables=None, chunk_hash=None,
+                 chunk_stats=None):
         self.drs = drs
+        self.drs_pattern = re.compile(drs) if drs else None
+        self.storage = storage if storage is not None else Storage()
+
+        # variables to collect, None for all of them
+        self.variables = variables
+
+        # hash of the chunk bytes (see CHUNK_HASHES), None to not read the chunks
+        self.chunk_hash = chunk_hash
+
+        # variables whose chunks are decoded to compute their statistics
+        self.chunk_stats = chunk_stats
+
+        # homogeneous collections: stores are fully collected once per schema, the rest are copied from the
+        # prototype and only the parts that vary between stores are read (sizes, chunks, global attributes)
+        self.homogeneous = homogeneous
+        self.prototypes = dict()
+
+    def collect(self, resource):
+        record = self.collect_record(resource)
+        if self.reads_chunks:
+            self.scan_chunks(record)
 
-    def collect(self, resources):
+        return record.to_store()
+
+    def collect_record(self, resource):
         raise NotImplementedError
 
+    def chunk_ranges(self, resource, variable):
+        """Resource, start and end of the bytes of every chunk of a variable record."""
+        return [(resource, location, location + size) for location, size, _ in variable.chunks]
+
+    @property
+    def reads_chunks(self):
+        return bool(self.chunk_hash or self.chunk_stats)
+
+    def chunk_codecs(self, resource, variable):
+        """numcodecs codecs that decode the chunks of a variable record, in decoding order."""
+        return list()
+
+    def decode_chunk(self, variable, codecs, data, index):
+        """Valid region of a chunk as an array, edge chunks padded to the chunk shape are cropped and edge chunks
+        stored short, such as the last virtual chunk of a contiguous variable, are shaped to their extent."""
+        for codec in codecs:
+            data = codec.decode(data)
+        values = numcodecs.compat.ensure_ndarray(data).reshape(-1).view(variable.dtype)
+
+        shape = [d.chunk_shape for d in variable.dimensions]
+        counts = [d.chunk_count for d in variable.dimensions]
+        if None in shape or None in counts:
+            return values
+
+        coords = np.unravel_index(index, counts) if counts else ()
+        extent = [max(min(s, d.size - c * s), 0) for c, s, d in zip(coords, shape, variable.dimensions)]
+        if len(values) == math.prod(shape):
+            return values.reshape(shape)[tuple(slice(0, e) for e in extent)]
+        if len(values) == math.prod(extent):
+            return values.reshape(extent)
+        return values
+
+    def scan_chunks(self, record, batch_size=64):
+        """Hash and compute the statistics of the chunks of a store record. Chunks are read in batches of
+        concurrent range requests and decoded one at a time, at most ``batch_size`` chunks are held in memory."""
+        hasher = chunk_hasher(self.chunk_hash) if self.chunk_hash else None
+        for variable in record.variables:
+            stats = self.chunk_stats and variable.name in self.chunk_stats
+            if stats and np.dtype(variable.dtype).kind not in "iufb":
+                logging.warning("Skipping statistics of non numeric variable {}".format(variable.name))
+                stats = False
+            if not (hasher or stats):
+                continue
+
+            codecs = self.chunk_codecs(record.name, variable) if stats else None
+            ranges = self.chunk_ranges(record.name, variable)
+            indexes = variable.chunks.index.tolist()
+            digests, statistics = list(), list()
+            for i in range(0, len(ranges), batch_size):
+                resources, starts, ends = zip(*ranges[i:i + batch_size])
+                for j, data in enumerate(self.storage.cat_ranges(list(resources), list(starts), list(ends))):
+                    if hasher:
+                        digests.append(hasher(data))
+                    if stats:
+                        values = self.decode_chunk(variable, codecs, data, indexes[i + j])
+                        statistics.append(chunk_statistics(values, variable.fillvalue))
+
+            if hasher:
+                variable.chunks.hash = np.array(digests, dtype=object)
+            if stats:
+                variable.chunks.stats = np.array(statistics, dtype=np.float64).reshape(-1, 4)
+
     def read_variable(self, store, variable):
         raise NotImplementedError
 
+    def read_values(self, variable):
+        """Values of a collected variable of the database.
+
+        Variables of local stores held by a single uncompressed chunk, e.g. contiguous coordinates, are read with a
+        single read at the recorded location, dtype and shape without opening the store. Other variables are read
+        by read_variable.
+        """
+        store = variable.store.name
+        if self.in_place and variable.dtype and self.storage.is_local(store) and variable.compressor is None and \
+                not variable.filters and len(variable.chunks) == 1:
+            dtype = np.dtype(variable.dtype)
+            shape = tuple(d.size for d in sorted(variable.dimensions, key=lambda d: d.index))
+            chunk = variable.chunks[0]
+            if dtype.kind not in "OV" and chunk.size == math.prod(shape) * dtype.itemsize:
+                with open(self.storage.path(store), "rb") as fh:
+                    return np.fromfile(fh, dtype=dtype, count=math.prod(shape), offset=chunk.location).reshape(shape)
+
+        return self.read_variable(store, variable.name)
+
     def read_attributes(self, store, obj=None):
         raise NotImplementedError
 
+    def select_variables(self, names, dependencies):
+        """Names of the variables to collect, the selected variables and everything they depend on (coordinates,
+        bounds, grid mappings, dimension scales), in the order of ``names``. ``dependencies`` returns the names that
+        a variable references and is only called for the variables that are collected.
+        """
+        if self.variables is None:
+            return list(names)
+
+        available = set(names)
+        selected = set()
+        pending = [v for v in self.variables if v in available]
+        while pending:
+            v = pending.pop()
+            if v not in selected:
+                selected.add(v)
+                pending.extend(d for d in dependencies(v) if d in available and d not in selected)
+
+        return [v for v in names if v in selected]
+
     def parse_drs(self, name):
         drs = dict()
-        if self.drs:
-            p = re.compile(self.drs)
-            matches = p.search(name)
+        if self.drs_pattern:
+            matches = self.drs_pattern.search(name)
             drs = matches.groupdict()
 
         return drs
 
+    def prototype(self, schema):
+        if self.homogeneous:
+            return self.prototypes.get(schema)
+
+        return None
+
+    def add_prototype(self, schema, store):
+        if self.homogeneous:
+            self.prototypes[schema] = store.copy(store.name)
+
     def ignored_attrs(self):
         return (
             "REFERENCE_LIST",
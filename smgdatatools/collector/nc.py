@@ -1,24 +1,80 @@
-import os
-
 import netCDF4
-from sqlalchemy import create_engine
-from sqlalchemy.orm import Session
+from fsspec.utils import get_protocol
+
+from smgdatatools.collector.lib import Collector, StoreStats, references, grid_coordinates, \
+    coordinate_fingerprint, attributes_digest
+from smgdatatools.model.records import StoreRecord, VariableRecord, DimensionRecord
+
+try:
+    import h5netcdf.legacyapi
+except ImportError:
+    h5netcdf = None
 
-from smgdatatools.collector.lib import Collector
-from smgdatatools.model.model import Base, Store, Variable, Dimension, GlobalAttribute, Attribute, Scale
+# protocols read by netCDF-C
+NETCDF_PROTOCOLS = ("http", "https")
+
+# format signature at the start of netCDF-4 (HDF5) files
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+if h5netcdf is not None:
+    class StorageDataset(h5netcdf.legacyapi.Dataset):
+        """netCDF-4 dataset read by h5netcdf from a file object of the storage layer, the file object is closed with
+        the dataset."""
+
+        def __init__(self, fh):
+            super().__init__(fh, "r")
+            self.fh = fh
+
+        def close(self):
+            try:
+                super().close()
+            finally:
+                self.fh.close()
 
 
 class NcCollector(Collector):
-    def __init__(self, drs=None):
-        super().__init__(drs)
+    def __init__(self, drs=None, homogeneous=False, storage=None, variables=None, chunk_hash=None,
+                 chunk_stats=None):
+        super().__init__(drs, homogeneous, storage, variables, chunk_hash, chunk_stats)
+
+    def open(self, resource, stats=None):
+        """Open a dataset. URLs handled by netCDF-C itself (OPeNDAP) are opened directly. netCDF-C can not read from
+        file objects, so other remote netCDF-4 files are read by h5netcdf through a block cached file object of the
+        storage layer rather than downloaded, and other remote netCDF-3 files are refused (the nc3 collector reads
+        their headers). Requests to remote storage are counted in ``stats``."""
+        if self.storage.is_local(resource):
+            return netCDF4.Dataset(self.storage.path(resource))
+        elif get_protocol(resource) in NETCDF_PROTOCOLS:
+            return netCDF4.Dataset(resource)
+
+        fh = self.storage.open(resource, cache_type="blockcache")
+        try:
+            if fh.read(len(HDF5_SIGNATURE)) != HDF5_SIGNATURE:
+                raise ValueError("{} is not a netCDF-4 file, remote netCDF-3 files are collected by the nc3 "
+                                 "collector".format(resource))
+            if h5netcdf is None:
+                raise ImportError("Reading remote netCDF-4 files requires the h5netcdf package")
+            fh.seek(0)
+            if stats is not None:
+                stats.wrap(fh)
+            return StorageDataset(fh)
+        except Exception:
+            fh.close()
+            raise
+
+    def size(self, resource):
+        if get_protocol(resource) in NETCDF_PROTOCOLS:
+            return None
+
+        return self.storage.info(resource)["size"]
 
     def read_variable(self, store, variable):
-        with netCDF4.Dataset(store) as f:
+        with self.open(store) as f:
             return f[variable][...]
 
     def read_attributes(self, store, obj=None):
         attrs = {}
-        with netCDF4.Dataset(store) as f:
+        with self.open(store) as f:
             if obj:
                 attrs = {attr: f[obj].getncattr(attr) for attr in f[obj].ncattrs()}
             else:
@@ -26,53 +82,77 @@ class NcCollector(Collector):
 
         return attrs
 
-    def collect(self, resource):
-        store = Store(name=resource)
+    def names(self, f):
+        """Names of the variables of the dataset that are collected."""
+        return self.select_variables(
+            list(f.variables),
+            lambda v: references({attr: f[v].getncattr(attr) for attr in f[v].ncattrs()}) + list(f[v].dimensions))
+
+    @staticmethod
+    def fingerprints(f, names):
+        """Fingerprints of the raw values of the variables that are one dimensional coordinates."""
+        fingerprints = dict()
+        for v in grid_coordinates({v: (f[v].dimensions, {attr: f[v].getncattr(attr) for attr in f[v].ncattrs()})
+                              for v in names}):
+            # h5netcdf datasets are never masked nor scaled
+            if hasattr(f[v], "set_auto_maskandscale"):
+                f[v].set_auto_maskandscale(False)
+            fingerprints[v] = coordinate_fingerprint(f[v][...])
+
+        return fingerprints
+
+    def schema(self, f):
+        schema = list()
+        for v in self.names(f):
+            # .dtype may return a python type rather than a numpy dtype
+            try:
+                dtype = f[v].dtype.str
+            except AttributeError:
+                dtype = None
+            attrs = {attr: f[v].getncattr(attr) for attr in f[v].ncattrs()}
+            schema.append((v, dtype, f[v].dimensions, attributes_digest(attrs, self.ignored_attrs())))
 
-        if os.path.isfile(resource):
-            store.size=os.stat(resource).st_size
+        return tuple(schema)
 
-        f = netCDF4.Dataset(resource)
+    def collect_record(self, resource):
+        stats = StoreStats()
+        with stats.time("open"):
+            f = self.open(resource, stats)
 
-        # global attributes
-        attrs = {attr: f.getncattr(attr) for attr in f.ncattrs()}
-        for attr in attrs:
-            if attr in self.ignored_attrs():
-                continue
-            elif isinstance(attrs[attr], str):
-                attribute = GlobalAttribute(
-                    name=attr,
-                    value=attrs[attr],
-                    store_id=store.id)
-                store.attrs.append(attribute)
-            elif isinstance(attrs[attr], bytes):
-                attribute = GlobalAttribute(
-                    name=attr,
-                    value=attrs[attr].decode("utf-8"),
-                    store_id=store.id)
-                store.attrs.append(attribute)
+        schema = self.schema(f) if self.homogeneous else None
+        prototype = self.prototype(schema)
+        if prototype is not None:
+            store = prototype.copy(resource)
+            store.size = self.size(resource)
+            store.attrs = self.collect_global_attrs(f, resource)
+            fingerprints = self.fingerprints(f, [variable.name for variable in store.variables])
+            for variable in store.variables:
+                variable.fingerprint = fingerprints.get(variable.name)
+                for dimension in variable.dimensions:
+                    dimension.size = f[variable.name].shape[dimension.index]
+            f.close()
+            store.stats = stats.finish()
 
-        # drs
-        drs = self.parse_drs(resource)
-        for facet in drs:
-            global_attribute = GlobalAttribute(
-                name=facet,
-                value=drs[facet],
-                store_id=store.id)
-            store.attrs.append(global_attribute)
+            return store
+
+        store = StoreRecord(name=resource, size=self.size(resource))
+
+        store.attrs = self.collect_global_attrs(f, resource)
 
         # variables
-        for v in f.variables:
+        names = self.names(f)
+        fingerprints = self.fingerprints(f, names)
+        for v in names:
             # .dtype may return a python type rather than a numpy dtype
             try:
                 dtype = f[v].dtype.str
             except AttributeError:
                 dtype = None
 
-            variable = Variable(
+            variable = VariableRecord(
                 name=v,
                 dtype=dtype,
-                store_id=store.id)
+                fingerprint=fingerprints.get(v))
 
             # attrs
             attrs = {attr: f[v].getncattr(attr) for attr in f[v].ncattrs()}
@@ -80,47 +160,44 @@ class NcCollector(Collector):
                 if attr in self.ignored_attrs():
                     continue
                 elif isinstance(attrs[attr], str):
-                    attribute = Attribute(
-                        name=attr,
-                        value=attrs[attr],
-                        variable_id=variable.id)
-                    variable.attrs.append(attribute)
+                    variable.attrs.append((attr, attrs[attr]))
                 elif isinstance(attrs[attr], bytes):
-                    attribute = Attribute(
-                        name=attr,
-                        value=attrs[attr].decode("utf-8"),
-                        variable_id=variable.id)
-                    variable.attrs.append(attribute)
+                    variable.attrs.append((attr, attrs[attr].decode("utf-8")))
                 elif attr == "_FillValue":
-                    attribute = Attribute(
-                        name="_FillValue",
-                        value=attrs["_FillValue"],
-                        variable_id=variable.id
-                    )
-                    variable.attrs.append(attribute)
+                    variable.attrs.append(("_FillValue", attrs["_FillValue"]))
 
             # dimensions
             for i, dim in enumerate(f[v].dimensions):
-                if isinstance(f[v].chunking(), list):
-                    dimension = Dimension(
-                        index=i,
-                        size=f[v].shape[i],
-                        variable_id=variable.id)
-                else:
-                    dimension = Dimension(
-                        index=i,
-                        size=f[v].shape[i],
-                        variable_id=variable.id)
-
-                scale = Scale(
-                    name=dim,
-                    dimension_id=dimension.id,
-                    variable_id=variable.id)
-                dimension.scales.append(scale)
-                variable.scales.append(scale)
-
+                dimension = DimensionRecord(
+                    index=i,
+                    size=f[v].shape[i],
+                    scales=[dim])
                 variable.dimensions.append(dimension)
+
             store.variables.append(variable)
+
+        self.add_prototype(schema, store)
         f.close()
+        store.stats = stats.finish()
 
         return store
+
+    def collect_global_attrs(self, f, resource):
+        global_attrs = list()
+
+        # global attributes
+        attrs = {attr: f.getncattr(attr) for attr in f.ncattrs()}
+        for attr in attrs:
+            if attr in self.ignored_attrs():
+                continue
+            elif isinstance(attrs[attr], str):
+                global_attrs.append((attr, attrs[attr]))
+            elif isinstance(attrs[attr], bytes):
+                global_attrs.append((attr, attrs[attr].decode("utf-8")))
+
+        # drs
+        drs = self.parse_drs(resource)
+        for facet in drs:
+            global_attrs.append((facet, drs[facet]))
+
+        return global_attrs
@@ -0,0 +1,364 @@
+import logging
+import math
+import os
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+from smgdatatools.collector.lib import Collector, StoreStats, references, grid_coordinates, \
+    coordinate_fingerprint, attributes_digest
+from smgdatatools.model.records import StoreRecord, VariableRecord, DimensionRecord, ChunkTable
+
+MAGIC = b"CDF"
+NC_DIMENSION, NC_VARIABLE, NC_ATTRIBUTE = 0x0A, 0x0B, 0x0C
+
+# external types, data is big endian
+NC_TYPES = {
+    1: "i1",
+    2: "S1",
+    3: ">i2",
+    4: ">i4",
+    5: ">f4",
+    6: ">f8",
+    7: "u1",
+    8: ">u2",
+    9: ">u4",
+    10: ">i8",
+    11: ">u8",
+}
+
+# default fill values of the netCDF library
+FILL_VALUES = {
+    1: -127,
+    3: -32767,
+    4: -2147483647,
+    5: 9.9692099683868690e+36,
+    6: 9.9692099683868690e+36,
+    7: 255,
+    8: 65535,
+    9: 4294967295,
+    10: -9223372036854775806,
+    11: 18446744073709551614,
+}
+
+Nc3Variable = namedtuple("Nc3Variable", ["name", "dimensions", "attrs", "nc_type", "begin"])
+Nc3Header = namedtuple("Nc3Header", ["version", "numrecs", "dimensions", "attrs", "variables"])
+
+
+def pad(n):
+    """Header values and variable data are padded to 4 bytes."""
+    return n + (-n % 4)
+
+
+class HeaderReader:
+    """Sequential reader of the header of a netCDF-3 file, see
+    https://docs.unidata.ucar.edu/nug/current/file_format_specifications.html
+
+    Classic files (version 1) use 32 bit offsets, 64-bit offset files (version 2) use 64 bit offsets and CDF-5
+    files (version 5) use 64 bit offsets and 64 bit sizes.
+    """
+
+    def __init__(self, fh):
+        self.fh = fh
+        magic = self.read(4)
+        if magic[:3] != MAGIC or magic[3] not in (1, 2, 5):
+            raise ValueError("Not a netCDF-3 file")
+        self.version = magic[3]
+
+    def read(self, n):
+        data = self.fh.read(n)
+        if len(data) < n:
+            raise ValueError("Truncated netCDF-3 header")
+
+        return data
+
+    def int(self):
+        return struct.unpack(">i", self.read(4))[0]
+
+    def size(self):
+        if self.version == 5:
+            return struct.unpack(">q", self.read(8))[0]
+
+        return struct.unpack(">I", self.read(4))[0]
+
+    def offset(self):
+        if self.version == 1:
+            return struct.unpack(">I", self.read(4))[0]
+
+        return struct.unpack(">q", self.read(8))[0]
+
+    def name(self):
+        n = self.size()
+        return self.read(pad(n))[:n].decode("utf-8")
+
+    def values(self, nc_type, n):
+        dtype = np.dtype(NC_TYPES[nc_type])
+        data = self.read(pad(n * dtype.itemsize))[:n * dtype.itemsize]
+        if nc_type == 2:
+            return data.rstrip(b"\0").decode("utf-8", "replace")
+
+        return np.frombuffer(data, dtype=dtype)
+
+    def list(self, tag, item):
+        """A list of the header, ABSENT lists have a zero tag and no elements."""
+        found = self.int()
+        n = self.size()
+        if found == 0 and n == 0:
+            return list()
+        elif found != tag:
+            raise ValueError("Invalid netCDF-3 header, expected tag {} found {}".format(tag, found))
+
+        return [item() for _ in range(n)]
+
+    def attribute(self):
+        name = self.name()
+        nc_type = self.int()
+        return name, self.values(nc_type, self.size())
+
+    def dimension(self):
+        return self.name(), self.size()
+
+    def variable(self):
+        name = self.name()
+        dimensions = [self.size() for _ in range(self.size())]
+        attrs = dict(self.list(NC_ATTRIBUTE, self.attribute))
+        nc_type = self.int()
+        # vsize is capped for large variables, sizes are computed from the shape instead
+        self.size()
+        return Nc3Variable(name, dimensions, attrs, nc_type, self.offset())
+
+    def header(self):
+        numrecs = self.size()
+        dimensions = self.list(NC_DIMENSION, self.dimension)
+        attrs = dict(self.list(NC_ATTRIBUTE, self.attribute))
+        variables = self.list(NC_VARIABLE, self.variable)
+
+        return Nc3Header(self.version, numrecs, dimensions, attrs, variables)
+
+
+def read_header(fh):
+    return HeaderReader(fh).header()
+
+
+def layout(header, file_size=None):
+    """Shape, record size and number of records of the variables of a header.
+
+    Record variables are interleaved: record ``r`` of every record variable is stored at ``begin + r * recsize``
+    where ``recsize`` is the sum of the padded record sizes of all the record variables, without padding if there
+    is a single record variable. The number of records of files being written (streaming) is computed from the
+    size of the file.
+    """
+    shapes = dict()
+    record_sizes = dict()
+    for v in header.variables:
+        shape = [header.dimensions[d][1] for d in v.dimensions]
+        record = bool(v.dimensions) and header.dimensions[v.dimensions[0]][1] == 0
+        shapes[v.name] = shape
+        if record:
+            record_sizes[v.name] = math.prod(shape[1:]) * np.dtype(NC_TYPES[v.nc_type]).itemsize
+
+    if len(record_sizes) == 1:
+        recsize = sum(record_sizes.values())
+    else:
+        recsize = sum(pad(size) for size in record_sizes.values())
+
+    numrecs = header.numrecs
+    if numrecs in (0xFFFFFFFF, -1):
+        first = min((v.begin for v in header.variables if v.name in record_sizes), default=None)
+        numrecs = (file_size - first) // recsize if first is not None and file_size and recsize else 0
+    for name in record_sizes:
+        shapes[name][0] = numrecs
+
+    return shapes, record_sizes, recsize, numrecs
+
+
+class Nc3Collector(Collector):
+    """netCDF-3 classic, 64-bit offset and CDF-5 files, collected from their header without the netCDF library.
+
+    Variables are contiguous. Fixed size variables are a single chunk and record variables have one chunk per
+    record, so their chunk index addresses the data of the file in place.
+    """
+
+    # only the header is read, with a few plain range requests
+    io_bound = True
+    in_place = True
+
+    def __init__(self, drs=None, homogeneous=False, storage=None, variables=None, block_size=65536,
+                 chunk_hash=None, chunk_stats=None):
+        super().__init__(drs, homogeneous, storage, variables, chunk_hash, chunk_stats)
+        self.block_size = block_size
+
+    def open(self, resource, stats=None):
+        if self.storage.is_local(resource):
+            return open(self.storage.path(resource), "rb")
+
+        fh = self.storage.open(resource, cache_type="readahead", block_size=self.block_size)
+        if stats is not None:
+            stats.wrap(fh)
+
+        return fh
+
+    @staticmethod
+    def file_size(fh):
+        """Size of an open file, remote files know it since they were opened."""
+        size = getattr(fh, "size", None)
+        return size if size is not None else os.fstat(fh.fileno()).st_size
+
+    def read_header(self, resource, stats=None):
+        with self.open(resource, stats) as fh:
+            return read_header(fh)
+
+    @staticmethod
+    def read_array(fh, v, shape, record_size, recsize):
+        """Values of a variable, ``record_size`` is None for fixed size variables."""
+        dtype = np.dtype(NC_TYPES[v.nc_type])
+        if record_size is not None:
+            records = list()
+            for r in range(shape[0]):
+                fh.seek(v.begin + r * recsize)
+                records.append(fh.read(record_size))
+            data = b"".join(records)
+        else:
+            fh.seek(v.begin)
+            data = fh.read(math.prod(shape) * dtype.itemsize)
+
+        return np.frombuffer(data, dtype=dtype).reshape(shape)
+
+    def read_variable(self, store, variable):
+        with self.open(store) as fh:
+            header = read_header(fh)
+            shapes, record_sizes, recsize, numrecs = layout(header, self.file_size(fh))
+            v = [x for x in header.variables if x.name == variable][0]
+            return self.read_array(fh, v, shapes[variable], record_sizes.get(variable), recsize)
+
+    def read_attributes(self, store, obj=None):
+        header = self.read_header(store)
+        if obj:
+            return [v for v in header.variables if v.name == obj][0].attrs
+
+        return header.attrs
+
+    def collect_attrs(self, attrs):
+        collected = list()
+        for attr, value in attrs.items():
+            if attr in self.ignored_attrs():
+                continue
+            elif isinstance(value, str):
+                collected.append((attr, value))
+            elif attr == "_FillValue":
+                collected.append((attr, value[0]))
+
+        return collected
+
+    def collect_global_attrs(self, header, resource):
+        attrs = self.collect_attrs(header.attrs)
+        drs = self.parse_drs(resource)
+        for facet in drs:
+            attrs.append((facet, drs[facet]))
+
+        return attrs
+
+    def schema(self, header, variables, names, record_sizes):
+        return tuple((name,
+                      variables[name].nc_type,
+                      tuple(header.dimensions[d][0] for d in variables[name].dimensions),
+                      name in record_sizes,
+                      attributes_digest(variables[name].attrs, self.ignored_attrs()))
+                     for name in names)
+
+    @staticmethod
+    def chunk_layout(shape, record, i):
+        """Chunk count and chunk shape of dimension i, record variables have one chunk per record and fixed size
+        variables are a single chunk."""
+        if record:
+            return (shape[0], 1) if i == 0 else (1, shape[i])
+
+        return None, shape[i]
+
+    @staticmethod
+    def collect_chunks(v, shape, record_size, recsize, numrecs):
+        if record_size is not None:
+            return ChunkTable(
+                v.begin + np.arange(numrecs, dtype=np.int64) * recsize,
+                np.full(numrecs, record_size, dtype=np.int64),
+                np.arange(numrecs, dtype=np.int64))
+        elif math.prod(shape) > 0:
+            return ChunkTable([v.begin], [math.prod(shape) * np.dtype(NC_TYPES[v.nc_type]).itemsize], [0])
+
+        return ChunkTable()
+
+    def collect_record(self, resource):
+        logging.warning("Collecting from {}".format(resource))
+
+        stats = StoreStats()
+        with self.open(resource, stats) as fh:
+            with stats.time("open"):
+                header = read_header(fh)
+                size = self.file_size(fh)
+            shapes, record_sizes, recsize, numrecs = layout(header, size)
+
+            variables = {v.name: v for v in header.variables}
+            names = self.select_variables(
+                list(variables),
+                lambda v: references(variables[v].attrs) + [header.dimensions[d][0] for d in variables[v].dimensions])
+
+            # one dimensional coordinates are small, their values are read through the cache of the header
+            fingerprints = dict()
+            for name in grid_coordinates({name: ([header.dimensions[d][0] for d in variables[name].dimensions],
+                                            variables[name].attrs) for name in names}):
+                values = self.read_array(fh, variables[name], shapes[name], record_sizes.get(name), recsize)
+                fingerprints[name] = coordinate_fingerprint(values)
+
+        schema = self.schema(header, variables, names, record_sizes) if self.homogeneous else None
+        prototype = self.prototype(schema)
+        if prototype is not None:
+            # only sizes, offsets and global attributes vary between the stores of a homogeneous collection
+            store = prototype.copy(resource)
+            store.size = size
+            store.attrs = self.collect_global_attrs(header, resource)
+            for variable in store.variables:
+                shape = shapes[variable.name]
+                for dimension in variable.dimensions:
+                    dimension.size = shape[dimension.index]
+                    dimension.chunk_count, dimension.chunk_shape = self.chunk_layout(
+                        shape, variable.name in record_sizes, dimension.index)
+                variable.fingerprint = fingerprints.get(variable.name)
+                with stats.time("chunks"):
+                    variable.chunks = self.collect_chunks(
+                        variables[variable.name], shape, record_sizes.get(variable.name), recsize, numrecs)
+            store.stats = stats.finish()
+
+            return store
+
+        store = StoreRecord(name=resource, size=size)
+        store.attrs = self.collect_global_attrs(header, resource)
+
+        for name in names:
+            v = variables[name]
+            shape = shapes[name]
+            fillvalue = v.attrs["_FillValue"][0] if "_FillValue" in v.attrs else FILL_VALUES.get(v.nc_type)
+            variable = VariableRecord(
+                name=name,
+                dtype=np.dtype(NC_TYPES[v.nc_type]).str,
+                fillvalue=fillvalue,
+                attrs=self.collect_attrs(v.attrs),
+                fingerprint=fingerprints.get(name))
+
+            for i, d in enumerate(v.dimensions):
+                chunk_count, chunk_shape = self.chunk_layout(shape, name in record_sizes, i)
+                variable.dimensions.append(DimensionRecord(
+                    index=i,
+                    size=shape[i],
+                    chunk_count=chunk_count,
+                    chunk_shape=chunk_shape,
+                    scales=[header.dimensions[d][0]]))
+
+            with stats.time("chunks"):
+                variable.chunks = self.collect_chunks(v, shape, record_sizes.get(name), recsize, numrecs)
+            store.variables.append(variable)
+
+        self.add_prototype(schema, store)
+        store.stats = stats.finish()
+
+        return store
@@ -0,0 +1,83 @@
+import posixpath
+
+import h5py
+import numpy as np
+
+from smgdatatools.collector.h5 import Hdf5ChunkCollector
+
+# NAME of the datasets that netCDF-4 creates for dimensions without coordinate variable
+NOT_A_VARIABLE = b"This is a netCDF dimension but not a netCDF variable"
+
+
+class Nc4Collector(Hdf5ChunkCollector):
+    """netCDF-4 files read through h5py in a single pass.
+
+    Besides the chunk index, compressor and filters collected by Hdf5ChunkCollector, variables keep the netCDF
+    view of the file: dimensions are named after their netCDF dimension, the typed ``_FillValue`` is kept, the
+    bookkeeping of the netCDF library (dimension scales without variable, hidden attributes) is left out and DRS
+    facets are added to the global attributes.
+    """
+
+    def datasets(self, f):
+        datasets = list()
+        for v in super().datasets(f):
+            ds = f[v]
+            if not isinstance(ds, h5py.Dataset):
+                continue
+            elif ds.attrs.get("NAME", b"").startswith(NOT_A_VARIABLE):
+                continue
+            datasets.append(v)
+
+        return datasets
+
+    def store_size(self, resource):
+        if self.driver:
+            return None
+
+        return self.storage.info(resource)["size"]
+
+    def collect_attrs(self, attrs):
+        collected = list()
+        for attr in attrs:
+            if attr in self.ignored_attrs():
+                continue
+            elif isinstance(attrs[attr], str):
+                collected.append((attr, attrs[attr]))
+            elif isinstance(attrs[attr], bytes):
+                collected.append((attr, attrs[attr].decode("utf-8")))
+            elif attr == "_FillValue":
+                # h5py reads attributes as arrays, keep the scalar of the variable type like netCDF4 does
+                collected.append((attr, np.asarray(attrs[attr]).reshape(-1)[0]))
+
+        return collected
+
+    def collect_scales(self, dim, attrs):
+        # coordinate variables are the dimension scale of their dimension, the netCDF dimension of the axes of
+        # other variables is the first dimension scale attached to them
+        if attrs.get("CLASS") == b"DIMENSION_SCALE" and attrs.get("NAME"):
+            return [attrs["NAME"].decode("utf-8")]
+
+        for _, scale in dim.items():
+            return [posixpath.basename(scale.name)]
+
+        return list()
+
+    def collect_global_attrs(self, f, resource=None):
+        global_attrs = self.collect_attrs(dict(f.attrs))
+
+        # drs
+        drs = self.parse_drs(resource)
+        for facet in drs:
+            global_attrs.append((facet, drs[facet]))
+
+        return global_attrs
+
+    def ignored_attrs(self):
+        return super().ignored_attrs() + (
+            "CLASS",
+            "NAME",
+            "_Netcdf4Dimid",
+            "_Netcdf4Coordinates",
+            "_nc3_strict",
+            "_NCProperties",
+        )
@@ -0,0 +1,138 @@
+import asyncio
+import collections
+import json
+import logging
+import queue
+import time
+import traceback
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from smgdatatools.model.records import FailureRecord
+
+try:
+    from aiohttp import ClientError
+except ImportError:
+    ClientError = ConnectionError
+
+EXECUTORS = ("auto", "process", "thread")
+
+# errors of remote storage that may go away when the request is repeated, anything else fails the store at once
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, asyncio.TimeoutError, ClientError)
+
+# collector of the current worker process, installed once by init_worker so that per-worker state (prototypes of
+# homogeneous collections, filesystem clients) is reused across tasks instead of being pickled with every task
+_collector = None
+_retries = 0
+_backoff = 1.
+_fingerprint = False
+_checksum = False
+
+
+def init_worker(collector, retries=0, backoff=1., fingerprint=False, checksum=False):
+    global _collector, _retries, _backoff, _fingerprint, _checksum
+    _collector = collector
+    _retries = retries
+    _backoff = backoff
+    _fingerprint = fingerprint
+    _checksum = checksum
+
+
+def collect_record(resource):
+    """Collect a store, a failure is returned instead of raised so that it does not abort the collection. Transient
+    errors are retried with exponential backoff. The fingerprint of the input is taken before it is read, if
+    requested, so that a change during collection is found by the next incremental run."""
+    for attempt in range(_retries + 1):
+        try:
+            fingerprint = _collector.storage.fingerprint(resource, _checksum) if _fingerprint else (None, None, None)
+            record = _collector.collect_record(resource)
+            if _collector.reads_chunks:
+                _collector.scan_chunks(record)
+            if fingerprint[0] is not None:
+                record.size, record.mtime, record.checksum = fingerprint
+            return record
+        except TRANSIENT_ERRORS as e:
+            if attempt == _retries:
+                return FailureRecord(resource, repr(e), traceback.format_exc(), attempt + 1)
+            delay = _backoff * 2 ** attempt
+            logging.warning("Retrying {} in {}s after {!r}".format(resource, delay, e))
+            time.sleep(delay)
+        except Exception as e:
+            return FailureRecord(resource, repr(e), traceback.format_exc(), attempt + 1)
+
+
+def collect_group(resources):
+    return [collect_record(resource) for resource in resources]
+
+
+class Quarantine:
+    """Inputs that could not be collected, appended with their tracebacks to a JSON lines file if one is given."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.count = 0
+
+    def add(self, failure):
+        self.count += 1
+        logging.error("Failed to collect {} after {} attempts: {}".format(
+            failure.name,
+            failure.attempts,
+            failure.error))
+        logging.debug(failure.traceback)
+        if self.path:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(failure.to_dict()) + "\n")
+
+
+def executor_for(collector, executor="auto"):
+    """Threads for collectors that mostly wait on the network, processes for those that parse files."""
+    if executor == "auto":
+        return "thread" if collector.io_bound else "process"
+
+    return executor
+
+
+def make_pool(collector, executor, processes, threads, retries=0, backoff=1., fingerprint=False, checksum=False):
+    if executor == "thread":
+        return ThreadPool(threads, init_worker, (collector, retries, backoff, fingerprint, checksum))
+
+    return Pool(processes, init_worker, (collector, retries, backoff, fingerprint, checksum))
+
+
+def stream(pool, func, inputs, max_in_flight, ordered=True):
+    """Like ``pool.imap``/``pool.imap_unordered``, but with at most ``max_in_flight`` inputs submitted and not yet
+    consumed, so memory stays bounded when the consumer is slower than the workers."""
+    if ordered:
+        pending = collections.deque()
+        for x in inputs:
+            pending.append(pool.apply_async(func, (x,)))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    else:
+        done = queue.Queue()
+        in_flight = 0
+        for x in inputs:
+            pool.apply_async(
+                func,
+                (x,),
+                callback=lambda result: done.put((True, result)),
+                error_callback=lambda error: done.put((False, error)))
+            in_flight += 1
+            if in_flight >= max_in_flight:
+                yield _result(done.get())
+                in_flight -= 1
+
+        while in_flight > 0:
+            yield _result(done.get())
+            in_flight -= 1
+
+
+def _result(item):
+    ok, result = item
+    if not ok:
+        raise result
+
+    return result
@@ -0,0 +1,80 @@
+import collections
+import posixpath
+import re
+
+# time range at the end of CMIP/CORDEX style file names, e.g. tas_Amon_..._185001-186912.nc
+TIME_RANGE = re.compile(r"_(\d{4,14})-(\d{4,14})(?:-clim)?\.[^_]*$")
+
+# timestamps are compared as fixed width strings of digits, YYYYMMDDhhmmss
+TIME_WIDTH = 14
+
+Entry = collections.namedtuple("Entry", ["name", "facets", "start", "end"])
+
+
+def parse_time(value, end=False):
+    """Pad a partial timestamp (1850, 185001, 18500101, ...) so that it can be compared with other timestamps,
+    ends of ranges are padded to the last instant of the period."""
+    return value.ljust(TIME_WIDTH, "9" if end else "0")
+
+
+def time_range(name):
+    match = TIME_RANGE.search(posixpath.basename(name))
+    if match is None:
+        return None, None
+
+    return parse_time(match.group(1)), parse_time(match.group(2), end=True)
+
+
+def parse_time_window(spec):
+    """Time window from a START-END spec, either side may be empty."""
+    if not spec:
+        return None
+
+    start, end = spec.split("-")
+    return parse_time(start) if start else None, parse_time(end, end=True) if end else None
+
+
+def parse_select(specs):
+    """Facet values from FACET=VALUE[,VALUE...] specs."""
+    select = dict()
+    for spec in specs or list():
+        facet, values = spec.split("=")
+        select.setdefault(facet, set()).update(values.split(","))
+
+    return select
+
+
+def scan(inputs, drs=None):
+    """DRS facets and time range of every input, taken from its path only."""
+    for name in inputs:
+        facets = dict()
+        if drs is not None:
+            match = drs.search(name)
+            if match is not None:
+                facets = match.groupdict()
+        start, end = time_range(name)
+        yield Entry(name, facets, start, end)
+
+
+def prune(entries, select=None, time_window=None):
+    """Drop the entries whose facets are not selected or whose time range is outside of the time window. Entries
+    without time range are kept."""
+    for entry in entries:
+        if select and any(entry.facets.get(facet) not in values for facet, values in select.items()):
+            continue
+        if time_window and entry.start is not None:
+            start, end = time_window
+            if (end is not None and entry.start > end) or (start is not None and entry.end < start):
+                continue
+        yield entry
+
+
+def group(entries, facets):
+    """Group the entries by the values of some facets. Groups keep the order in which they first appear and their
+    names are ordered by time."""
+    groups = dict()
+    for entry in entries:
+        key = tuple(entry.facets.get(facet) for facet in facets)
+        groups.setdefault(key, list()).append(entry)
+
+    return [[entry.name for entry in sorted(g, key=lambda e: (e.start or "", e.name))] for g in groups.values()]
@@ -0,0 +1,149 @@
+import datetime
+import json
+import logging
+import os
+import socket
+import time
+
+import numpy as np
+
+PHASES = ("open", "metadata", "chunks", "total")
+COUNTERS = ("variables", "chunks", "requests", "bytes")
+QUANTILES = (0.5, 0.9, 0.99, 1.0)
+
+
+class Telemetry:
+    """Collection telemetry gathered in the parent process from the records sent back by the workers.
+
+    Progress (stores/s, chunks/s and ETA when the number of inputs is known) is logged every ``interval``
+    seconds, inputs that failed count as processed and are reported on their own. The summary has the totals,
+    throughput and percentiles of every phase and counter, and the slowest stores.
+    """
+
+    def __init__(self, total=None, interval=10., slowest=10):
+        self.total = total
+        self.interval = interval
+        self.slowest = slowest
+        self.start = time.monotonic()
+        self.last = self.start
+        self.names = list()
+        self.timings = {phase: list() for phase in PHASES}
+        self.counters = {counter: list() for counter in COUNTERS}
+        self.failures = 0
+
+    def add(self, record):
+        stats = record.stats
+        self.names.append(record.name)
+        for phase in PHASES:
+            self.timings[phase].append(stats.timings.get(phase, 0.) if stats else 0.)
+        self.counters["variables"].append(len(record.variables))
+        self.counters["chunks"].append(sum(len(v.chunks) for v in record.variables))
+        self.counters["requests"].append(stats.requests if stats else 0)
+        self.counters["bytes"].append(stats.bytes if stats else 0)
+
+        logging.info("Collected {} in {:.3f}s ({} chunks, {} requests, {} bytes)".format(
+            record.name,
+            self.timings["total"][-1],
+            self.counters["chunks"][-1],
+            self.counters["requests"][-1],
+            self.counters["bytes"][-1]))
+        self.tick()
+
+    def add_failure(self, failure):
+        self.failures += 1
+        self.tick()
+
+    def tick(self):
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            logging.warning(self.progress(now))
+
+    def progress(self, now=None):
+        elapsed = (now or time.monotonic()) - self.start
+        done = len(self.names) + self.failures
+        stores_per_s = done / elapsed if elapsed > 0 else 0.
+        chunks_per_s = sum(self.counters["chunks"]) / elapsed if elapsed > 0 else 0.
+
+        message = "{} stores, {:.1f} stores/s, {:.1f} chunks/s".format(done, stores_per_s, chunks_per_s)
+        if self.total:
+            eta = (self.total - done) / stores_per_s if stores_per_s > 0 else float("inf")
+            message = "{}/{} stores ({:.1f}%), {:.1f} stores/s, {:.1f} chunks/s, ETA {}".format(
+                done,
+                self.total,
+                100. * done / self.total,
+                stores_per_s,
+                chunks_per_s,
+                datetime.timedelta(seconds=round(eta)) if eta != float("inf") else "unknown")
+        if self.failures:
+            message += ", {} failed".format(self.failures)
+
+        return message
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        summary = {
+            "host": socket.gethostname(),
+            "stores": len(self.names),
+            "failures": self.failures,
+            "elapsed": elapsed,
+            "stores_per_s": len(self.names) / elapsed if elapsed > 0 else 0.,
+            "chunks_per_s": sum(self.counters["chunks"]) / elapsed if elapsed > 0 else 0.,
+            "totals": {counter: int(sum(values)) for counter, values in self.counters.items()},
+            "seconds": {phase: percentiles(values) for phase, values in self.timings.items()},
+            "counts": {counter: percentiles(values) for counter, values in self.counters.items()},
+        }
+        order = np.argsort(self.timings["total"])[::-1][:self.slowest]
+        summary["slowest"] = [{"name": self.names[i], "seconds": self.timings["total"][i]} for i in order]
+
+        return summary
+
+    def write_json(self, dest):
+        with open(dest, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, dest):
+        """Write the summary in the Prometheus text format, e.g. for the textfile collector of node_exporter."""
+        summary = self.summary()
+        lines = [
+            "# HELP smgdatatools_collect_stores Stores collected.",
+            "# TYPE smgdatatools_collect_stores gauge",
+            "smgdatatools_collect_stores {}".format(summary["stores"]),
+            "# HELP smgdatatools_collect_failures Inputs that could not be collected.",
+            "# TYPE smgdatatools_collect_failures gauge",
+            "smgdatatools_collect_failures {}".format(summary["failures"]),
+            "# HELP smgdatatools_collect_elapsed_seconds Duration of the collection.",
+            "# TYPE smgdatatools_collect_elapsed_seconds gauge",
+            "smgdatatools_collect_elapsed_seconds {}".format(summary["elapsed"]),
+        ]
+        for counter, total in summary["totals"].items():
+            lines.append("# TYPE smgdatatools_collect_{}_total counter".format(counter))
+            lines.append("smgdatatools_collect_{}_total {}".format(counter, total))
+
+        lines.append("# HELP smgdatatools_collect_store_seconds Time spent collecting a store by phase.")
+        lines.append("# TYPE smgdatatools_collect_store_seconds summary")
+        for phase in PHASES:
+            for quantile, value in zip(QUANTILES, summary["seconds"][phase].values()):
+                lines.append('smgdatatools_collect_store_seconds{{phase="{}",quantile="{}"}} {}'.format(
+                    phase,
+                    quantile,
+                    value))
+            lines.append('smgdatatools_collect_store_seconds_sum{{phase="{}"}} {}'.format(
+                phase,
+                sum(self.timings[phase])))
+            lines.append('smgdatatools_collect_store_seconds_count{{phase="{}"}} {}'.format(
+                phase,
+                len(self.timings[phase])))
+
+        # write and rename so that the textfile collector never reads a partial file
+        with open(dest + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(dest + ".tmp", dest)
+
+
+def percentiles(values):
+    if not values:
+        return {"p50": 0., "p90": 0., "p99": 0., "max": 0.}
+
+    p50, p90, p99, maximum = np.quantile(np.asarray(values, dtype=float), QUANTILES).tolist()
+    return {"p50": p50, "p90": p90, "p99": p99, "max": maximum}
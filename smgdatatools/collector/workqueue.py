@@ -0,0 +1,143 @@
+import logging
+import os
+import threading
+import time
+import uuid
+
+PENDING, LEASED, DONE = "pending", "leased", "done"
+
+
+class Lease:
+    def __init__(self, queue, name, inputs):
+        self.queue = queue
+        self.name = name
+        self.inputs = inputs
+        self.renewed = time.time()
+        self.stopped = threading.Event()
+
+    @property
+    def path(self):
+        return os.path.join(self.queue.root, LEASED, self.name)
+
+    def renew(self, interval=0.):
+        """Tell the other workers that the batch is still being collected, at most once every ``interval``
+        seconds."""
+        if time.time() - self.renewed >= interval:
+            os.utime(self.path)
+            self.renewed = time.time()
+
+    def heartbeat(self, interval):
+        """Renew the lease every ``interval`` seconds from a background thread until the batch is completed, so that
+        a store that takes longer than the lease timeout to collect does not get the batch requeued."""
+        def beat():
+            while not self.stopped.wait(interval):
+                try:
+                    self.renew()
+                except FileNotFoundError:
+                    logging.warning("Lease of batch {} was lost".format(self.name))
+                    return
+
+        threading.Thread(target=beat, name="lease-{}".format(self.name), daemon=True).start()
+
+    def complete(self):
+        self.stopped.set()
+        try:
+            os.rename(self.path, os.path.join(self.queue.root, DONE, self.name))
+        except FileNotFoundError:
+            # the lease expired and the batch was requeued, the stores collected twice are de-duplicated by merge
+            logging.warning("Lease of batch {} was lost".format(self.name))
+
+
+class WorkQueue:
+    """Queue of input batches on a shared filesystem, without any service besides the filesystem.
+
+    Batches are text files with one input per line that move from ``pending/`` to ``leased/`` when a worker claims
+    them and to ``done/`` when they are collected. Every move is a rename, which is atomic, so a batch is claimed by
+    a single worker. Workers renew their leases by touching the batch file from a heartbeat thread, leases that have
+    not been renewed for ``lease_timeout`` seconds belong to stalled workers and are moved back to ``pending/``.
+    Modification times are compared with the clock of the worker, nodes are expected to have synchronized clocks.
+    """
+
+    def __init__(self, root, lease_timeout=600.):
+        self.root = root
+        self.lease_timeout = lease_timeout
+
+    def create(self, inputs, batch_size=100):
+        """Split the inputs into pending batches, returns the number of batches."""
+        for state in (PENDING, LEASED, DONE):
+            os.makedirs(os.path.join(self.root, state), exist_ok=True)
+
+        batches = 0
+        batch = list()
+        for x in inputs:
+            batch.append(x)
+            if len(batch) >= batch_size:
+                self.put(batches, batch)
+                batches += 1
+                batch = list()
+        if batch:
+            self.put(batches, batch)
+            batches += 1
+
+        return batches
+
+    def put(self, n, batch):
+        name = "{:08d}.txt".format(n)
+        tmp = os.path.join(self.root, "{}.{}.tmp".format(name, uuid.uuid4().hex))
+        with open(tmp, "w") as f:
+            f.writelines(x + "\n" for x in batch)
+        os.rename(tmp, os.path.join(self.root, PENDING, name))
+
+    def list(self, state):
+        return sorted(os.listdir(os.path.join(self.root, state)))
+
+    def requeue_stale(self):
+        """Move the leases that were not renewed in time back to pending, returns the requeued batches."""
+        requeued = list()
+        now = time.time()
+        for name in self.list(LEASED):
+            path = os.path.join(self.root, LEASED, name)
+            try:
+                if now - os.stat(path).st_mtime < self.lease_timeout:
+                    continue
+                os.rename(path, os.path.join(self.root, PENDING, name))
+            except FileNotFoundError:
+                # completed or requeued by another worker meanwhile
+                continue
+            logging.warning("Requeued stale batch {}".format(name))
+            requeued.append(name)
+
+        return requeued
+
+    def claim(self):
+        """Lease the next pending batch, None if there are no pending batches."""
+        self.requeue_stale()
+        for name in self.list(PENDING):
+            pending, leased = os.path.join(self.root, PENDING, name), os.path.join(self.root, LEASED, name)
+            try:
+                # the lease starts now, not when the batch was created, the batch must never be in leased/ with the
+                # time it was created or requeued or another worker could requeue it at once
+                os.utime(pending)
+                os.rename(pending, leased)
+            except FileNotFoundError:
+                # claimed by another worker
+                continue
+            with open(leased) as f:
+                inputs = [line.rstrip("\n") for line in f if line.strip()]
+
+            return Lease(self, name, inputs)
+
+        return None
+
+    def leases(self, poll_interval=10.):
+        """Claim batches until every batch is done. When there are no pending batches but others are still
+        leased, wait for them to complete or to be requeued. Leases are renewed by a heartbeat until completed."""
+        while True:
+            lease = self.claim()
+            if lease is not None:
+                lease.heartbeat(self.lease_timeout / 4)
+                yield lease
+            elif self.list(LEASED):
+                time.sleep(poll_interval)
+            else:
+                return
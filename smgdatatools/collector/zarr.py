@@ -1,127 +1,261 @@
+import json
 import logging
 import math
+import posixpath
 
-import gcsfs
-import zarr
+import numcodecs
+import numpy as np
 
-from smgdatatools.collector.lib import Collector
-from smgdatatools.model.model import Store, Variable, Attribute, Dimension, ChunkShape, Scale, Chunk, \
-    GlobalAttribute, Compressor, CompressorProperty
+from smgdatatools.collector.lib import Collector, StoreStats, references, attributes_digest
+from smgdatatools.model.records import StoreRecord, VariableRecord, DimensionRecord, CodecRecord, ChunkTable
+
+
+def fill_value(value):
+    # zarr encodes non finite floats as strings
+    if value in ("NaN", "Infinity", "-Infinity"):
+        return float(value.replace("Infinity", "inf"))
+
+    return value
 
 
 class ZarrCollector(Collector):
-    def __init__(self, drs=None):
-        super().__init__(drs)
+    # metadata and listings are plain fsspec requests
+    io_bound = True
+
+    def __init__(self, drs=None, homogeneous=False, storage=None, variables=None, chunk_hash=None,
+                 chunk_stats=None):
+        super().__init__(drs, homogeneous, storage, variables, chunk_hash, chunk_stats)
+
+        # metadata of the last store read, its chunks and attributes are read without fetching it again
+        self.cached = (None, None)
+
+    def read_metadata(self, resource, stats=None):
+        """Metadata documents (.zattrs, .zarray, ...) of a store keyed by their path relative to the store.
+
+        Consolidated metadata (.zmetadata) is read in a single request when present, otherwise the store is listed
+        once and the metadata of its arrays is fetched concurrently. Requests are counted in ``stats``.
+        """
+        stats = stats if stats is not None else StoreStats()
+        root = resource.rstrip("/")
+        path = self.storage.path(root)
+
+        documents = self.storage.cat([root + "/.zmetadata"])
+        stats.count(1, sum(len(document) for document in documents.values()))
+        if documents:
+            metadata = json.loads(documents[path + "/.zmetadata"])["metadata"]
+            self.cached = (resource, metadata)
+            return metadata
+
+        names = sorted(posixpath.basename(entry["name"].rstrip("/"))
+                       for entry in self.storage.ls(root)
+                       if entry["type"] == "directory")
+        keys = [".zgroup", ".zattrs"] + [posixpath.join(name, key) for name in names for key in (".zarray", ".zattrs")]
+        stats.count(1)
+        documents = self.storage.cat([posixpath.join(root, key) for key in keys])
+        stats.count(len(keys), sum(len(document) for document in documents.values()))
+
+        metadata = {key: json.loads(documents[posixpath.join(path, key)])
+                    for key in keys if posixpath.join(path, key) in documents}
+        self.cached = (resource, metadata)
+
+        return metadata
+
+    def metadata(self, resource):
+        cached, metadata = self.cached
+        return metadata if cached == resource else self.read_metadata(resource)
+
+    @staticmethod
+    def arrays(metadata):
+        return sorted(posixpath.dirname(key) for key in metadata
+                      if key.endswith("/.zarray") and "/" not in posixpath.dirname(key))
 
-    def collect(self, resource):
+    def names(self, metadata):
+        """Names of the arrays of the store that are collected."""
+        def dependencies(v):
+            attrs = metadata.get(v + "/.zattrs", dict())
+            return references(attrs) + list(attrs.get("_ARRAY_DIMENSIONS", []))
+
+        return self.select_variables(ZarrCollector.arrays(metadata), dependencies)
+
+    def schema(self, metadata):
+        schema = list()
+        for v in self.names(metadata):
+            zarray = metadata[v + "/.zarray"]
+            schema.append((
+                v,
+                json.dumps(zarray["dtype"]),
+                tuple(zarray["chunks"]),
+                json.dumps(zarray["compressor"], sort_keys=True),
+                json.dumps(zarray["fill_value"]),
+                attributes_digest(metadata.get(v + "/.zattrs", dict()), self.ignored_attrs())))
+
+        return tuple(schema)
+
+    def collect_record(self, resource):
         logging.warning("Collecting from {}".format(resource))
 
-        fs = gcsfs.GCSFileSystem(token="anon")
-        mapper = fs.get_mapper(resource)
-        f = zarr.open(mapper)
-        store = Store(name=resource, size=0)
+        stats = StoreStats()
+        with stats.time("open"):
+            metadata = self.read_metadata(resource, stats)
 
-        # global attrs
-        attrs = dict(f.attrs)
-        for attr in attrs:
-            if attr in self.ignored_attrs():
-                continue
-            elif isinstance(attrs[attr], str):
-                attribute = GlobalAttribute(
-                    name=attr,
-                    value=attrs[attr],
-                    store_id=store.id)
-                store.attrs.append(attribute)
-
-        for v in f:
-            variable = Variable(
+        schema = self.schema(metadata) if self.homogeneous else None
+        prototype = self.prototype(schema)
+        if prototype is not None:
+            store = prototype.copy(resource)
+            store.attrs = self.collect_global_attrs(metadata)
+            for variable in store.variables:
+                zarray = metadata[variable.name + "/.zarray"]
+                for dimension in variable.dimensions:
+                    dimension.size = zarray["shape"][dimension.index]
+                    dimension.chunk_count = math.ceil(dimension.size / zarray["chunks"][dimension.index])
+                with stats.time("chunks"):
+                    variable.chunks = self.collect_chunks(resource, variable.name, zarray)
+                # one listing per array
+                stats.count(1)
+            store.stats = stats.finish()
+
+            return store
+
+        store = StoreRecord(name=resource, size=0)
+        store.attrs = self.collect_global_attrs(metadata)
+
+        for v in self.names(metadata):
+            zarray = metadata[v + "/.zarray"]
+            attrs = metadata.get(v + "/.zattrs", dict())
+
+            variable = VariableRecord(
                 name=v,
-                dtype=f[v].dtype.str,
-                fillvalue=f[v].fill_value,
-                store_id=store.id)
+                dtype=np.dtype(zarray["dtype"]).str if isinstance(zarray["dtype"], str) else None,
+                fillvalue=fill_value(zarray["fill_value"]))
 
             # compressor
-            if f[v].compressor:
-                comp_config = f[v].compressor.get_config()
-                comp = Compressor(
-                    name=comp_config["id"])
-                for k in comp_config:
-                    if k != "id":
-                        comp.properties.append(CompressorProperty(
-                            name=k,
-                            value=comp_config[k]))
-                variable.compressor = comp
+            if zarray["compressor"]:
+                comp_config = zarray["compressor"]
+                variable.compressor = CodecRecord(
+                    name=comp_config["id"],
+                    properties={k: comp_config[k] for k in comp_config if k != "id"})
 
             # filters
-            if f[v].filters:
+            if zarray["filters"]:
                 pass
 
             # attrs
-            attrs = dict(f[v].attrs)
             for attr in attrs:
                 if attr in self.ignored_attrs():
                     continue
                 elif isinstance(attrs[attr], str):
-                    attribute = Attribute(
-                        name=attr,
-                        value=attrs[attr],
-                        variable_id=variable.id)
-                    variable.attrs.append(attribute)
+                    variable.attrs.append((attr, attrs[attr]))
 
             # dimensions
-            for i, dim in enumerate(f[v].shape):
-                dimension = Dimension(
+            for i, dim in enumerate(zarray["shape"]):
+                dimension = DimensionRecord(
                     index=i,
-                    size=f[v].shape[i],
-                    chunk_count=math.ceil(f[v].shape[i] / f[v].chunks[i]),
-                    variable_id=variable.id)
-                chunk_shape = ChunkShape(
-                    dimension_id=dimension.id,
-                    shape=f[v].chunks[i],
-                    index=i)
-                dimension.chunk_shapes.append(chunk_shape)
+                    size=zarray["shape"][i],
+                    chunk_count=math.ceil(zarray["shape"][i] / zarray["chunks"][i]),
+                    chunk_shape=zarray["chunks"][i])
 
                 # scales
                 if "_ARRAY_DIMENSIONS" in attrs:
-                    scale = Scale(
-                        name=attrs["_ARRAY_DIMENSIONS"][i],
-                        dimension_id=dimension.id,
-                        variable_id=variable.id)
-                    dimension.scales.append(scale)
-                    variable.scales.append(scale)
+                    dimension.scales.append(attrs["_ARRAY_DIMENSIONS"][i])
 
                 variable.dimensions.append(dimension)
 
-            for i in range(f[v].nchunks):
-                chunk = Chunk(
-                    location=0,
-                    size=0,  # referenceFS reads whole object if size is zero
-                    index=i,
-                    variable_id=variable.id)
-                variable.chunks.append(chunk)
-
+            with stats.time("chunks"):
+                variable.chunks = self.collect_chunks(resource, v, zarray)
+            stats.count(1)
             store.variables.append(variable)
 
+        self.add_prototype(schema, store)
+        store.stats = stats.finish()
+
         return store
 
+    def collect_global_attrs(self, metadata):
+        global_attrs = list()
+        attrs = metadata.get(".zattrs", dict())
+        for attr in attrs:
+            if attr in self.ignored_attrs():
+                continue
+            elif isinstance(attrs[attr], str):
+                global_attrs.append((attr, attrs[attr]))
+
+        return global_attrs
+
+    def chunk_ranges(self, resource, variable):
+        """Chunks are whole objects named after their position in the chunk grid."""
+        zarray = self.metadata(resource)[variable.name + "/.zarray"]
+        separator = zarray.get("dimension_separator", ".")
+        counts = [d.chunk_count for d in variable.dimensions]
+        array = posixpath.join(resource.rstrip("/"), variable.name)
+
+        ranges = list()
+        for index in variable.chunks.index.tolist():
+            key = separator.join(str(c) for c in np.unravel_index(index, counts)) if counts else "0"
+            ranges.append((posixpath.join(array, key), None, None))
+
+        return ranges
+
+    def chunk_codecs(self, resource, variable):
+        zarray = self.metadata(resource)[variable.name + "/.zarray"]
+        codecs = [numcodecs.get_codec(zarray["compressor"])] if zarray["compressor"] else list()
+        codecs.extend(numcodecs.get_codec(config) for config in reversed(zarray["filters"] or list()))
+
+        return codecs
+
+    def collect_chunks(self, resource, v, zarray):
+        """Chunks that exist in the store with their object sizes, from a single listing of the array prefix.
+
+        Chunks that were never written (fill value only) are not part of the index.
+        """
+        array = posixpath.join(resource.rstrip("/"), v)
+        prefix = self.storage.path(array)
+        separator = zarray.get("dimension_separator", ".")
+        chunk_counts = [math.ceil(s / c) for s, c in zip(zarray["shape"], zarray["chunks"])]
+
+        if separator == "/":
+            entries = self.storage.find(array)
+        else:
+            entries = self.storage.ls(array)
+
+        locations, sizes, indexes = list(), list(), list()
+        for entry in entries:
+            if entry["type"] != "file":
+                continue
+            key = posixpath.relpath(entry["name"], prefix)
+            try:
+                coords = [int(x) for x in key.split(separator)]
+            except ValueError:
+                # .zarray, .zattrs
+                continue
+            if len(coords) != max(len(chunk_counts), 1) or \
+                    any(c >= n for c, n in zip(coords, chunk_counts)):
+                continue
+
+            # referenceFS reads whole object if location and size are zero, sizes are kept for range planning
+            locations.append(0)
+            sizes.append(entry["size"])
+            indexes.append(int(np.ravel_multi_index(coords, chunk_counts)) if chunk_counts else 0)
+
+        order = np.argsort(indexes, kind="stable")
+        return ChunkTable(
+            np.array(locations, dtype=np.int64)[order],
+            np.array(sizes, dtype=np.int64)[order],
+            np.array(indexes, dtype=np.int64)[order])
+
     def read_variable(self, store, variable):
         pass
 
     def read_attributes(self, store, obj=None):
-        fs = gcsfs.GCSFileSystem(token="anon")
-        mapper = fs.get_mapper(store)
-        f = zarr.open(mapper)
+        metadata = self.metadata(store)
         if obj:
-            attrs = dict(f[obj].attrs)
+            attrs = metadata.get(obj + "/.zattrs", dict())
         else:
-            attrs = dict(f.attrs)
+            attrs = metadata.get(".zattrs", dict())
 
         return attrs
 
     def compressor(self, store, v):
-        fs = gcsfs.GCSFileSystem(token="anon")
-        mapper = fs.get_mapper(store)
-        f = zarr.open(mapper)
-        compressor = f[v].compressor
+        config = self.metadata(store)[v + "/.zarray"]["compressor"]
+        compressor = numcodecs.get_codec(config) if config else None
 
         return compressor
@@ -1,21 +1,34 @@
 #!/usr/bin/env python
 
 import argparse
+import json
 import logging
 import os
 import sys
-from multiprocessing import Pool
 
 from sqlalchemy import select, create_engine
 from sqlalchemy.orm import Session
 from sqlalchemy.pool import QueuePool
 
+from smgdatatools.collector.grib import Grib2Collector
 from smgdatatools.collector.h5 import Hdf5ChunkCollector
+from smgdatatools.collector.lib import Storage, CHUNK_HASHES
 from smgdatatools.collector.nc import NcCollector
+from smgdatatools.collector.nc3 import Nc3Collector
+from smgdatatools.collector.nc4 import Nc4Collector
+from smgdatatools.collector.pipeline import stream, collect_record, collect_group, executor_for, make_pool, \
+    Quarantine, EXECUTORS
+from smgdatatools.collector.telemetry import Telemetry
+from smgdatatools.collector.workqueue import WorkQueue
+from smgdatatools.collector.plan import scan, prune, group, parse_select, parse_time_window
 from smgdatatools.collector.zarr import ZarrCollector
 from smgdatatools.etl.h5vds import Common, Union, NewCommon, New
 from smgdatatools.etl.jinja import JinjaEtl
-from smgdatatools.model.model import Store, GlobalAttribute, Base
+from smgdatatools.etl.lib import aggregation_coordinates
+from smgdatatools.model.model import Store, GlobalAttribute
+from smgdatatools.model.records import FailureRecord
+from smgdatatools.model.report import duplication, grid_groups, statistics
+from smgdatatools.model.writer import StoreWriter, create_tables, incremental, committed
 
 
 def parse_key_value(key_value):
@@ -59,6 +72,14 @@ if __name__ == "__main__":
                         type=str,
                         required=False,
                         help="destination file.")
+    parser.add_argument("--grid-check",
+                        required=False,
+                        default="warn",
+                        choices=("warn", "reject", "split", "ignore"),
+                        help="stores of common ETLs should share their coordinates other than the aggregation "
+                             "dimension, one dimensional coordinates are compared by the fingerprints of their "
+                             "values. Warn about incompatible stores, reject them, split them into one output per "
+                             "grid ({grid_group} in --dest) or ignore the check.")
     parser.add_argument("--db",
                         required=False,
                         type=str,
@@ -67,6 +88,15 @@ if __name__ == "__main__":
                         required=False,
                         type=str,
                         help="source db file (do not use if --db is used).")
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        default=False,
+                        help="keep the database, only collect new or changed inputs and remove vanished ones.")
+    parser.add_argument("--checksum",
+                        action="store_true",
+                        default=False,
+                        help="include a checksum of the inputs in their fingerprint (SHA-256 of local files, "
+                             "checksum reported by the object store for remote objects).")
     parser.add_argument("-t", "--template",
                         type=str,
                         required=False,
@@ -81,6 +111,28 @@ if __name__ == "__main__":
                         type=str,
                         required=False,
                         help="regex of the DRS of the input files.")
+    parser.add_argument("--drs-variable",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="facet of the DRS holding the variable, inputs of variables not in --aggregations are "
+                             "not collected.")
+    parser.add_argument("--select",
+                        type=str,
+                        nargs="*",
+                        default=list(),
+                        help="FACET=VALUE[,VALUE...] DRS facets of the inputs to collect, others are not opened.")
+    parser.add_argument("--time-window",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="START-END (e.g. 1850-1900), only collect inputs whose file name time range overlaps.")
+    parser.add_argument("--group-by",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="comma separated DRS facets, inputs of a group are collected in time order by the same "
+                             "worker.")
     parser.add_argument("--from",
                         type=str,
                         required=False,
@@ -92,7 +144,7 @@ if __name__ == "__main__":
                         required=False,
                         help="ETL to perform.")
     parser.add_argument("--collector",
-                        choices=["nc", "zarr", "hdf5chunk"],
+                        choices=["nc", "nc3", "nc4", "zarr", "hdf5chunk", "grib2"],
                         required=True,
                         type=str,
                         help="collector.")
@@ -106,6 +158,46 @@ if __name__ == "__main__":
                         type=str,
                         default=None,
                         help="aggregation variables detected by global attribute.")
+    parser.add_argument("--homogeneous",
+                        action="store_true",
+                        default=False,
+                        help="inputs share variables, attributes and encodings, collect them from a prototype store.")
+    parser.add_argument("--variables",
+                        required=False,
+                        default=None,
+                        type=lambda x: x.split(","),
+                        help="comma separated variables to collect, their coordinates, bounds, grid mappings and "
+                             "dimension scales are collected too. Other variables are never read.")
+    parser.add_argument("--hash-chunks",
+                        required=False,
+                        default=None,
+                        choices=CHUNK_HASHES,
+                        help="hash the bytes of every chunk to find chunks duplicated across stores. Chunks are read, "
+                             "xxh3 requires the xxhash package.")
+    parser.add_argument("--chunk-stats",
+                        required=False,
+                        default=None,
+                        type=lambda x: x.split(","),
+                        help="comma separated variables whose chunks are decoded to store the minimum, maximum, count "
+                             "and sum of their valid values (see the chunkstats table).")
+    parser.add_argument("--stats-report",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="write a JSON summary of the chunk statistics of the database to FILE, "
+                             "see --chunk-stats.")
+    parser.add_argument("--duplication-report",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="write a JSON report of the duplicated chunks of the database to FILE, "
+                             "see --hash-chunks.")
+
+    parser.add_argument("--storage-options",
+                        required=False,
+                        default=None,
+                        type=json.loads,
+                        help="JSON object of fsspec storage options for remote inputs, e.g. '{\"anon\": true}'.")
 
     # arguments for hdf5chunk collector
     parser.add_argument("--hdf5-driver",
@@ -113,16 +205,121 @@ if __name__ == "__main__":
                         default=None,
                         type=str,
                         help="HDF5 file driver.")
+    parser.add_argument("--hdf5-cache-type",
+                        required=False,
+                        default="blockcache",
+                        type=str,
+                        help="fsspec cache of remote HDF5 files opened without a driver (blockcache, readahead, ...).")
+    parser.add_argument("--hdf5-block-size",
+                        required=False,
+                        default=None,
+                        type=int,
+                        help="block size in bytes of the fsspec cache of remote HDF5 files.")
+    parser.add_argument("--hdf5-page-buffer-size",
+                        required=False,
+                        default=None,
+                        type=int,
+                        help="HDF5 page buffer size in bytes.")
+    parser.add_argument("--hdf5-chunk-cache-size",
+                        required=False,
+                        default=None,
+                        type=int,
+                        help="HDF5 raw data chunk cache size in bytes.")
+    parser.add_argument("--hdf5-metadata-cache-size",
+                        required=False,
+                        default=None,
+                        type=int,
+                        help="HDF5 metadata cache initial size in bytes.")
     parser.add_argument("-j", "--jobs",
                         type=int,
                         required=False,
                         default=5,
                         help="collector parallel jobs for chunked ETLs.")
+    parser.add_argument("--executor",
+                        choices=EXECUTORS,
+                        default="auto",
+                        help="run collectors in processes or threads, auto uses threads for collectors that mostly "
+                             "wait on the network.")
+    parser.add_argument("--threads",
+                        type=int,
+                        required=False,
+                        default=32,
+                        help="collector threads when the thread executor is used.")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        required=False,
+                        default=100,
+                        help="number of collected stores written to the database per transaction.")
+    parser.add_argument("--max-in-flight",
+                        type=int,
+                        required=False,
+                        default=None,
+                        help="maximum number of inputs being collected or waiting to be written (default 4 * workers).")
+    parser.add_argument("--unordered",
+                        action="store_true",
+                        default=False,
+                        help="write stores as soon as they are collected instead of in input order.")
+    parser.add_argument("--retries",
+                        type=int,
+                        required=False,
+                        default=2,
+                        help="retries of inputs that fail with transient (network) errors.")
+    parser.add_argument("--backoff",
+                        type=float,
+                        required=False,
+                        default=1.,
+                        help="seconds before the first retry, doubled on every retry.")
+    parser.add_argument("--quarantine",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="append the inputs that could not be collected and their tracebacks to FILE (JSON lines).")
+    parser.add_argument("--resume",
+                        action="store_true",
+                        default=False,
+                        help="keep the database and skip the inputs whose stores were already committed.")
+    parser.add_argument("--queue",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="directory of a work queue on a shared filesystem, collect the batches leased from it "
+                             "into --db (one shard per worker, see mergedb.py).")
+    parser.add_argument("--enqueue",
+                        action="store_true",
+                        default=False,
+                        help="split the inputs into batches of the --queue and exit.")
+    parser.add_argument("--queue-batch-size",
+                        type=int,
+                        required=False,
+                        default=100,
+                        help="inputs per batch of the --queue.")
+    parser.add_argument("--lease-timeout",
+                        type=float,
+                        required=False,
+                        default=600.,
+                        help="seconds after which the batch of a worker that stopped renewing it is requeued.")
+    parser.add_argument("--progress-interval",
+                        type=float,
+                        required=False,
+                        default=10.,
+                        help="seconds between progress reports of the collection.")
+    parser.add_argument("--telemetry",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="write a JSON summary of the collection (timings, throughput, percentiles) to FILE.")
+    parser.add_argument("--prometheus",
+                        type=str,
+                        required=False,
+                        default=None,
+                        help="write the collection summary to FILE in the Prometheus text format.")
     parser.add_argument("--chunk-size",
                         type=str,
                         required=False,
                         default=None,
-                        help="for contiguous variables, emulate a chunked variable.")
+                        help="for contiguous variables, emulate a chunked variable. Either var:c0,c1,... for the "
+                             "leading dimensions or var:dim:size for a dimension given by index or name, separated "
+                             "by ';'. The last chunk of a dimension that is not divided is shorter.")
 
     # arguments for join new
     parser.add_argument("--coord-attrs",
@@ -148,6 +345,13 @@ if __name__ == "__main__":
 
     args = vars(parser.parse_args())
 
+    # workers of a queue collect the batches as they were queued
+    if args["queue"] and args["incremental"]:
+        parser.error("--incremental can not be used with --queue, the inputs of a queue are always collected")
+    if args["queue"] and not args["enqueue"] and (args["select"] or args["time_window"]):
+        parser.error("--select and --time-window are applied when the inputs are queued with --enqueue, not by the "
+                     "workers of a --queue")
+
     logging.basicConfig(
         filename=args["log_file"],
         encoding='utf-8',
@@ -157,7 +361,7 @@ if __name__ == "__main__":
     if args["from_db"]:
         db_url = "sqlite+pysqlite:///{}".format(args["from_db"])
     elif args["db"]:
-        if os.path.isfile(args["db"]):
+        if os.path.isfile(args["db"]) and not (args["incremental"] or args["resume"] or args["queue"]):
             os.remove(args["db"])
         db_url = "sqlite+pysqlite:///{}".format(args["db"])
     else:
@@ -166,17 +370,69 @@ if __name__ == "__main__":
         db_url = "sqlite+pysqlite:///:memory:"
 
     # set up collector
+    storage = Storage(args["storage_options"])
     if args["collector"] == "hdf5chunk":
         collector = Hdf5ChunkCollector(
             drs=args["drs"],
             driver=args["hdf5_driver"],
-            chunk_size=args["chunk_size"])
+            chunk_size=args["chunk_size"],
+            homogeneous=args["homogeneous"],
+            storage=storage,
+            cache_type=args["hdf5_cache_type"],
+            block_size=args["hdf5_block_size"],
+            page_buf_size=args["hdf5_page_buffer_size"],
+            rdcc_nbytes=args["hdf5_chunk_cache_size"],
+            mdc_size=args["hdf5_metadata_cache_size"],
+            variables=args["variables"],
+            chunk_hash=args["hash_chunks"],
+            chunk_stats=args["chunk_stats"])
+    elif args["collector"] == "nc4":
+        collector = Nc4Collector(
+            drs=args["drs"],
+            driver=args["hdf5_driver"],
+            chunk_size=args["chunk_size"],
+            homogeneous=args["homogeneous"],
+            storage=storage,
+            cache_type=args["hdf5_cache_type"],
+            block_size=args["hdf5_block_size"],
+            page_buf_size=args["hdf5_page_buffer_size"],
+            rdcc_nbytes=args["hdf5_chunk_cache_size"],
+            mdc_size=args["hdf5_metadata_cache_size"],
+            variables=args["variables"],
+            chunk_hash=args["hash_chunks"],
+            chunk_stats=args["chunk_stats"])
     elif args["collector"] == "nc":
         collector = NcCollector(
-            drs=args["drs"])
+            drs=args["drs"],
+            homogeneous=args["homogeneous"],
+            storage=storage,
+            variables=args["variables"],
+            chunk_hash=args["hash_chunks"],
+            chunk_stats=args["chunk_stats"])
+    elif args["collector"] == "nc3":
+        collector = Nc3Collector(
+            drs=args["drs"],
+            homogeneous=args["homogeneous"],
+            storage=storage,
+            variables=args["variables"],
+            chunk_hash=args["hash_chunks"],
+            chunk_stats=args["chunk_stats"])
+    elif args["collector"] == "grib2":
+        collector = Grib2Collector(
+            drs=args["drs"],
+            homogeneous=args["homogeneous"],
+            storage=storage,
+            variables=args["variables"],
+            chunk_hash=args["hash_chunks"],
+            chunk_stats=args["chunk_stats"])
     elif args["collector"] == "zarr":
         collector = ZarrCollector(
-            drs=args["drs"])
+            drs=args["drs"],
+            homogeneous=args["homogeneous"],
+            storage=storage,
+            variables=args["variables"],
+            chunk_hash=args["hash_chunks"],
+            chunk_stats=args["chunk_stats"])
     else:
         raise ValueError("Invalid collector.")
 
@@ -186,20 +442,97 @@ if __name__ == "__main__":
         future=True,
         poolclass=QueuePool,
         pool_size=args["jobs"])
-    Base.metadata.create_all(engine)
+    create_tables(engine)
     session = Session(engine)
 
-    if not args["from_db"]:
-        if args["from"] == "-":
-            inputs = (line.rstrip("\n") for line in sys.stdin)
+    if not args["from_db"] or args["incremental"]:
+        if args["queue"] and not args["enqueue"]:
+            # distributed collection, batches are leased from the shared queue until all of them are done
+            queue = WorkQueue(args["queue"], args["lease_timeout"])
+            batches = ((lease, list(scan(lease.inputs, collector.drs_pattern))) for lease in queue.leases())
+            total = None
         else:
-            inputs = (line.rstrip("\n") for line in open(args["from"], "r"))
+            if args["from"] == "-":
+                inputs = (line.rstrip("\n") for line in sys.stdin)
+            else:
+                inputs = (line.rstrip("\n") for line in open(args["from"], "r"))
 
-        with Pool(args["jobs"]) as pool:
-            for store in pool.map(collector.collect, inputs):
-                session.add(store)
+            # pre-pass over the listing, inputs are selected from their path only and never opened if not needed
+            selection = parse_select(args["select"])
+            if args["drs_variable"] and args["aggregations"]:
+                selection.setdefault(args["drs_variable"], set()).update(args["aggregations"])
+            entries = scan(inputs, collector.drs_pattern)
+            if args["incremental"]:
+                # stores of inputs that are listed but pruned or already committed have not vanished
+                entries = list(entries)
+                listed = [entry.name for entry in entries]
+            entries = prune(entries, selection, parse_time_window(args["time_window"]))
 
-        session.commit()
+            if args["enqueue"]:
+                n = WorkQueue(args["queue"]).create((entry.name for entry in entries), args["queue_batch_size"])
+                logging.warning("Queued {} batches in {}".format(n, args["queue"]))
+                sys.exit(0)
+
+            entries = list(entries)
+            if args["resume"]:
+                done = committed(session)
+                logging.warning("Resuming collection, {} stores already committed".format(len(done)))
+                entries = [entry for entry in entries if entry.name not in done]
+
+            if args["incremental"]:
+                fingerprints = incremental(session, (entry.name for entry in entries), args["checksum"], storage,
+                                           listed)
+                entries = [entry for entry in entries if entry.name in fingerprints]
+            batches = [(None, entries)]
+            total = len(entries)
+        telemetry = Telemetry(total, args["progress_interval"])
+        quarantine = Quarantine(args["quarantine"])
+
+        # workers send back plain records that are written in batches while collection goes on
+        executor = executor_for(collector, args["executor"])
+        workers = args["threads"] if executor == "thread" else args["jobs"]
+        max_in_flight = args["max_in_flight"] or 4 * workers
+        logging.info("Collecting with {} {} workers".format(workers, executor))
+        # workers fingerprint every input before reading it, so that later --incremental runs can compare them
+        with make_pool(collector, executor, args["jobs"], args["threads"], args["retries"], args["backoff"],
+                       True, args["checksum"]) as pool, \
+                StoreWriter(session, args["batch_size"], args["incremental"]) as writer:
+            for lease, entries in batches:
+                if args["group_by"]:
+                    tasks = group(entries, args["group_by"].split(","))
+                    func = collect_group
+                else:
+                    tasks = (entry.name for entry in entries)
+                    func = collect_record
+
+                for result in stream(pool, func, tasks, max_in_flight, not args["unordered"]):
+                    for record in (result if args["group_by"] else [result]):
+                        if isinstance(record, FailureRecord):
+                            quarantine.add(record)
+                            telemetry.add_failure(record)
+                            continue
+                        telemetry.add(record)
+                        writer.write(record)
+
+                # a batch is done once its stores are committed to the shard
+                if lease is not None:
+                    writer.flush()
+                    lease.complete()
+
+        logging.warning(telemetry.progress())
+        if quarantine.count:
+            logging.warning("{} inputs could not be collected".format(quarantine.count))
+        if args["telemetry"]:
+            telemetry.write_json(args["telemetry"])
+        if args["prometheus"]:
+            telemetry.write_prometheus(args["prometheus"])
+
+    if args["duplication_report"]:
+        with open(args["duplication_report"], "w") as fh:
+            json.dump(duplication(session), fh, indent=2)
+    if args["stats_report"]:
+        with open(args["stats_report"], "w") as fh:
+            json.dump(statistics(session), fh, indent=2)
 
     # perform ETL
     if args["etl"]:
@@ -212,7 +545,7 @@ if __name__ == "__main__":
                 args["template"],
                 parse_key_value(args["opts"]))
         elif args["etl"].lower() == "common":
-            etl = Common()
+            etl = Common(grid_check=args["grid_check"])
         elif args["etl"].lower() == "union":
             etl = Union()
         elif args["etl"].lower() == "new-common":
@@ -226,7 +559,8 @@ if __name__ == "__main__":
             etl = NewCommon(
                 args["coord_name"],
                 parse_key_value(args["coord_attrs"]),
-                coord_values)
+                coord_values,
+                grid_check=args["grid_check"])
         elif args["etl"].lower() == "new":
             if args["coord_values"]:
                 coord_values = args["coord_values"].split(",")
@@ -246,7 +580,6 @@ if __name__ == "__main__":
         global_attrs = session.execute(
             select(GlobalAttribute.name, GlobalAttribute.value)
         ).all()
-        dest = args["dest"].format(**dict(global_attrs))
 
         # aggregations
         if args["aggregations_attr"]:
@@ -256,9 +589,22 @@ if __name__ == "__main__":
         else:
             aggregations = args["aggregations"]
 
+        # one output per grid, {grid_group} in --dest is the index of the group of stores sharing a grid
+        if args["grid_check"] == "split":
+            by_id = {store.id: store for store in stores}
+            excluded = aggregation_coordinates(stores, aggregations)
+            groups = [[by_id[i] for i in ids] for ids in grid_groups(session, list(by_id), excluded)]
+            if len(groups) > 1 and "{grid_group}" not in args["dest"]:
+                raise ValueError("Stores have {} different grids, --dest must include {{grid_group}}".format(
+                    len(groups)))
+        else:
+            groups = [stores]
+
         # etl
-        os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
-        etl.run(dest, collector, stores, aggregations)
+        for i, grid_stores in enumerate(groups):
+            dest = args["dest"].format(**{**dict(global_attrs), "grid_group": i})
+            os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+            etl.run(dest, collector, grid_stores, aggregations)
+            print(dest)
         session.close()
         engine.dispose()
-        print(dest)
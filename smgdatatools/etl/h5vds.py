@@ -1,10 +1,12 @@
 import logging
 
 import h5py
+from sqlalchemy.orm import object_session
 
 from smgdatatools.collector.lib import Collector
-from smgdatatools.etl.lib import Etl, convert_times
+from smgdatatools.etl.lib import Etl, convert_times, aggregation_coordinates
 from smgdatatools.model.model import Store, Variable, Dimension
+from smgdatatools.model.report import grid_conflicts
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +37,24 @@ def create_dimension(o, name, size, dtype=None):
     create_char_attr(o[name], "NAME", NOT_A_VAR + name)
 
 
+def check_grids(stores: list, aggregations: list[str], reject=True):
+    """Raise ValueError, or only log a warning if not ``reject``, if the coordinates of the stores, other than the
+    aggregation dimension, have different values. Coordinates are compared by the fingerprints of their values
+    collected in the database."""
+    session = object_session(stores[0])
+    if session is None:
+        return
+
+    excluded = aggregation_coordinates(stores, aggregations)
+    conflicts = grid_conflicts(session, [store.id for store in stores], excluded)
+    if conflicts:
+        message = "Stores do not share the same grid, coordinates with different values: {}".format(
+            ", ".join("{} ({} distinct)".format(name, n) for name, n in conflicts.items()))
+        if reject:
+            raise ValueError(message)
+        logger.warning(message)
+
+
 def create_virtual_variable(f: h5py.File, v: Variable):
     shape = tuple([d.size for d in sorted(v.dimensions, key=lambda x: x.index)])
     layout = h5py.VirtualLayout(
@@ -201,7 +221,13 @@ class New(Etl):
 
 
 class Common(Etl):
+    def __init__(self, grid_check="ignore"):
+        self.grid_check = grid_check
+
     def run(self, dest: str, collector: Collector, stores: list, aggregations: list[str]):
+        if self.grid_check in ("warn", "reject"):
+            check_grids(stores, aggregations, self.grid_check == "reject")
+
         f: h5py.File = h5py.File(dest, "w")
 
         aggregation_stores = [store
@@ -257,7 +283,7 @@ class Common(Etl):
                     dim = [d for d in v.dimensions if d.index == 0][0]
                     frm, to = i, i + dim.size
                     attrs = {attr.name: attr.value for attr in v.attrs}
-                    values = collector.read_variable(store.name, proto_agg_var.name)
+                    values = collector.read_values(v)
 
                     if "calendar" in attrs and "units" in attrs:
                         if ((attrs["calendar"] != proto_agg_var_attrs["calendar"]) or
@@ -273,7 +299,7 @@ class Common(Etl):
 
                     if "bounds" in proto_agg_var_attrs and "bounds" in attrs:
                         bounds = [v for v in store.variables if v.name == attrs["bounds"]][0]
-                        values = collector.read_variable(store.name, bounds.name)
+                        values = collector.read_values(bounds)
                         if "calendar" in attrs and "units" in attrs:
                             if ((attrs["calendar"] != proto_agg_var_attrs["calendar"]) or
                                     (attrs["units"] != proto_agg_var_attrs["units"])):
@@ -351,12 +377,16 @@ class Common(Etl):
 
 
 class NewCommon(Etl):
-    def __init__(self, name, attrs, values):
+    def __init__(self, name, attrs, values, grid_check="ignore"):
         self.name = name
         self.attrs = attrs
         self.values = values
+        self.grid_check = grid_check
 
     def run(self, dest: str, collector: Collector, stores: list, aggregations: list[str]):
+        if self.grid_check in ("warn", "reject"):
+            check_grids(stores, aggregations, self.grid_check == "reject")
+
         f: h5py.File = h5py.File(dest, "w")
 
         # need to include only one ensemble from one "aggregation variable"
@@ -415,7 +445,7 @@ class NewCommon(Etl):
                     dim = [d for d in v.dimensions if d.index == 0][0]
                     frm, to = i, i + dim.size
                     attrs = {attr.name: attr.value for attr in v.attrs}
-                    values = collector.read_variable(store.name, proto_agg_var.name)
+                    values = collector.read_values(v)
 
                     if "calendar" in attrs and "units" in attrs:
                         if ((attrs["calendar"] != proto_agg_var_attrs["calendar"]) or
@@ -431,7 +461,7 @@ class NewCommon(Etl):
 
                     if "bounds" in proto_agg_var_attrs and "bounds" in attrs:
                         bounds = [v for v in store.variables if v.name == attrs["bounds"]][0]
-                        values = collector.read_variable(store.name, bounds.name)
+                        values = collector.read_values(bounds)
                         if "calendar" in attrs and "units" in attrs:
                             if ((attrs["calendar"] != proto_agg_var_attrs["calendar"]) or
                                     (attrs["units"] != proto_agg_var_attrs["units"])):
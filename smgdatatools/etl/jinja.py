@@ -6,8 +6,10 @@ import re
 import pkg_resources
 from jinja2 import ChoiceLoader, FileSystemLoader, Environment, select_autoescape
 from smgdatatools.model.model import Variable
+from smgdatatools.model.report import chunk_sources
 
-from smgdatatools.etl.lib import Etl, convert_times, join_existing, calculate_chunk_idx, to_numpy
+from smgdatatools.etl.lib import Etl, convert_times, join_existing, calculate_chunk_idx, to_numpy, numcodecs_filters, \
+    has_numcodecs_filters
 
 # Filters and tests
 def is_dimension(variable: Variable):
@@ -67,9 +69,12 @@ class JinjaEtl(Etl):
         env.filters["calculate_chunk_idx"] = calculate_chunk_idx
         env.filters["convert_times"] = convert_times
         env.filters["to_numpy"] = to_numpy
+        env.filters["numcodecs_filters"] = numcodecs_filters
+        env.filters["chunk_sources"] = chunk_sources
         env.filters['b64decode'] = base64.b64decode
         env.filters['b64encode'] = base64.b64encode
 
         env.tests["is_dimension"] = is_dimension
+        env.tests["numcodecs_decodable"] = has_numcodecs_filters
 
         return env
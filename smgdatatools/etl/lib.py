@@ -1,3 +1,4 @@
+import logging
 import math
 
 import cftime
@@ -11,6 +12,77 @@ class Etl:
         raise NotImplementedError
 
 
+# compressor codes of the blosc HDF5 filter
+BLOSC_COMPRESSORS = ("blosclz", "lz4", "lz4hc", "snappy", "zlib", "zstd")
+
+# HDF5 filter ids of variables collected before the pipeline was recorded
+LEGACY_FILTER_IDS = {"gzip": 1, "shuffle": 2, "fletcher32": 3}
+
+
+def numcodecs_config(name, properties):
+    """numcodecs configuration that decodes the output of an HDF5 filter, from the name and properties of a
+    collected compressor or filter. Raises ValueError for filters whose output numcodecs can not decode."""
+    code = int(properties["id"]) if "id" in properties else LEGACY_FILTER_IDS.get(name)
+    cd_values = [int(x) for x in str(properties.get("cd_values", "")).split(",") if x != ""]
+
+    if code == 1:
+        return {"id": "zlib", "level": int(properties.get("level", cd_values[0] if cd_values else 4))}
+    elif code == 2:
+        return {"id": "shuffle", "elementsize": int(properties.get("elementsize", cd_values[0] if cd_values else 1))}
+    elif code == 3:
+        return {"id": "fletcher32"}
+    elif code == 307:
+        return {"id": "bz2", "level": cd_values[0] if cd_values else 9}
+    elif code == 32001:
+        # filter revision, blosc version, type size, chunk size, level, shuffle, compressor
+        cd_values = cd_values + [5, 1, 0][max(len(cd_values) - 4, 0):]
+        return {"id": "blosc",
+                "cname": BLOSC_COMPRESSORS[cd_values[6]],
+                "clevel": cd_values[4],
+                "shuffle": cd_values[5],
+                "blocksize": 0}
+    elif code == 32015:
+        return {"id": "zstd", "level": cd_values[0] if cd_values else 0}
+
+    raise ValueError("No numcodecs codec for HDF5 filter {} ({})".format(name, code))
+
+
+def numcodecs_filters(variable):
+    """numcodecs configurations of the HDF5 filter pipeline of a variable or variable record, in pipeline order.
+
+    They are meant for the ``filters`` of a zarr array without compressor: zarr decodes filters in reverse order,
+    as HDF5 does, so chunks are referenced and decoded where they are.
+    """
+    codecs = list()
+    if variable.compressor:
+        codecs.append(variable.compressor)
+    codecs.extend(variable.filters)
+
+    configs = list()
+    for codec in codecs:
+        # collection records keep properties in a dict, the database in rows
+        properties = codec.properties if isinstance(codec.properties, dict) else \
+            {p.name: p.value for p in codec.properties}
+        configs.append((int(properties.get("order", -1)), numcodecs_config(codec.name, properties)))
+
+    # without recorded order, filters (shuffle) come before the compressor and checksums come last
+    legacy = {"shuffle": 0, "zlib": 1, "fletcher32": 2}
+    configs.sort(key=lambda x: (x[0], legacy.get(x[1]["id"], 1)))
+
+    return [config for _, config in configs]
+
+
+def has_numcodecs_filters(variable):
+    """Whether numcodecs decodes the filter pipeline of a variable, so its chunks can be referenced in place.
+    Variables with other filters (szip, nbit, scaleoffset, lzf...) are logged and left out of references."""
+    try:
+        numcodecs_filters(variable)
+    except (ValueError, KeyError) as e:
+        logging.warning("Skipping references of variable {}: {}".format(variable.name, e))
+        return False
+    return True
+
+
 def to_numpy(arr):
     return np.array(arr)
 
@@ -24,13 +96,44 @@ def join_existing(variables):
     vs = sorted(variables, key=lambda x: x.store.name, reverse=False)
     i = 0
     for v in vs:
+        # chunk indexes are positions in the chunk grid, sparse variables may not have all of them
         for chunk in v.chunks:
-            chunk.index = i
-            i += 1
+            chunk.shift(i)
+        i += count_chunks(v)
 
     return vs
 
 
+def aggregation_coordinates(stores, aggregations):
+    """Names of the coordinate of the aggregation dimension, the first dimension of the aggregation variables, and
+    of its bounds. Their values are expected to differ among the stores of an aggregation."""
+    for store in stores:
+        variables = {v.name: v for v in store.variables}
+        for aggregation in aggregations:
+            if aggregation not in variables:
+                continue
+            names = list()
+            for d in variables[aggregation].dimensions:
+                if d.index != 0:
+                    continue
+                for scale in d.scales:
+                    names.append(scale.name)
+                    if scale.name in variables:
+                        names.extend(attr.value for attr in variables[scale.name].attrs if attr.name == "bounds")
+
+            return names
+
+    return list()
+
+
+def count_chunks(variable):
+    chunk_counts = [d.chunk_count for d in variable.dimensions]
+    if not chunk_counts or None in chunk_counts:
+        return len(variable.chunks)
+
+    return math.prod(chunk_counts)
+
+
 def calculate_chunk_idx(variable, index):
     # order dimensions by it's index in the dataspace
     dimensions = sorted(variable.dimensions, key=lambda x: x.index, reverse=False)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from smgdatatools.model.merge import merge
+from smgdatatools.model.writer import create_tables
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the shard databases of a distributed collection.")
+    parser.add_argument("shards",
+                        nargs="+",
+                        type=str,
+                        help="shard db files.")
+    parser.add_argument("--db",
+                        required=True,
+                        type=str,
+                        help="destination db file, stores already in it are kept.")
+    parser.add_argument("--batch-size",
+                        type=int,
+                        required=False,
+                        default=10000,
+                        help="rows inserted per statement.")
+    parser.add_argument("--log-level",
+                        required=False,
+                        default="warn",
+                        help="log level.")
+
+    args = vars(parser.parse_args())
+
+    logging.basicConfig(level=getattr(logging, args["log_level"].upper()))
+
+    engine = create_engine("sqlite+pysqlite:///{}".format(args["db"]), future=True)
+    create_tables(engine)
+    session = Session(engine)
+    merge(session, args["shards"], args["batch_size"])
+    session.close()
+    engine.dispose()
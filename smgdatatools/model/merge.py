@@ -0,0 +1,74 @@
+import logging
+
+from sqlalchemy import create_engine, func, insert, select, text
+
+from smgdatatools.model.model import Store, Variable
+from smgdatatools.model.writer import TABLES, SQLITE_INGEST_PRAGMAS, create_tables
+
+
+def references(table):
+    """Foreign key columns of a table and the tables they reference."""
+    return [(fk.parent.name, fk.column.table.name) for fk in table.foreign_keys]
+
+
+def merge(session, shards, batch_size=10000):
+    """Merge shard databases into the database of the session.
+
+    Primary keys of every shard are shifted past the keys already in the database and foreign keys are shifted
+    by the same offsets. Stores are de-duplicated by name: the first store merged is kept, the duplicates and
+    everything collected from them are skipped.
+    """
+    if session.get_bind().dialect.name == "sqlite":
+        for pragma in SQLITE_INGEST_PRAGMAS:
+            session.execute(text(pragma))
+
+    names = set(session.execute(select(Store.name)).scalars())
+    for shard in shards:
+        engine = create_engine("sqlite+pysqlite:///{}".format(shard), future=True)
+        create_tables(engine)
+        with engine.connect() as source:
+            offsets = {table.name: session.execute(select(func.max(table.c.id))).scalar() or 0 for table in TABLES}
+
+            skipped = {table.name: set() for table in TABLES}
+            for store_id, name in source.execute(select(Store.id, Store.name)):
+                if name in names:
+                    skipped["store"].add(store_id)
+                else:
+                    names.add(name)
+
+            # compressors are referenced by variables, skip those only used by the variables of skipped stores
+            kept = set()
+            for store_id, compressor_id in source.execute(select(Variable.store_id, Variable.compressor_id)):
+                if compressor_id is None:
+                    continue
+                elif store_id in skipped["store"]:
+                    skipped["compressor"].add(compressor_id)
+                else:
+                    kept.add(compressor_id)
+            skipped["compressor"] -= kept
+
+            for table in TABLES:
+                refs = references(table)
+                rows = list()
+                for row in source.execute(select(table)).mappings():
+                    if row["id"] in skipped[table.name] or \
+                            any(row[column] in skipped[parent] for column, parent in refs):
+                        skipped[table.name].add(row["id"])
+                        continue
+
+                    row = dict(row)
+                    row["id"] += offsets[table.name]
+                    for column, parent in refs:
+                        if row[column] is not None:
+                            row[column] += offsets[parent]
+                    rows.append(row)
+
+                    if len(rows) >= batch_size:
+                        session.execute(insert(table), rows)
+                        rows = list()
+                if rows:
+                    session.execute(insert(table), rows)
+            session.commit()
+
+        engine.dispose()
+        logging.warning("Merged {}, {} duplicate stores skipped".format(shard, len(skipped["store"])))
@@ -10,8 +10,10 @@ class Store(Base):
     __tablename__ = "store"
 
     id = Column("id", Integer, primary_key=True)
-    name = Column("name", String(500))
+    name = Column("name", String(500), index=True)
     size = Column("size", Float)
+    mtime = Column("mtime", Float)
+    checksum = Column("checksum", String(64))
 
     variables = relationship("Variable", back_populates="store")
     attrs = relationship("GlobalAttribute")
@@ -27,6 +29,8 @@ class Variable(Base):
     name = Column("name", String(500))
     dtype = Column("dtype", String(5))
     fillvalue = Column("fillvalue", Float)
+    # digest of the values of coordinates, compared to check that stores share a grid
+    fingerprint = Column("fingerprint", String(32), index=True)
 
     store_id = Column(Integer, ForeignKey("store.id"))
     store = relationship("Store", back_populates="variables")
@@ -35,11 +39,31 @@ class Variable(Base):
     compressor = relationship("Compressor", backref=backref("compressor", uselist=False))
 
     dimensions = relationship("Dimension")
-    chunks = relationship("Chunk")
+    chunk_rows = relationship("Chunk", back_populates="variable")
+    chunk_grids = relationship("ChunkGrid", back_populates="variable")
     scales = relationship("Scale")
     attrs = relationship("Attribute")
     filters = relationship("Filter")
 
+    @property
+    def chunks(self):
+        """Chunks of the variable, explicit chunks and the chunks of its regular grids.
+
+        Grids are expanded on first access into chunks that are not added to the session. The list is kept, so
+        changes to the chunks (e.g. the indexes of join_existing) persist while the instance lives.
+        """
+        if "_chunks" not in self.__dict__:
+            if self.chunk_grids:
+                chunks = list(self.chunk_rows)
+                for grid in self.chunk_grids:
+                    chunks.extend(grid.expand())
+                chunks.sort(key=lambda c: c.index)
+            else:
+                chunks = self.chunk_rows
+            self.__dict__["_chunks"] = chunks
+
+        return self.__dict__["_chunks"]
+
     def calculate_chunk_idx(self, cidx):
         return calculate_chunk_idx(self, cidx)
 
@@ -193,18 +217,54 @@ class Chunk(Base):
     location = Column("location", Integer)
     size = Column("size", Integer)
     index = Column("index", Integer)
+    # hex digest of the chunk bytes, only when chunks are hashed
+    hash = Column("hash", String(32), index=True)
 
     variable_id = Column(Integer, ForeignKey("variable.id"))
-    variable = relationship("Variable", back_populates="chunks")
+    variable = relationship("Variable", back_populates="chunk_rows")
+    stats = relationship("ChunkStats", back_populates="chunk", uselist=False)
+
+    # position in the chunk grid of the variable, kept once the chunk is shifted, not stored
+    grid_index = None
+
+    def shift(self, offset):
+        """Place the chunk ``offset`` positions past its position in the chunk grid of its variable, e.g. after the
+        chunks of the previous stores of an aggregation. Shifting again replaces the previous offset."""
+        if self.grid_index is None:
+            self.grid_index = self.index
+        self.index = self.grid_index + offset
 
     def __repr__(self):
         return f"Chunk(id={self.id!r}, " \
                f"index={self.index!r}, " \
                f"size={self.size!r}, " \
                f"location={self.location!r}, " \
+               f"hash={self.hash!r}, " \
                f"variable_id={self.variable_id!r})"
 
 
+class ChunkStats(Base):
+    """Statistics of the valid values of a decoded chunk, values equal to the fill value and NaN are not valid.
+    Minimum and maximum are null when the chunk has no valid value."""
+    __tablename__ = "chunkstats"
+
+    id = Column("id", Integer, primary_key=True)
+    min = Column("min", Float)
+    max = Column("max", Float)
+    count = Column("count", Integer)
+    sum = Column("sum", Float)
+
+    chunk_id = Column(Integer, ForeignKey("chunk.id"), index=True)
+    chunk = relationship("Chunk", back_populates="stats")
+
+    def __repr__(self):
+        return f"ChunkStats(id={self.id!r}, " \
+               f"min={self.min!r}, " \
+               f"max={self.max!r}, " \
+               f"count={self.count!r}, " \
+               f"chunk_id={self.chunk_id!r})"
+
+
 class ChunkShape(Base):
     __tablename__ = "chunkshape"
 
@@ -220,3 +280,33 @@ class ChunkShape(Base):
                f"shape={self.shape!r}, " \
                f"index={self.index!r}, " \
                f"dimension_id={self.dimension_id!r})"
+
+
+class ChunkGrid(Base):
+    """Regular run of chunks: ``count`` chunks of ``size`` bytes with consecutive indexes from ``index``, the
+    location of each chunk is ``stride`` bytes past the previous one."""
+    __tablename__ = "chunkgrid"
+
+    id = Column("id", Integer, primary_key=True)
+    location = Column("location", Integer)
+    stride = Column("stride", Integer)
+    size = Column("size", Integer)
+    count = Column("count", Integer)
+    index = Column("index", Integer)
+
+    variable_id = Column(Integer, ForeignKey("variable.id"))
+    variable = relationship("Variable", back_populates="chunk_grids")
+
+    def expand(self):
+        return [Chunk(location=self.location + i * self.stride,
+                      size=self.size,
+                      index=self.index + i,
+                      variable_id=self.variable_id) for i in range(self.count)]
+
+    def __repr__(self):
+        return f"ChunkGrid(id={self.id!r}, " \
+               f"index={self.index!r}, " \
+               f"count={self.count!r}, " \
+               f"location={self.location!r}, " \
+               f"stride={self.stride!r}, " \
+               f"variable_id={self.variable_id!r})"
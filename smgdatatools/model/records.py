@@ -0,0 +1,293 @@
+import math
+
+import numpy as np
+
+from smgdatatools.model.model import Store, Variable, Dimension, Filter, GlobalAttribute, Attribute, Scale, Chunk, \
+    ChunkGrid, ChunkShape, ChunkStats, FilterProperty, Compressor, CompressorProperty
+
+
+# Plain records produced by the collectors. They are cheap to build and to pickle across the process pool,
+# chunk tables travel as NumPy buffers instead of one ORM instance per chunk. The parent process maps them
+# into the database. Attributes are kept as (name, value) pairs in collection order.
+
+class ChunkTable:
+    __slots__ = ("location", "size", "index", "hash", "stats")
+
+    def __init__(self, location=None, size=None, index=None, hash=None, stats=None):
+        self.location = np.asarray(location if location is not None else [], dtype=np.int64)
+        self.size = np.asarray(size if size is not None else [], dtype=np.int64)
+        self.index = np.asarray(index if index is not None else [], dtype=np.int64)
+        # hex digest of the bytes of every chunk, None when the chunks were not hashed
+        self.hash = np.asarray(hash, dtype=object) if hash is not None else None
+        # (min, max, count, sum) of the valid values of every chunk, None when the chunks were not decoded
+        self.stats = np.asarray(stats, dtype=np.float64).reshape(-1, 4) if stats is not None else None
+
+    def __len__(self):
+        return len(self.location)
+
+    def __iter__(self):
+        return zip(self.location.tolist(), self.size.tolist(), self.index.tolist())
+
+    def hashes(self):
+        if self.hash is None:
+            return [None] * len(self)
+
+        return self.hash.tolist()
+
+    def statistics(self):
+        """(min, max, count, sum) of every chunk, None for all of them when the chunks were not decoded. Minimum
+        and maximum are None for chunks without valid values."""
+        if self.stats is None:
+            return [None] * len(self)
+
+        return [(None if math.isnan(lo) else lo, None if math.isnan(hi) else hi, int(count), total)
+                for lo, hi, count, total in self.stats.tolist()]
+
+    def grids(self, min_count=2):
+        """Split the table into regular grids and the remaining chunks.
+
+        A grid is a run of at least ``min_count`` chunks with consecutive indexes, the same size and locations
+        in an arithmetic progression, e.g. every chunk of an uncompressed dataset. Grids are returned as
+        (location, stride, size, count, index) tuples. Hashed chunks and chunks with statistics are not
+        compacted, grids have neither.
+        """
+        n = len(self)
+        if n < min_count or self.hash is not None or self.stats is not None:
+            return [], self
+
+        stride = np.diff(self.location)
+        link = (np.diff(self.index) == 1) & (self.size[1:] == self.size[:-1])
+        # a run ends where the next chunk does not follow it or the stride changes
+        breaks = ~link
+        breaks[1:] |= link[:-1] & (stride[1:] != stride[:-1])
+        starts = np.concatenate(([0], np.flatnonzero(breaks) + 1))
+        counts = np.diff(np.concatenate((starts, [n])))
+
+        grids = list()
+        rest = np.ones(n, dtype=bool)
+        for start, count in zip(starts[counts >= min_count].tolist(), counts[counts >= min_count].tolist()):
+            grids.append((
+                int(self.location[start]),
+                int(stride[start]),
+                int(self.size[start]),
+                count,
+                int(self.index[start])))
+            rest[start:start + count] = False
+
+        return grids, ChunkTable(self.location[rest], self.size[rest], self.index[rest])
+
+    def __getstate__(self):
+        return self.location, self.size, self.index, self.hash, self.stats
+
+    def __setstate__(self, state):
+        self.location, self.size, self.index, self.hash, self.stats = state
+
+    def __repr__(self):
+        return f"ChunkTable(len={len(self)!r})"
+
+
+class CodecRecord:
+    __slots__ = ("name", "properties")
+
+    def __init__(self, name, properties=None):
+        self.name = name
+        self.properties = properties if properties is not None else dict()
+
+    def __getstate__(self):
+        return self.name, self.properties
+
+    def __setstate__(self, state):
+        self.name, self.properties = state
+
+    def __repr__(self):
+        return f"CodecRecord(name={self.name!r})"
+
+
+class DimensionRecord:
+    __slots__ = ("index", "size", "chunk_count", "chunk_shape", "scales")
+
+    def __init__(self, index, size, chunk_count=None, chunk_shape=None, scales=None):
+        self.index = index
+        self.size = size
+        self.chunk_count = chunk_count
+        self.chunk_shape = chunk_shape
+        self.scales = scales if scales is not None else list()
+
+    def copy(self):
+        return DimensionRecord(self.index, self.size, self.chunk_count, self.chunk_shape, list(self.scales))
+
+    def __getstate__(self):
+        return self.index, self.size, self.chunk_count, self.chunk_shape, self.scales
+
+    def __setstate__(self, state):
+        self.index, self.size, self.chunk_count, self.chunk_shape, self.scales = state
+
+    def __repr__(self):
+        return f"DimensionRecord(index={self.index!r}, size={self.size!r}, chunk_count={self.chunk_count!r})"
+
+
+class VariableRecord:
+    __slots__ = ("name", "dtype", "fillvalue", "attrs", "compressor", "filters", "dimensions", "chunks",
+                 "fingerprint")
+
+    def __init__(self, name, dtype=None, fillvalue=None, attrs=None, compressor=None, filters=None,
+                 dimensions=None, chunks=None, fingerprint=None):
+        self.name = name
+        self.dtype = dtype
+        self.fillvalue = fillvalue
+        self.attrs = attrs if attrs is not None else list()
+        self.compressor = compressor
+        self.filters = filters if filters is not None else list()
+        self.dimensions = dimensions if dimensions is not None else list()
+        self.chunks = chunks if chunks is not None else ChunkTable()
+        # digest of the values of coordinates, see coordinate_fingerprint
+        self.fingerprint = fingerprint
+
+    def copy(self):
+        """Copy the variable without its chunks nor fingerprint, attributes and codecs are shared with the
+        original."""
+        return VariableRecord(
+            self.name,
+            self.dtype,
+            self.fillvalue,
+            self.attrs,
+            self.compressor,
+            self.filters,
+            [d.copy() for d in self.dimensions])
+
+    def __getstate__(self):
+        return (self.name, self.dtype, self.fillvalue, self.attrs, self.compressor, self.filters, self.dimensions,
+                self.chunks, self.fingerprint)
+
+    def __setstate__(self, state):
+        (self.name, self.dtype, self.fillvalue, self.attrs, self.compressor, self.filters, self.dimensions,
+         self.chunks, self.fingerprint) = state
+
+    def __repr__(self):
+        return f"VariableRecord(name={self.name!r}, dtype={self.dtype!r})"
+
+
+class StoreRecord:
+    __slots__ = ("name", "size", "mtime", "checksum", "attrs", "variables", "stats")
+
+    def __init__(self, name, size=None, attrs=None, variables=None, mtime=None, checksum=None, stats=None):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.checksum = checksum
+        self.attrs = attrs if attrs is not None else list()
+        self.variables = variables if variables is not None else list()
+        # collection telemetry, not written to the database
+        self.stats = stats
+
+    def copy(self, name):
+        """Copy the variables of the store, but not its global attributes nor its chunks."""
+        return StoreRecord(name, self.size, variables=[v.copy() for v in self.variables])
+
+    def to_store(self):
+        store = Store(name=self.name, size=self.size, mtime=self.mtime, checksum=self.checksum)
+
+        for name, value in self.attrs:
+            store.attrs.append(GlobalAttribute(
+                name=name,
+                value=value))
+
+        for v in self.variables:
+            variable = Variable(
+                name=v.name,
+                dtype=v.dtype,
+                fillvalue=v.fillvalue,
+                fingerprint=v.fingerprint)
+
+            for name, value in v.attrs:
+                variable.attrs.append(Attribute(
+                    name=name,
+                    value=value))
+
+            if v.compressor:
+                comp = Compressor(
+                    name=v.compressor.name)
+                for name, value in v.compressor.properties.items():
+                    comp.properties.append(CompressorProperty(
+                        name=name,
+                        value=value))
+                variable.compressor = comp
+
+            for f in v.filters:
+                filt = Filter(
+                    name=f.name)
+                for name, value in f.properties.items():
+                    filt.properties.append(FilterProperty(
+                        name=name,
+                        value=value))
+                variable.filters.append(filt)
+
+            for d in v.dimensions:
+                dimension = Dimension(
+                    index=d.index,
+                    size=d.size,
+                    chunk_count=d.chunk_count)
+                if d.chunk_shape is not None:
+                    dimension.chunk_shapes.append(ChunkShape(
+                        shape=d.chunk_shape,
+                        index=d.index))
+                for name in d.scales:
+                    scale = Scale(
+                        name=name)
+                    dimension.scales.append(scale)
+                    variable.scales.append(scale)
+                variable.dimensions.append(dimension)
+
+            grids, chunks = v.chunks.grids()
+            for location, stride, size, count, index in grids:
+                variable.chunk_grids.append(ChunkGrid(
+                    location=location,
+                    stride=stride,
+                    size=size,
+                    count=count,
+                    index=index))
+            for (location, size, index), digest, stats in zip(chunks, chunks.hashes(), chunks.statistics()):
+                chunk = Chunk(
+                    location=location,
+                    size=size,
+                    index=index,
+                    hash=digest)
+                if stats is not None:
+                    chunk.stats = ChunkStats(min=stats[0], max=stats[1], count=stats[2], sum=stats[3])
+                variable.chunk_rows.append(chunk)
+
+            store.variables.append(variable)
+
+        return store
+
+    def __getstate__(self):
+        return self.name, self.size, self.mtime, self.checksum, self.attrs, self.variables, self.stats
+
+    def __setstate__(self, state):
+        self.name, self.size, self.mtime, self.checksum, self.attrs, self.variables, self.stats = state
+
+    def __repr__(self):
+        return f"StoreRecord(name={self.name!r}, size={self.size!r})"
+
+
+class FailureRecord:
+    """Sent back by the workers instead of a StoreRecord when a store could not be collected."""
+    __slots__ = ("name", "error", "traceback", "attempts")
+
+    def __init__(self, name, error, traceback, attempts=1):
+        self.name = name
+        self.error = error
+        self.traceback = traceback
+        self.attempts = attempts
+
+    def to_dict(self):
+        return {"name": self.name, "error": self.error, "traceback": self.traceback, "attempts": self.attempts}
+
+    def __getstate__(self):
+        return self.name, self.error, self.traceback, self.attempts
+
+    def __setstate__(self, state):
+        self.name, self.error, self.traceback, self.attempts = state
+
+    def __repr__(self):
+        return f"FailureRecord(name={self.name!r}, error={self.error!r})"
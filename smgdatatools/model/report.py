@@ -0,0 +1,146 @@
+from sqlalchemy import and_, case, func, select
+from sqlalchemy.orm import aliased, object_session
+
+from smgdatatools.model.model import Store, Variable, Chunk, ChunkStats
+
+
+def duplication(session, top=10):
+    """Duplication of the hashed chunks of the database.
+
+    Chunks with the same hash hold the same bytes, every copy after the first one is duplicated. Sizes are in
+    bytes, variables are listed by name with the chunks and bytes they duplicate.
+    """
+    hashed = select(Chunk.hash, func.count().label("n"), func.max(Chunk.size).label("size")) \
+        .where(Chunk.hash.is_not(None)) \
+        .group_by(Chunk.hash) \
+        .subquery()
+
+    chunks, size = session.execute(
+        select(func.count(), func.coalesce(func.sum(Chunk.size), 0)).where(Chunk.hash.is_not(None))).one()
+    unique, duplicated_chunks, duplicated_bytes = session.execute(select(
+        func.count(),
+        func.coalesce(func.sum(hashed.c.n - 1), 0),
+        func.coalesce(func.sum((hashed.c.n - 1) * hashed.c.size), 0))).one()
+
+    # chunks of a variable duplicated by any other chunk of the database
+    duplicates = select(hashed.c.hash).where(hashed.c.n > 1)
+    variables = session.execute(
+        select(Variable.name, func.count(), func.sum(Chunk.size))
+        .join(Chunk, Chunk.variable_id == Variable.id)
+        .where(Chunk.hash.in_(duplicates))
+        .group_by(Variable.name)
+        .order_by(func.sum(Chunk.size).desc()))
+
+    hashes = session.execute(
+        select(hashed.c.hash, hashed.c.n, hashed.c.size)
+        .where(hashed.c.n > 1)
+        .order_by(((hashed.c.n - 1) * hashed.c.size).desc(), hashed.c.hash)
+        .limit(top))
+
+    return {
+        "chunks": chunks,
+        "bytes": size,
+        "unique_chunks": unique,
+        "duplicated_chunks": duplicated_chunks,
+        "duplicated_bytes": duplicated_bytes,
+        "variables": [{"name": name, "chunks": n, "bytes": nbytes} for name, n, nbytes in variables],
+        "hashes": [{"hash": digest, "copies": n, "size": nbytes} for digest, n, nbytes in hashes],
+    }
+
+
+def statistics(session):
+    """Summary of the chunk statistics of the database by variable name, answered from the chunkstats table without
+    reading the data. Stores with no valid value of a variable (e.g. all NaN) are listed as ``empty``."""
+    totals = session.execute(
+        select(Variable.name, func.count(), func.sum(case((ChunkStats.count == 0, 1), else_=0)),
+               func.min(ChunkStats.min), func.max(ChunkStats.max), func.sum(ChunkStats.count),
+               func.sum(ChunkStats.sum))
+        .join(Chunk, Chunk.variable_id == Variable.id)
+        .join(ChunkStats, ChunkStats.chunk_id == Chunk.id)
+        .group_by(Variable.name)
+        .order_by(Variable.name))
+
+    by_store = select(Variable.name, Store.name.label("store"), func.sum(ChunkStats.count).label("count")) \
+        .join(Store, Store.id == Variable.store_id) \
+        .join(Chunk, Chunk.variable_id == Variable.id) \
+        .join(ChunkStats, ChunkStats.chunk_id == Chunk.id) \
+        .group_by(Variable.id, Variable.name, Store.name) \
+        .subquery()
+    empty = dict()
+    for name, store in session.execute(
+            select(by_store.c.name, by_store.c.store).where(by_store.c.count == 0).order_by(by_store.c.store)):
+        empty.setdefault(name, list()).append(store)
+
+    summary = dict()
+    for name, chunks, empty_chunks, lo, hi, count, total in totals:
+        summary[name] = {
+            "chunks": chunks,
+            "empty_chunks": empty_chunks,
+            "min": lo,
+            "max": hi,
+            "count": count,
+            "mean": total / count if count else None,
+            "empty": empty.get(name, list()),
+        }
+
+    return summary
+
+
+def chunk_sources(variable):
+    """Store name, location and size of the first chunk of the database with the bytes of each chunk of
+    ``variable``, as a chunk id to source mapping, so catalogs can point duplicated chunks to a single copy. Chunks
+    match on hash and size, chunks without hash are not in the mapping."""
+    session = object_session(variable)
+    if session is None:
+        return dict()
+
+    chunk, source = aliased(Chunk), aliased(Chunk)
+    hashes = select(chunk.hash).where(chunk.variable_id == variable.id).where(chunk.hash.is_not(None))
+    first = select(Chunk.hash, Chunk.size, func.min(Chunk.id).label("id")) \
+        .where(Chunk.hash.in_(hashes)) \
+        .group_by(Chunk.hash, Chunk.size) \
+        .subquery()
+    rows = session.execute(
+        select(chunk.id, Store.name, source.location, source.size)
+        .join(first, and_(first.c.hash == chunk.hash, first.c.size == chunk.size))
+        .join(source, source.id == first.c.id)
+        .join(Variable, Variable.id == source.variable_id)
+        .join(Store, Store.id == Variable.store_id)
+        .where(chunk.variable_id == variable.id))
+
+    return {chunk_id: (store, location, size) for chunk_id, store, location, size in rows}
+
+
+def grid_conflicts(session, store_ids, excluded=()):
+    """Coordinates with different values among stores, as a name to number of distinct fingerprints mapping.
+    Coordinates in ``excluded`` (e.g. the aggregation dimension) and variables without fingerprint are ignored."""
+    rows = session.execute(
+        select(Variable.name, func.count(func.distinct(Variable.fingerprint)))
+        .where(Variable.store_id.in_(store_ids))
+        .where(Variable.fingerprint.is_not(None))
+        .where(Variable.name.not_in(excluded))
+        .group_by(Variable.name)
+        .having(func.count(func.distinct(Variable.fingerprint)) > 1)
+        .order_by(Variable.name))
+
+    return dict(rows.all())
+
+
+def grid_groups(session, store_ids, excluded=()):
+    """Split stores into groups sharing the values of their coordinates. Groups are lists of store ids, sorted by
+    the id of their first store."""
+    signatures = dict()
+    rows = session.execute(
+        select(Variable.store_id, Variable.name, Variable.fingerprint)
+        .where(Variable.store_id.in_(store_ids))
+        .where(Variable.fingerprint.is_not(None))
+        .where(Variable.name.not_in(excluded))
+        .order_by(Variable.store_id, Variable.name))
+    for store_id, name, fingerprint in rows:
+        signatures.setdefault(store_id, list()).append((name, fingerprint))
+
+    groups = dict()
+    for store_id in sorted(store_ids):
+        groups.setdefault(tuple(signatures.get(store_id, ())), list()).append(store_id)
+
+    return list(groups.values())
@@ -0,0 +1,302 @@
+import logging
+
+from sqlalchemy import delete, func, insert, inspect, select, text
+
+from smgdatatools.collector.lib import Storage
+from smgdatatools.model.model import Base, Store, Variable, Dimension, Filter, GlobalAttribute, Attribute, Scale, \
+    Chunk, ChunkGrid, ChunkShape, ChunkStats, FilterProperty, Compressor, CompressorProperty
+
+# tables in insertion order, parents before children
+TABLES = [
+    Store.__table__,
+    GlobalAttribute.__table__,
+    Compressor.__table__,
+    CompressorProperty.__table__,
+    Variable.__table__,
+    Attribute.__table__,
+    Filter.__table__,
+    FilterProperty.__table__,
+    Dimension.__table__,
+    ChunkShape.__table__,
+    Scale.__table__,
+    Chunk.__table__,
+    ChunkGrid.__table__,
+    ChunkStats.__table__,
+]
+
+SQLITE_INGEST_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+def create_tables(engine):
+    """Create the tables of the model, adding the columns that databases built by older versions lack.
+
+    New columns are nullable and empty in existing rows, e.g. stores without fingerprint are collected again by an
+    incremental run. Databases missing a required column can not be upgraded and have to be rebuilt.
+    """
+    Base.metadata.create_all(engine)
+
+    inspector = inspect(engine)
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            missing = [column for column in table.columns if column.name not in existing]
+            for column in missing:
+                if not column.nullable or column.foreign_keys:
+                    raise RuntimeError("Column {}.{} is missing from {}, rebuild the database".format(
+                        table.name,
+                        column.name,
+                        engine.url.database))
+                logging.warning("Adding column {}.{} to {}".format(table.name, column.name, engine.url.database))
+                connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    table.name,
+                    column.name,
+                    column.type.compile(engine.dialect))))
+            for index in table.indexes:
+                if any(column in missing for column in index.columns):
+                    index.create(connection, checkfirst=True)
+
+
+class StoreWriter:
+    """Write collection records to the database in batches using SQLAlchemy Core executemany.
+
+    Primary keys are assigned by the writer, so every table of a batch is inserted with a single executemany
+    and no ORM instance is created. Each batch is committed on its own. With ``replace``, stores already in the
+    database under the name of a written record are deleted in the transaction that inserts the record.
+    """
+
+    def __init__(self, session, batch_size=100, replace=False):
+        self.session = session
+        self.batch_size = batch_size
+        self.replace = replace
+        self.pending = list()
+        self.ids = dict()
+
+    def __enter__(self):
+        if self.session.get_bind().dialect.name == "sqlite":
+            for pragma in SQLITE_INGEST_PRAGMAS:
+                self.session.execute(text(pragma))
+
+        for table in TABLES:
+            self.ids[table.name] = self.session.execute(select(func.max(table.c.id))).scalar() or 0
+        self.session.commit()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
+
+    def write(self, record):
+        self.pending.append(record)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def next_id(self, table, n=1):
+        first = self.ids[table.name] + 1
+        self.ids[table.name] += n
+
+        return first
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        if self.replace:
+            names = [record.name for record in self.pending]
+            delete_stores(self.session, self.session.execute(select(Store.id).where(Store.name.in_(names))).scalars())
+
+        rows = {table.name: list() for table in TABLES}
+        for record in self.pending:
+            self.rows(record, rows)
+
+        for table in TABLES:
+            if rows[table.name]:
+                self.session.execute(insert(table), rows[table.name])
+        self.session.commit()
+
+        logging.info("Committed {} stores".format(len(self.pending)))
+        self.pending = list()
+
+    def rows(self, record, rows):
+        store_id = self.next_id(Store.__table__)
+        rows["store"].append({
+            "id": store_id,
+            "name": record.name,
+            "size": record.size,
+            "mtime": record.mtime,
+            "checksum": record.checksum})
+
+        for name, value in record.attrs:
+            rows["global_attribute"].append({
+                "id": self.next_id(GlobalAttribute.__table__),
+                "name": name,
+                "value": value,
+                "store_id": store_id})
+
+        for v in record.variables:
+            compressor_id = None
+            if v.compressor:
+                compressor_id = self.next_id(Compressor.__table__)
+                rows["compressor"].append({"id": compressor_id, "name": v.compressor.name})
+                for name, value in v.compressor.properties.items():
+                    rows["compressor_properties"].append({
+                        "id": self.next_id(CompressorProperty.__table__),
+                        "name": name,
+                        "value": value,
+                        "compressor_id": compressor_id})
+
+            variable_id = self.next_id(Variable.__table__)
+            rows["variable"].append({
+                "id": variable_id,
+                "name": v.name,
+                "dtype": v.dtype,
+                "fillvalue": v.fillvalue,
+                "fingerprint": v.fingerprint,
+                "store_id": store_id,
+                "compressor_id": compressor_id})
+
+            for name, value in v.attrs:
+                rows["attribute"].append({
+                    "id": self.next_id(Attribute.__table__),
+                    "name": name,
+                    "value": value,
+                    "variable_id": variable_id})
+
+            for f in v.filters:
+                filter_id = self.next_id(Filter.__table__)
+                rows["filter"].append({"id": filter_id, "name": f.name, "variable_id": variable_id})
+                for name, value in f.properties.items():
+                    rows["filter_properties"].append({
+                        "id": self.next_id(FilterProperty.__table__),
+                        "name": name,
+                        "value": value,
+                        "filter_id": filter_id})
+
+            for d in v.dimensions:
+                dimension_id = self.next_id(Dimension.__table__)
+                rows["dimension"].append({
+                    "id": dimension_id,
+                    "index": d.index,
+                    "size": d.size,
+                    "chunk_count": d.chunk_count,
+                    "variable_id": variable_id})
+                if d.chunk_shape is not None:
+                    rows["chunkshape"].append({
+                        "id": self.next_id(ChunkShape.__table__),
+                        "shape": d.chunk_shape,
+                        "index": d.index,
+                        "dimension_id": dimension_id})
+                for name in d.scales:
+                    rows["scale"].append({
+                        "id": self.next_id(Scale.__table__),
+                        "name": name,
+                        "dimension_id": dimension_id,
+                        "variable_id": variable_id})
+
+            grids, chunks = v.chunks.grids()
+            for location, stride, size, count, index in grids:
+                rows["chunkgrid"].append({
+                    "id": self.next_id(ChunkGrid.__table__),
+                    "location": location,
+                    "stride": stride,
+                    "size": size,
+                    "count": count,
+                    "index": index,
+                    "variable_id": variable_id})
+
+            first = self.next_id(Chunk.__table__, len(chunks))
+            for i, ((location, size, index), digest, stats) in enumerate(
+                    zip(chunks, chunks.hashes(), chunks.statistics())):
+                rows["chunk"].append({
+                    "id": first + i,
+                    "location": location,
+                    "size": size,
+                    "index": index,
+                    "hash": digest,
+                    "variable_id": variable_id})
+                if stats is not None:
+                    rows["chunkstats"].append({
+                        "id": self.next_id(ChunkStats.__table__),
+                        "min": stats[0],
+                        "max": stats[1],
+                        "count": stats[2],
+                        "sum": stats[3],
+                        "chunk_id": first + i})
+
+
+def delete_stores(session, store_ids, batch_size=500):
+    """Delete stores and everything that was collected from them."""
+    store_ids = list(store_ids)
+    for i in range(0, len(store_ids), batch_size):
+        ids = store_ids[i:i + batch_size]
+        variables = select(Variable.id).where(Variable.store_id.in_(ids))
+        dimensions = select(Dimension.id).where(Dimension.variable_id.in_(variables))
+        filters = select(Filter.id).where(Filter.variable_id.in_(variables))
+        compressors = select(Variable.compressor_id).where(Variable.store_id.in_(ids))
+
+        chunks = select(Chunk.id).where(Chunk.variable_id.in_(variables))
+
+        session.execute(delete(ChunkStats).where(ChunkStats.chunk_id.in_(chunks)))
+        session.execute(delete(Chunk).where(Chunk.variable_id.in_(variables)))
+        session.execute(delete(ChunkGrid).where(ChunkGrid.variable_id.in_(variables)))
+        session.execute(delete(Scale).where(Scale.variable_id.in_(variables)))
+        session.execute(delete(ChunkShape).where(ChunkShape.dimension_id.in_(dimensions)))
+        session.execute(delete(Dimension).where(Dimension.variable_id.in_(variables)))
+        session.execute(delete(FilterProperty).where(FilterProperty.filter_id.in_(filters)))
+        session.execute(delete(Filter).where(Filter.variable_id.in_(variables)))
+        session.execute(delete(Attribute).where(Attribute.variable_id.in_(variables)))
+        session.execute(delete(CompressorProperty).where(CompressorProperty.compressor_id.in_(compressors)))
+        session.execute(delete(Compressor).where(Compressor.id.in_(compressors)))
+        session.execute(delete(Variable).where(Variable.store_id.in_(ids)))
+        session.execute(delete(GlobalAttribute).where(GlobalAttribute.store_id.in_(ids)))
+        session.execute(delete(Store).where(Store.id.in_(ids)))
+
+
+def committed(session):
+    """Names of the stores already in the database."""
+    return set(session.execute(select(Store.name)).scalars())
+
+
+def incremental(session, inputs, checksum=False, storage=None, listed=None):
+    """Compare the inputs with the fingerprints of the stores already in the database.
+
+    Inputs are fingerprinted in bulk from the listings of their directories. Stores of inputs that are no longer
+    listed are deleted, stores of changed inputs are kept until a ``StoreWriter`` with ``replace`` writes their new
+    collection, so a failed collection leaves the previous store in place. ``listed`` are the names of the whole
+    listing when only some of its inputs are compared (e.g. selected ones), stores of listed inputs that are not
+    compared are kept. Returns the fingerprints of the inputs that need to be collected, in input order.
+    """
+    stored = {name: (store_id, (size, mtime, digest))
+              for store_id, name, size, mtime, digest in session.execute(
+                  select(Store.id, Store.name, Store.size, Store.mtime, Store.checksum))}
+
+    storage = storage if storage is not None else Storage()
+    fingerprints = dict()
+    changed = 0
+    for resource, current in storage.fingerprints(inputs, checksum).items():
+        if resource in stored:
+            _, previous = stored.pop(resource)
+            unchanged = (current[0] is not None and
+                         current[:2] == previous[:2] and
+                         (not checksum or current[2] == previous[2]))
+            if unchanged:
+                continue
+            changed += 1
+        fingerprints[resource] = current
+
+    # vanished inputs
+    listed = set(listed) if listed is not None else set()
+    vanished = [store_id for name, (store_id, _) in stored.items() if name not in listed]
+
+    logging.warning("Incremental collection: {} inputs to collect ({} changed), {} stores removed".format(
+        len(fingerprints),
+        changed,
+        len(vanished)))
+    delete_stores(session, vanished)
+    session.commit()
+
+    return fingerprints
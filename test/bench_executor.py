@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Compare the process and thread executors on synthetic local HDF5 files and mock remote zarr stores.
+
+Local HDF5 collection is CPU bound and serialized by the h5py lock, it scales with processes. Remote collection
+waits on the network, threads reach a much higher concurrency than processes at a lower cost.
+
+    PYTHONPATH=.. python bench_executor.py --stores 200 --latency 0.02
+"""
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import fsspec
+import h5py
+import numpy as np
+from fsspec.implementations.memory import MemoryFileSystem
+
+from smgdatatools.collector.h5 import Hdf5ChunkCollector
+from smgdatatools.collector.pipeline import make_pool, stream, collect_record
+from smgdatatools.collector.zarr import ZarrCollector
+
+
+class SlowMemoryFileSystem(MemoryFileSystem):
+    """Memory filesystem with a fixed latency per request, a stand-in for an object store."""
+
+    protocol = "slowmemory"
+    latency = 0.02
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        if path.startswith("slowmemory://"):
+            path = path[len("slowmemory://"):]
+        return super()._strip_protocol(path)
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        time.sleep(self.latency)
+        return super().cat_file(path, start, end, **kwargs)
+
+    def ls(self, path, detail=True, **kwargs):
+        time.sleep(self.latency)
+        return super().ls(path, detail, **kwargs)
+
+
+def make_hdf5(tmp, stores):
+    fnames = list()
+    for i in range(stores):
+        fname = os.path.join(tmp, "{}.h5".format(i))
+        with h5py.File(fname, "w") as f:
+            for v in range(4):
+                f.create_dataset("v{}".format(v), data=np.zeros((120, 16, 16), dtype="f4"), chunks=(1, 16, 16))
+        fnames.append(fname)
+
+    return fnames
+
+
+def make_zarr(stores):
+    fs = fsspec.filesystem("slowmemory")
+    zarray = {"chunks": [1, 16, 16], "compressor": None, "dtype": "<f4", "fill_value": "NaN", "filters": None,
+              "order": "C", "shape": [12, 16, 16], "zarr_format": 2}
+    resources = list()
+    for i in range(stores):
+        root = "/bench/{}".format(i)
+        fs.pipe(root + "/.zgroup", json.dumps({"zarr_format": 2}).encode())
+        fs.pipe(root + "/.zattrs", b"{}")
+        for v in range(4):
+            fs.pipe("{}/v{}/.zarray".format(root, v), json.dumps(zarray).encode())
+            fs.pipe("{}/v{}/.zattrs".format(root, v), b"{}")
+            for c in range(12):
+                fs.pipe("{}/v{}/{}.0.0".format(root, v, c), b"x")
+        resources.append("slowmemory:/" + root)
+
+    return resources
+
+
+def run(collector, inputs, executor, processes, threads):
+    start = time.perf_counter()
+    with make_pool(collector, executor, processes, threads) as pool:
+        for _ in stream(pool, collect_record, inputs, 4 * (threads if executor == "thread" else processes)):
+            pass
+
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark of the collection executors.")
+    parser.add_argument("--stores", type=int, default=100, help="stores per workload.")
+    parser.add_argument("--latency", type=float, default=0.02, help="latency in seconds of mock remote requests.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="processes.")
+    parser.add_argument("--threads", type=int, default=32, help="threads.")
+    args = parser.parse_args()
+
+    fsspec.register_implementation("slowmemory", SlowMemoryFileSystem, clobber=True)
+    SlowMemoryFileSystem.latency = args.latency
+
+    with tempfile.TemporaryDirectory() as tmp:
+        workloads = [
+            ("local hdf5", Hdf5ChunkCollector(), make_hdf5(tmp, args.stores)),
+            ("remote zarr", ZarrCollector(), make_zarr(args.stores)),
+        ]
+
+        print("{:<12} {:>10} {:>10} {:>10}".format("workload", "executor", "seconds", "stores/s"))
+        for name, collector, inputs in workloads:
+            for executor in ["process", "thread"]:
+                seconds = run(collector, inputs, executor, args.jobs, args.threads)
+                print("{:<12} {:>10} {:>10.2f} {:>10.1f}".format(name, executor, seconds, len(inputs) / seconds))
@@ -1,16 +1,45 @@
+import functools
+import hashlib
+import http.server
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
 import unittest
+import unittest.mock
 
+import fsspec
+import h5py
 import netCDF4
+import numcodecs
+import numpy as np
 from sqlalchemy.orm import Session
 
-from smgdatatools.model.model import Base, Store
-from sqlalchemy import create_engine
+from smgdatatools.model.model import Base, Store, Variable, Compressor, Chunk, ChunkGrid
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.pool import QueuePool
 
+from smgdatatools.collector import grib, nc
+from smgdatatools.collector.grib import Grib2Collector
+from smgdatatools.collector.h5 import Hdf5ChunkCollector
+from smgdatatools.collector.lib import StoreStats, Storage
 from smgdatatools.collector.nc import NcCollector
+from smgdatatools.collector.nc3 import Nc3Collector
+from smgdatatools.collector.nc4 import Nc4Collector
+from smgdatatools.collector.telemetry import Telemetry
+from smgdatatools.collector.workqueue import WorkQueue
+from smgdatatools.collector.pipeline import collect_record, executor_for, init_worker, make_pool, stream, Quarantine
+from smgdatatools.collector.plan import scan, prune, group, parse_select, parse_time_window
 from smgdatatools.collector.zarr import ZarrCollector
 from smgdatatools.etl.h5vds import Common, NewCommon, New, Union
 from smgdatatools.etl.jinja import JinjaEtl
+from smgdatatools.etl.lib import aggregation_coordinates, join_existing, numcodecs_config, numcodecs_filters
+from smgdatatools.model.merge import merge
+from smgdatatools.model.records import ChunkTable, FailureRecord
+from smgdatatools.model.report import chunk_sources, duplication, grid_conflicts, grid_groups, statistics
+from smgdatatools.model.writer import StoreWriter, create_tables, incremental, committed
 
 
 def parse_coord_values_attr(coord_values_attr_spec, stores):
@@ -25,6 +54,31 @@ def parse_coord_values_attr(coord_values_attr_spec, stores):
     return list(values)
 
 
+class RangeRequestHandler(http.server.SimpleHTTPRequestHandler):
+    """Static files with support for single byte range requests."""
+
+    def do_GET(self):
+        if "Range" not in self.headers:
+            return super().do_GET()
+
+        start, end = self.headers["Range"].split("=")[1].split("-")
+        with open(self.translate_path(self.path), "rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            start = int(start)
+            end = min(int(end) if end else size - 1, size - 1)
+            fh.seek(start)
+            data = fh.read(end - start + 1)
+
+        self.send_response(206)
+        self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, size))
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
 class TestEsgfVds(unittest.TestCase):
     def test_cmip6_common_etl(self):
         datasets = [
@@ -323,5 +377,1256 @@ class TestEsgfVds(unittest.TestCase):
         session.close()
         engine.dispose()
 
+
+class TestHdf5ChunkCollector(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fname = os.path.join(self.tmp.name, "sparse.h5")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_sparse_chunk_index(self):
+        with h5py.File(self.fname, "w") as f:
+            ds = f.create_dataset("x", (10, 10), chunks=(3, 4), dtype="f4")
+            ds[0:3, 4:8] = 1
+            ds[9, 9] = 2
+
+        store = Hdf5ChunkCollector().collect(self.fname)
+        variable = [v for v in store.variables if v.name == "x"][0]
+
+        self.assertEqual([c.index for c in variable.chunks], [1, 11])
+        self.assertEqual([variable.calculate_chunk_idx(c.index) for c in variable.chunks], [[0, 1], [3, 2]])
+        with open(self.fname, "rb") as fh:
+            chunk = variable.chunks[1]
+            fh.seek(chunk.location)
+            values = np.frombuffer(fh.read(chunk.size), dtype="f4").reshape((3, 4))
+        self.assertEqual(values[0, 1], 2)
+
+    def test_virtual_chunks(self):
+        data = np.arange(6 * 4 * 3, dtype="f8").reshape((6, 4, 3))
+        with h5py.File(self.fname, "w") as f:
+            f.create_dataset("x", data=data)
+            f.create_dataset("y", data=data)
+            f.create_dataset("z", data=data)
+            f["t"] = np.arange(6)
+            f["t"].make_scale("t")
+            f["z"].dims[0].attach_scale(f["t"])
+
+        collector = Hdf5ChunkCollector(chunk_size="x:1,2;y:4;z:t:1")
+        store = collector.collect(self.fname)
+        variables = {v.name: v for v in store.variables}
+
+        expected = {
+            "x": [data[i:i + 1, j:j + 2] for i in range(6) for j in range(0, 4, 2)],
+            "y": [data[i:i + 4] for i in range(0, 6, 4)],
+            "z": [data[i:i + 1] for i in range(6)],
+        }
+        with open(self.fname, "rb") as fh:
+            for v, blocks in expected.items():
+                chunks = sorted(variables[v].chunks, key=lambda c: c.index)
+                self.assertEqual(len(chunks), len(blocks))
+                for chunk, block in zip(chunks, blocks):
+                    fh.seek(chunk.location)
+                    values = np.frombuffer(fh.read(chunk.size), dtype="f8")
+                    np.testing.assert_array_equal(values, block.ravel())
+
+        self.assertEqual([d.chunk_count for d in variables["x"].dimensions], [6, 2, 1])
+
+        # the last chunk of y is a shorter range of the 2 remaining steps
+        y = next(v for v in collector.collect_record(self.fname).variables if v.name == "y")
+        (location, size, index), = [c for c in y.chunks if c[2] == 1]
+        self.assertEqual(size, 2 * 4 * 3 * 8)
+        with open(self.fname, "rb") as fh:
+            fh.seek(location)
+            values = collector.decode_chunk(y, [], fh.read(size), index)
+        np.testing.assert_array_equal(values, data[4:])
+
+        # not contiguous
+        with self.assertRaises(ValueError):
+            Hdf5ChunkCollector(chunk_size="x:2,2").collect(self.fname)
+
+    def test_read_values(self):
+        with h5py.File(self.fname, "w") as f:
+            f.create_dataset("time", data=np.arange(12, dtype=">f8"))
+            f.create_dataset("tas", data=np.ones((12, 4), dtype="f4"), chunks=(6, 4), compression="gzip")
+        nc3 = os.path.join(self.tmp.name, "lat.nc")
+        with netCDF4.Dataset(nc3, "w", format="NETCDF3_CLASSIC") as f:
+            f.createDimension("lat", 3)
+            f.createVariable("lat", "f4", ("lat",))[:] = [-1, 0, 1]
+
+        read = list()
+
+        class Hdf5(Hdf5ChunkCollector):
+            def read_variable(self, store, variable):
+                read.append(variable)
+                return super().read_variable(store, variable)
+
+        engine = create_engine("sqlite+pysqlite:///:memory:", future=True)
+        Base.metadata.create_all(engine)
+        session = Session(engine)
+        with StoreWriter(session) as writer:
+            writer.write(Hdf5ChunkCollector().collect_record(self.fname))
+            writer.write(Nc3Collector().collect_record(nc3))
+
+        variables = {v.name: v for v in session.query(Variable)}
+        collector = Hdf5()
+        np.testing.assert_array_equal(collector.read_values(variables["time"]), np.arange(12))
+        np.testing.assert_array_equal(collector.read_values(variables["tas"]), np.ones((12, 4)))
+        np.testing.assert_array_equal(Nc3Collector().read_values(variables["lat"]), [-1, 0, 1])
+        # compressed variables are read by the library
+        self.assertEqual(read, ["tas"])
+
+        session.close()
+        engine.dispose()
+
+    def test_filter_pipeline(self):
+        data = np.arange(100.)
+        with h5py.File(self.fname, "w") as f:
+            f.create_dataset("x", data=data, chunks=(10,), compression="gzip", compression_opts=3, shuffle=True,
+                             fletcher32=True)
+            f.create_dataset("y", data=data, chunks=(10,), compression="lzf")
+            # optional filters are recorded even if the plugin is not available
+            dcpl = h5py.h5p.create(h5py.h5p.DATASET_CREATE)
+            dcpl.set_chunk((10,))
+            dcpl.set_filter(32099, 1, (1, 2))
+            h5py.h5d.create(f.id, b"z", h5py.h5t.NATIVE_DOUBLE, h5py.h5s.create_simple((100,)), dcpl=dcpl)
+
+        store = Hdf5ChunkCollector().collect(self.fname)
+        x, y, z = store.variables
+
+        self.assertEqual(x.compressor.name, "gzip")
+        self.assertEqual([f.name for f in x.filters], ["shuffle", "fletcher32"])
+        configs = numcodecs_filters(x)
+        self.assertEqual(configs, [{"id": "shuffle", "elementsize": 8}, {"id": "zlib", "level": 3},
+                                   {"id": "fletcher32"}])
+
+        # chunks are decoded in place with the reversed pipeline
+        codecs = [numcodecs.get_codec(config) for config in configs]
+        chunk = x.chunks[3]
+        with open(self.fname, "rb") as fh:
+            fh.seek(chunk.location)
+            buffer = fh.read(chunk.size)
+        for codec in reversed(codecs):
+            buffer = codec.decode(buffer)
+        np.testing.assert_array_equal(np.frombuffer(buffer, dtype="f8"), data[30:40])
+
+        self.assertEqual([(f.name, {p.name: p.value for p in f.properties}["cd_values"]) for f in z.filters],
+                         [("filter32099", "1,2")])
+        self.assertEqual(numcodecs_config("blosc", {"id": 32001, "cd_values": "2,2,8,80,5,1,5"}),
+                         {"id": "blosc", "cname": "zstd", "clevel": 5, "shuffle": 1, "blocksize": 0})
+        for variable in [y, z]:
+            with self.assertRaises(ValueError):
+                numcodecs_filters(variable)
+
+    def test_record_pickle(self):
+        with h5py.File(self.fname, "w") as f:
+            f.create_dataset("x", data=np.arange(100, dtype="f4").reshape((10, 10)), chunks=(5, 5))
+
+        record = pickle.loads(pickle.dumps(Hdf5ChunkCollector().collect_record(self.fname)))
+        store = record.to_store()
+
+        self.assertEqual(store.name, self.fname)
+        self.assertEqual([c.index for c in store.variables[0].chunks], [0, 1, 2, 3])
+        self.assertEqual([d.chunk_count for d in store.variables[0].dimensions], [2, 2])
+
+    def test_homogeneous_collection(self):
+        fnames = [os.path.join(self.tmp.name, "{}.h5".format(i)) for i in range(3)]
+        for i, fname in enumerate(fnames):
+            with h5py.File(fname, "w") as f:
+                f.attrs["tracking_id"] = str(i)
+                f.create_dataset("time", data=np.arange(4 + i, dtype="f8"))
+                tas = f.create_dataset("tas", (4 + i, 6), chunks=(2, 3), dtype="f4", compression="gzip")
+                tas[...] = 1
+                tas.attrs["units"] = "K" if i < 2 else "degC"
+
+        expected = [Hdf5ChunkCollector().collect(fname) for fname in fnames]
+        collector = Hdf5ChunkCollector(homogeneous=True)
+        stores = [collector.collect(fname) for fname in fnames]
+
+        # variables with different attributes do not share a prototype
+        self.assertEqual(len(collector.prototypes), 2)
+        for store, reference in zip(stores, expected):
+            self.assertEqual([(a.name, a.value) for a in store.attrs], [(a.name, a.value) for a in reference.attrs])
+            for v, r in zip(store.variables, reference.variables):
+                self.assertEqual([a.value for a in v.attrs], [a.value for a in r.attrs])
+                self.assertEqual([(d.size, d.chunk_count) for d in v.dimensions],
+                                 [(d.size, d.chunk_count) for d in r.dimensions])
+                self.assertEqual([(c.index, c.location, c.size) for c in v.chunks],
+                                 [(c.index, c.location, c.size) for c in r.chunks])
+
+
+
+class TestZarrCollector(unittest.TestCase):
+    def setUp(self):
+        self.fs = fsspec.filesystem("memory")
+        self.documents = {
+            ".zgroup": {"zarr_format": 2},
+            ".zattrs": {"source_id": "CESM2", "variant_label": "r1i1p1f1"},
+            "tas/.zarray": {"chunks": [2, 3], "compressor": {"id": "zlib", "level": 1}, "dtype": "<f4",
+                            "fill_value": "NaN", "filters": None, "order": "C", "shape": [5, 3],
+                            "zarr_format": 2},
+            "tas/.zattrs": {"_ARRAY_DIMENSIONS": ["time", "lat"], "units": "K"},
+            "lat/.zarray": {"chunks": [3], "compressor": None, "dtype": "<f8", "fill_value": None,
+                            "filters": None, "order": "C", "shape": [3], "zarr_format": 2},
+            "lat/.zattrs": {"_ARRAY_DIMENSIONS": ["lat"]},
+        }
+        for key, document in self.documents.items():
+            self.fs.pipe("/plain/" + key, json.dumps(document).encode())
+            self.fs.pipe("/consolidated/" + key, json.dumps(document).encode())
+        self.fs.pipe("/consolidated/.zmetadata", json.dumps(
+            {"metadata": self.documents, "zarr_consolidated_format": 1}).encode())
+        # chunk 1.0 of tas was never written
+        for root in ["/plain", "/consolidated"]:
+            self.fs.pipe(root + "/tas/0.0", b"x" * 10)
+            self.fs.pipe(root + "/tas/2.0", b"x" * 7)
+            self.fs.pipe(root + "/lat/0", b"x" * 24)
+
+    def tearDown(self):
+        self.fs.rm("/plain", recursive=True)
+        self.fs.rm("/consolidated", recursive=True)
+
+    def test_collect(self):
+        collector = ZarrCollector()
+        for resource in ["memory://plain", "memory://consolidated"]:
+            store = collector.collect(resource)
+            self.assertEqual([(a.name, a.value) for a in store.attrs],
+                             [("source_id", "CESM2"), ("variant_label", "r1i1p1f1")])
+            self.assertEqual([v.name for v in store.variables], ["lat", "tas"])
+
+            tas = store.variables[1]
+            self.assertEqual(tas.compressor.name, "zlib")
+            self.assertEqual([(d.size, d.chunk_count) for d in tas.dimensions], [(5, 3), (3, 1)])
+            self.assertEqual([s.name for s in tas.scales], ["time", "lat"])
+            self.assertEqual([(c.index, c.size) for c in tas.chunks], [(0, 10), (2, 7)])
+            self.assertEqual(collector.read_attributes(resource, "tas")["units"], "K")
+
+    def test_chunk_hashes(self):
+        store = ZarrCollector(chunk_hash="blake2b").collect("memory://plain")
+        tas = store.variables[1]
+        self.assertEqual([c.hash for c in tas.chunks],
+                         [hashlib.blake2b(b"x" * n, digest_size=16).hexdigest() for n in (10, 7)])
+
+        # chunks are read with the metadata fetched when the store was collected
+        collector = ZarrCollector(chunk_hash="blake2b")
+        record = collector.collect_record("memory://plain")
+        with unittest.mock.patch.object(collector, "read_metadata") as read_metadata:
+            collector.scan_chunks(record)
+        read_metadata.assert_not_called()
+        self.assertEqual(record.variables[1].chunks.hashes(), [c.hash for c in tas.chunks])
+
+    def test_variable_selection(self):
+        store = ZarrCollector(variables=["tas"]).collect("memory://plain")
+        self.assertEqual([v.name for v in store.variables], ["lat", "tas"])
+        store = ZarrCollector(variables=["lat"]).collect("memory://consolidated")
+        self.assertEqual([v.name for v in store.variables], ["lat"])
+
+    def test_thread_executor(self):
+        collector = ZarrCollector()
+        self.assertEqual(executor_for(collector), "thread")
+        self.assertEqual(executor_for(Hdf5ChunkCollector()), "process")
+
+        resources = ["memory://plain", "memory://consolidated"] * 4
+        with make_pool(collector, "thread", 1, 4) as pool:
+            records = list(stream(pool, collect_record, resources, 4))
+        self.assertEqual([r.name for r in records], resources)
+        self.assertEqual([len(r.variables[1].chunks) for r in records], [2] * len(resources))
+
+
+class TestStoreWriter(unittest.TestCase):
+    def test_batched_write(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fnames = [os.path.join(tmp, "{}.h5".format(i)) for i in range(3)]
+            for fname in fnames:
+                with h5py.File(fname, "w") as f:
+                    f.attrs["title"] = fname
+                    f.create_dataset("x", data=np.zeros((4, 4)), chunks=(2, 2), compression="gzip")
+
+            collector = Hdf5ChunkCollector()
+            engine = create_engine(
+                "sqlite+pysqlite:///:memory:",
+                echo=False,
+                future=True,
+                poolclass=QueuePool,
+                pool_size=1)
+            Base.metadata.create_all(engine)
+            session = Session(engine)
+
+            with StoreWriter(session, batch_size=2) as writer:
+                for fname in fnames:
+                    writer.write(collector.collect_record(fname))
+
+            stores = session.query(Store).order_by(Store.id).all()
+            self.assertEqual([s.name for s in stores], fnames)
+            for store in stores:
+                self.assertEqual([a.value for a in store.attrs], [store.name])
+                variable = store.variables[0]
+                self.assertEqual(variable.compressor.name, "gzip")
+                self.assertEqual(sorted(c.index for c in variable.chunks), [0, 1, 2, 3])
+                self.assertEqual([d.chunk_shapes[0].shape for d in variable.dimensions], [2, 2])
+
+            session.close()
+            engine.dispose()
+
+    def test_chunk_grids(self):
+        table = ChunkTable([100, 140, 180, 220, 500, 600, 700], [40, 40, 40, 40, 10, 10, 10], [0, 1, 2, 3, 5, 6, 9])
+        grids, rest = table.grids()
+        self.assertEqual(grids, [(100, 40, 40, 4, 0), (500, 100, 10, 2, 5)])
+        self.assertEqual(list(rest), [(700, 10, 9)])
+
+        with tempfile.TemporaryDirectory() as tmp:
+            fnames = [os.path.join(tmp, "{}.h5".format(i)) for i in range(2)]
+            for fname in fnames:
+                with h5py.File(fname, "w") as f:
+                    # the third chunk is never written
+                    x = f.create_dataset("x", shape=(12, 4), dtype="f8", chunks=(3, 4))
+                    x[:6] = np.arange(24.).reshape((6, 4))
+                    x[9:] = np.arange(12.).reshape((3, 4))
+
+            collector = Hdf5ChunkCollector()
+            engine = create_engine("sqlite+pysqlite:///:memory:", future=True, poolclass=QueuePool, pool_size=1)
+            Base.metadata.create_all(engine)
+            session = Session(engine)
+            with StoreWriter(session) as writer:
+                for fname in fnames:
+                    writer.write(collector.collect_record(fname))
+
+            # 2 regular chunks and a separate one per store
+            self.assertEqual(session.query(ChunkGrid).count(), 2)
+            self.assertEqual(session.query(Chunk).count(), 2)
+
+            variables = [s.variables[0] for s in session.query(Store).order_by(Store.id)]
+            expected = [(c.location, c.size, c.index) for c in collector.collect(fnames[0]).variables[0].chunks]
+            self.assertEqual([(c.location, c.size, c.index) for c in variables[0].chunks], expected)
+
+            join_existing(variables)
+            self.assertEqual([c.index for c in variables[1].chunks], [4, 5, 7])
+            # chunk rows and chunks of grids are shifted from their position in the grid
+            join_existing(variables)
+            self.assertEqual([c.index for c in variables[1].chunks], [4, 5, 7])
+            self.assertEqual([c.grid_index for c in variables[1].chunks], [0, 1, 3])
+
+            session.close()
+            engine.dispose()
+
+    def test_create_tables(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine("sqlite+pysqlite:///{}".format(os.path.join(tmp, "old.sqlite")), future=True)
+            with engine.begin() as connection:
+                connection.execute(text("CREATE TABLE store (id INTEGER PRIMARY KEY, name VARCHAR(500), size FLOAT)"))
+                connection.execute(text("INSERT INTO store (id, name, size) VALUES (1, 'a.nc', 10)"))
+                connection.execute(text("CREATE TABLE chunk (id INTEGER PRIMARY KEY, location INTEGER, size INTEGER, "
+                                        "\"index\" INTEGER, variable_id INTEGER REFERENCES variable(id))"))
+
+            create_tables(engine)
+            create_tables(engine)
+            session = Session(engine)
+            store = session.query(Store).one()
+            self.assertEqual((store.name, store.size, store.mtime, store.checksum), ("a.nc", 10, None, None))
+            self.assertIn("ix_chunk_hash", [index["name"] for index in inspect(engine).get_indexes("chunk")])
+
+            session.close()
+            engine.dispose()
+
+    def test_incremental(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fnames = [os.path.join(tmp, "{}.h5".format(i)) for i in range(3)]
+            for fname in fnames:
+                with h5py.File(fname, "w") as f:
+                    f.create_dataset("x", data=np.zeros((4, 4)), chunks=(2, 2))
+
+            collector = Hdf5ChunkCollector()
+            engine = create_engine("sqlite+pysqlite:///:memory:", future=True, poolclass=QueuePool, pool_size=1)
+            Base.metadata.create_all(engine)
+            session = Session(engine)
+
+            fingerprints = incremental(session, fnames[:2])
+            self.assertEqual(list(fingerprints), fnames[:2])
+            with StoreWriter(session) as writer:
+                for fname in fingerprints:
+                    record = collector.collect_record(fname)
+                    record.size, record.mtime, record.checksum = fingerprints[fname]
+                    writer.write(record)
+
+            # fnames[0] is listed but not selected, its store is kept
+            fingerprints = incremental(session, fnames[1:2], listed=fnames)
+            self.assertEqual(list(fingerprints), [])
+            self.assertEqual(session.query(Store).count(), 2)
+
+            # the store of the changed input is kept until its new collection is written, the vanished one is not
+            os.utime(fnames[1], (0, 0))
+            fingerprints = incremental(session, fnames[1:])
+            self.assertEqual(list(fingerprints), fnames[1:])
+            self.assertEqual(session.query(Store.name).all(), [(fnames[1],)])
+            with StoreWriter(session, replace=True) as writer:
+                record = collector.collect_record(fnames[1])
+                record.size, record.mtime, record.checksum = fingerprints[fnames[1]]
+                writer.write(record)
+            self.assertEqual(session.query(Store.name, Store.mtime).all(), [(fnames[1], 0)])
+            self.assertEqual(session.query(Variable).count(), 1)
+
+            session.close()
+            engine.dispose()
+
+
+class TestChunkHashing(unittest.TestCase):
+    def test_duplicated_chunks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fnames = [os.path.join(tmp, "{}.h5".format(i)) for i in range(2)]
+            for i, fname in enumerate(fnames):
+                with h5py.File(fname, "w") as f:
+                    f.create_dataset("orog", data=np.arange(16.).reshape(4, 4), chunks=(2, 4))
+                    f.create_dataset("tas", data=np.full((4, 4), float(i)), chunks=(2, 4))
+
+            collector = Hdf5ChunkCollector(chunk_hash="blake2b")
+            records = list()
+            for fname in fnames:
+                record = collector.collect_record(fname)
+                collector.scan_chunks(record, batch_size=1)
+                records.append(pickle.loads(pickle.dumps(record)))
+
+            orog = [v for v in records[0].variables if v.name == "orog"][0]
+            self.assertEqual(len(set(orog.chunks.hashes())), 2)
+            self.assertEqual(orog.chunks.grids()[0], [])
+
+            engine = create_engine("sqlite+pysqlite:///:memory:", future=True)
+            Base.metadata.create_all(engine)
+            session = Session(engine)
+            with StoreWriter(session) as writer:
+                for record in records:
+                    writer.write(record)
+
+            # orog is the same in both files, the chunks of tas are the same within each file
+            report = duplication(session)
+            self.assertEqual(report["chunks"], 8)
+            self.assertEqual(report["bytes"], 8 * 64)
+            self.assertEqual(report["unique_chunks"], 4)
+            self.assertEqual(report["duplicated_chunks"], 4)
+            self.assertEqual(report["duplicated_bytes"], 4 * 64)
+            self.assertEqual({v["name"]: v["chunks"] for v in report["variables"]}, {"orog": 4, "tas": 4})
+
+            store = session.query(Store).filter(Store.name == fnames[1]).one()
+            variable = [v for v in store.variables if v.name == "orog"][0]
+            first = session.query(Chunk).filter(Chunk.hash == variable.chunks[0].hash).order_by(Chunk.id).first()
+            sources = chunk_sources(variable)
+            self.assertEqual(len(sources), 2)
+            self.assertEqual(sources[variable.chunks[0].id], (fnames[0], first.location, 64))
+
+            # same hash but different size is not the same chunk
+            first.size = 63
+            session.commit()
+            chunk = variable.chunks[0]
+            self.assertEqual(chunk_sources(variable)[chunk.id], (fnames[1], chunk.location, 64))
+
+            session.close()
+            engine.dispose()
+
+
+class TestChunkStatistics(unittest.TestCase):
+    def test_statistics(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tas = np.arange(30, dtype="f4").reshape(6, 5)
+            tas[4:, :4] = np.nan
+            fnames = [os.path.join(tmp, "tas_{}.nc".format(i)) for i in range(2)]
+            for fname, values in zip(fnames, [tas, np.full((6, 5), np.nan, dtype="f4")]):
+                with netCDF4.Dataset(fname, "w") as f:
+                    f.createDimension("time", 6)
+                    f.createDimension("lat", 5)
+                    f.createVariable("lat", "f8", ("lat",))[:] = np.arange(5)
+                    v = f.createVariable("tas", "f4", ("time", "lat"), chunksizes=(4, 4), zlib=True, shuffle=True,
+                                         fill_value=np.float32(1e20))
+                    v[:] = values
+                    v[0, 0] = np.ma.masked
+
+            collector = Nc4Collector(chunk_stats=["tas"])
+            engine = create_engine("sqlite+pysqlite:///:memory:", future=True)
+            Base.metadata.create_all(engine)
+            session = Session(engine)
+            with StoreWriter(session) as writer:
+                for fname in fnames:
+                    record = collector.collect_record(fname)
+                    collector.scan_chunks(record, batch_size=3)
+                    writer.write(pickle.loads(pickle.dumps(record)))
+
+            # edge chunks are cropped to the variable, the fill value and NaN are not counted
+            variable = session.query(Variable).filter(Variable.name == "tas").order_by(Variable.id).first()
+            stats = [(c.index, c.stats.min, c.stats.max, c.stats.count, c.stats.sum) for c in variable.chunks]
+            self.assertEqual(stats, [(0, 1., 18., 15, float(tas[:4, :4].sum())),
+                                     (1, 4., 19., 4, float(tas[:4, 4].sum())),
+                                     (2, None, None, 0, 0.),
+                                     (3, 24., 29., 2, 53.)])
+            self.assertFalse(session.query(Variable).filter(Variable.name == "lat").first().chunks[0].stats)
+
+            summary = statistics(session)
+            self.assertEqual(list(summary), ["tas"])
+            self.assertEqual(summary["tas"]["chunks"], 8)
+            self.assertEqual(summary["tas"]["empty_chunks"], 5)
+            self.assertEqual((summary["tas"]["min"], summary["tas"]["max"], summary["tas"]["count"]), (1., 29., 21))
+            self.assertEqual(summary["tas"]["empty"], [fnames[1]])
+
+            session.close()
+            engine.dispose()
+
+
+class TestReferencesTemplate(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.engine = create_engine("sqlite+pysqlite:///:memory:", future=True)
+        Base.metadata.create_all(self.engine)
+        self.session = Session(self.engine)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        self.tmp.cleanup()
+
+    def write(self, name, tas, **kwargs):
+        fname = os.path.join(self.tmp.name, name)
+        with netCDF4.Dataset(fname, "w") as f:
+            f.createDimension("time", tas.shape[0])
+            f.createDimension("lat", tas.shape[1])
+            f.createVariable("lat", "f8", ("lat",))[:] = np.arange(tas.shape[1])
+            f.createVariable("tas", "f4", ("time", "lat"), chunksizes=(2, tas.shape[1]), **kwargs)[:] = tas
+
+        return fname
+
+    def render(self, collector, fnames):
+        with StoreWriter(self.session) as writer:
+            for fname in fnames:
+                record = collector.collect_record(fname)
+                if collector.reads_chunks:
+                    collector.scan_chunks(record)
+                writer.write(record)
+        dest = os.path.join(self.tmp.name, "references.json")
+        stores = self.session.query(Store).order_by(Store.id).all()
+        JinjaEtl("references.json.j2", dict()).run(dest, collector, stores, [])
+        with open(dest) as fh:
+            return json.load(fh)["refs"]
+
+    def test_duplicated_chunks(self):
+        tas = np.arange(12, dtype="f4").reshape(4, 3)
+        fnames = [self.write(name, tas, zlib=True) for name in ("a.nc", "b.nc")]
+        refs = self.render(Nc4Collector(chunk_hash="blake2b"), fnames)
+
+        for i in range(2):
+            self.assertEqual(refs["b/tas/{}.0".format(i)], refs["a/tas/{}.0".format(i)])
+            self.assertEqual(refs["b/tas/{}.0".format(i)][0], fnames[0])
+
+    def test_numcodecs_filters(self):
+        tas = np.arange(12, dtype="f4").reshape(4, 3)
+        fname = self.write("tas.nc", tas, zlib=True, shuffle=True)
+        refs = self.render(Nc4Collector(), [fname])
+
+        zarray = json.loads(refs["tas/tas/.zarray"])
+        self.assertIsNone(zarray["compressor"])
+        self.assertEqual([f["id"] for f in zarray["filters"]], ["shuffle", "zlib"])
+        self.assertEqual(json.loads(refs["tas/tas/.zattrs"])["_ARRAY_DIMENSIONS"], ["time", "lat"])
+        for i in range(2):
+            path, offset, size = refs["tas/tas/{}.0".format(i)]
+            with open(path, "rb") as fh:
+                fh.seek(offset)
+                data = fh.read(size)
+            for config in reversed(zarray["filters"]):
+                data = numcodecs.get_codec(config).decode(data)
+            np.testing.assert_array_equal(np.frombuffer(data, dtype=zarray["dtype"]).reshape(2, 3),
+                                          tas[2 * i:2 * i + 2])
+
+    def test_unmappable_filters(self):
+        fname = os.path.join(self.tmp.name, "x.h5")
+        with h5py.File(fname, "w") as f:
+            f.create_dataset("a", data=np.arange(16.).reshape((4, 4)), chunks=(2, 4), compression="gzip")
+            f.create_dataset("b", data=np.arange(16.).reshape((4, 4)), chunks=(2, 4), compression="lzf")
+            for i, dim in enumerate(("y", "x")):
+                f[dim] = np.arange(4.)
+                f[dim].make_scale(dim)
+                f["a"].dims[i].attach_scale(f[dim])
+                f["b"].dims[i].attach_scale(f[dim])
+
+        with self.assertLogs(level="WARNING") as logs:
+            refs = self.render(Hdf5ChunkCollector(), [fname])
+
+        self.assertIn("x/a/.zarray", refs)
+        self.assertIn("x/a/1.0", refs)
+        self.assertFalse([k for k in refs if k.startswith("x/b/")])
+        self.assertTrue(any("variable b" in line for line in logs.output))
+
+
+class TestStorage(unittest.TestCase):
+    def setUp(self):
+        self.fs = fsspec.filesystem("memory")
+        self.tmp = tempfile.TemporaryDirectory()
+
+        self.h5 = os.path.join(self.tmp.name, "x.h5")
+        with h5py.File(self.h5, "w") as f:
+            f.attrs["title"] = "x"
+            f.create_dataset("x", data=np.arange(16.).reshape((4, 4)), chunks=(2, 2), compression="gzip")
+        self.nc = os.path.join(self.tmp.name, "x.nc")
+        with netCDF4.Dataset(self.nc, "w") as f:
+            f.title = "x"
+            f.createDimension("time", 3)
+            f.createVariable("tas", "f4", ("time",))[:] = [1, 2, 3]
+
+        for fname in [self.h5, self.nc]:
+            with open(fname, "rb") as fh:
+                self.fs.pipe("/storage/" + os.path.basename(fname), fh.read())
+
+    def tearDown(self):
+        self.fs.rm("/storage", recursive=True)
+        self.tmp.cleanup()
+
+    def test_remote_hdf5(self):
+        collector = Hdf5ChunkCollector()
+        local = collector.collect_record(self.h5)
+        remote = collector.collect_record("memory://storage/x.h5")
+        self.assertEqual(remote.attrs, local.attrs)
+        self.assertEqual(list(remote.variables[0].chunks), list(local.variables[0].chunks))
+        np.testing.assert_array_equal(collector.read_variable("memory://storage/x.h5", "x"),
+                                      np.arange(16.).reshape((4, 4)))
+
+        # the file objects of the storage layer are closed with the HDF5 files
+        handles = list()
+        storage_open = collector.storage.open
+
+        def spy(*args, **kwargs):
+            fh = storage_open(*args, **kwargs)
+            fh.close = unittest.mock.Mock(wraps=fh.close)
+            handles.append(fh)
+            return fh
+
+        with unittest.mock.patch.object(collector.storage, "open", side_effect=spy):
+            collector.collect_record("memory://storage/x.h5")
+            collector.read_variable("memory://storage/x.h5", "x")
+        self.assertEqual([fh.close.call_count for fh in handles], [1, 1])
+
+    def test_remote_netcdf3(self):
+        fname = os.path.join(self.tmp.name, "x3.nc")
+        with netCDF4.Dataset(fname, "w", format="NETCDF3_CLASSIC") as f:
+            f.createDimension("time", 3)
+        with open(fname, "rb") as fh:
+            self.fs.pipe("/storage/x3.nc", fh.read())
+        with self.assertRaisesRegex(ValueError, "nc3 collector"):
+            NcCollector().collect_record("memory://storage/x3.nc")
+
+    @unittest.skipIf(nc.h5netcdf is not None, "h5netcdf is installed")
+    def test_remote_netcdf_without_h5netcdf(self):
+        with self.assertRaises(ImportError):
+            NcCollector().collect_record("memory://storage/x.nc")
+
+    @unittest.skipIf(nc.h5netcdf is None, "h5netcdf is not installed")
+    def test_remote_netcdf(self):
+        collector = NcCollector()
+        store = collector.collect_record("memory://storage/x.nc")
+        self.assertEqual(store.size, os.path.getsize(self.nc))
+        self.assertIn(("title", "x"), store.attrs)
+        self.assertEqual(list(collector.read_variable("memory://storage/x.nc", "tas")), [1, 2, 3])
+
+    def test_http_range(self):
+        handler = functools.partial(RangeRequestHandler, directory=self.tmp.name)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = "http://127.0.0.1:{}/x.h5".format(server.server_address[1])
+        try:
+            local = Hdf5ChunkCollector().collect_record(self.h5)
+            requests = list()
+            for block_size in [512, 1 << 20]:
+                collector = Hdf5ChunkCollector(block_size=block_size, page_buf_size=1 << 20, mdc_size=1 << 20)
+                self.assertEqual(list(collector.collect_record(url).variables[0].chunks),
+                                 list(local.variables[0].chunks))
+
+                stats = StoreStats()
+                with collector.open(url, stats) as f:
+                    f["x"].id.get_offset()
+                    [f.attrs[attr] for attr in f.attrs]
+                self.assertGreater(stats.bytes, 0)
+                requests.append(stats.requests)
+            # the whole file fits in a single block
+            self.assertGreater(requests[0], requests[1])
+            self.assertEqual(requests[1], 1)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_fingerprint(self):
+        storage = Storage()
+        size, mtime, _ = storage.fingerprint("memory://storage/x.h5")
+        self.assertEqual(size, os.path.getsize(self.h5))
+        self.assertIsNotNone(mtime)
+        self.assertEqual(storage.fingerprint("memory://storage/missing.h5"), (None, None, None))
+        self.assertEqual(storage.fingerprint(self.h5)[0], os.path.getsize(self.h5))
+
+    def test_fingerprints(self):
+        storage = Storage()
+        resources = ["memory://storage/x.nc", "memory://storage/missing.h5", self.h5, "memory://storage/x.h5"]
+        expected = {resource: storage.fingerprint(resource) for resource in resources}
+        # remote objects come from the listing of their directory, not from a request per object
+        with unittest.mock.patch.object(self.fs, "info", side_effect=AssertionError) as info:
+            fingerprints = storage.fingerprints(resources[:1] + resources[2:])
+        info.assert_not_called()
+        self.assertEqual(list(fingerprints), resources[:1] + resources[2:])
+        self.assertEqual(fingerprints, {resource: expected[resource] for resource in fingerprints})
+        self.assertEqual(storage.fingerprints(resources[1:2]), {resources[1]: (None, None, None)})
+
+    def test_pickle(self):
+        storage = Storage()
+        storage.filesystem("memory://storage/x.h5")
+        self.assertEqual(pickle.loads(pickle.dumps(storage)).filesystems, dict())
+
+
+class TestNc4Collector(unittest.TestCase):
+    def test_single_pass(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "tas_day_185001-185012.nc")
+            with netCDF4.Dataset(fname, "w") as f:
+                f.title = "test"
+                f.createDimension("time", None)
+                f.createDimension("lat", 4)
+                f.createDimension("bnds", 2)
+                f.createVariable("time", "f8", ("time",))[:] = np.arange(6)
+                f.createVariable("time_bnds", "f8", ("time", "bnds"))[:] = np.zeros((6, 2))
+                f.createVariable("lat", "f8", ("lat",))[:] = np.arange(4)
+                tas = f.createVariable("tas", "f4", ("time", "lat"), zlib=True, chunksizes=(2, 4),
+                                       fill_value=np.float32(1e20))
+                tas.units = "K"
+                tas[:] = np.ones((6, 4))
+
+            drs = r"(?P<variable>\w+)_(?P<frequency>\w+)_"
+            reference = NcCollector(drs=drs).collect_record(fname)
+            store = Nc4Collector(drs=drs).collect_record(fname)
+
+            self.assertEqual(store.size, os.path.getsize(fname))
+            self.assertEqual(store.attrs, reference.attrs)
+            self.assertEqual([v.name for v in store.variables], [v.name for v in reference.variables])
+            for v, r in zip(store.variables, reference.variables):
+                self.assertEqual(v.attrs, r.attrs)
+                self.assertEqual([(d.size, d.scales) for d in v.dimensions],
+                                 [(d.size, d.scales) for d in r.dimensions])
+
+            tas = store.variables[-1]
+            self.assertIsInstance(dict(tas.attrs)["_FillValue"], np.float32)
+            self.assertEqual(tas.compressor.name, "gzip")
+            self.assertEqual([(d.chunk_count, d.chunk_shape) for d in tas.dimensions], [(3, 2), (1, 4)])
+            self.assertEqual(list(tas.chunks.index), [0, 1, 2])
+
+    def test_variable_selection(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "tas.nc")
+            with netCDF4.Dataset(fname, "w") as f:
+                f.createDimension("time", None)
+                f.createDimension("rlat", 2)
+                f.createDimension("bnds", 2)
+                time = f.createVariable("time", "f8", ("time",))
+                time.bounds = "time_bnds"
+                time[:] = np.arange(3)
+                f.createVariable("time_bnds", "f8", ("time", "bnds"))[:] = np.zeros((3, 2))
+                f.createVariable("rlat", "f8", ("rlat",))[:] = np.arange(2)
+                f.createVariable("lat", "f8", ("rlat",))[:] = np.arange(2)
+                f.createVariable("rotated_pole", "c")
+                f.createVariable("height", "f8")
+                tas = f.createVariable("tas", "f4", ("time", "rlat"))
+                tas.coordinates = "lat height"
+                tas.grid_mapping = "rotated_pole"
+                tas[:] = np.ones((3, 2))
+                f.createVariable("orog", "f4", ("rlat",))[:] = np.ones(2)
+                f.createVariable("pr", "f4", ("time", "rlat"))[:] = np.ones((3, 2))
+
+            expected = ["time", "time_bnds", "rlat", "lat", "rotated_pole", "height", "tas"]
+            for collector in [Nc4Collector(variables=["tas"]), NcCollector(variables=["tas"])]:
+                store = collector.collect_record(fname)
+                self.assertEqual([v.name for v in store.variables], expected)
+
+            self.assertEqual([v.name for v in Nc4Collector(variables=["missing"]).collect_record(fname).variables], [])
+
+
+class TestNc3Collector(unittest.TestCase):
+    def test_record_variables(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "tas.nc")
+            for fmt in ["NETCDF3_CLASSIC", "NETCDF3_64BIT_OFFSET", "NETCDF3_64BIT_DATA"]:
+                with netCDF4.Dataset(fname, "w", format=fmt) as f:
+                    f.title = "test"
+                    f.createDimension("time", None)
+                    f.createDimension("lat", 3)
+                    f.createVariable("lat", "f8", ("lat",))[:] = np.arange(3)
+                    f.createVariable("time", "f8", ("time",))[:] = np.arange(5)
+                    # records of 6 bytes are padded to 8 in the interleaved record
+                    f.createVariable("tas", "i2", ("time", "lat"), fill_value=np.int16(-1))[:] = np.arange(15).reshape(
+                        (5, 3))
+
+                collector = Nc3Collector()
+                record = collector.collect_record(fname)
+                self.assertEqual(record.attrs, [("title", "test")])
+                self.assertEqual([v.name for v in record.variables], ["lat", "time", "tas"])
+
+                tas = record.variables[2]
+                self.assertEqual(tas.dtype, ">i2")
+                self.assertEqual(tas.fillvalue, -1)
+                self.assertEqual([(d.size, d.chunk_count, d.chunk_shape, d.scales) for d in tas.dimensions],
+                                 [(5, 5, 1, ["time"]), (3, 1, 3, ["lat"])])
+                self.assertEqual(len(tas.chunks), 5)
+                self.assertEqual(np.diff(tas.chunks.location).tolist(), [16] * 4)
+
+                with netCDF4.Dataset(fname) as f, open(fname, "rb") as fh:
+                    for v in record.variables:
+                        values = list()
+                        for location, size, index in v.chunks:
+                            fh.seek(location)
+                            values.append(np.frombuffer(fh.read(size), dtype=v.dtype))
+                        np.testing.assert_array_equal(np.concatenate(values).reshape(f[v.name].shape), f[v.name][:])
+                        np.testing.assert_array_equal(collector.read_variable(fname, v.name), f[v.name][:])
+
+    def test_homogeneous(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fnames = [os.path.join(tmp, "tas_{}.nc".format(i)) for i in range(3)]
+            for i, fname in enumerate(fnames):
+                with netCDF4.Dataset(fname, "w", format="NETCDF3_CLASSIC") as f:
+                    f.title = fname
+                    f.createDimension("time", None)
+                    f.createDimension("lat", 3)
+                    f.createVariable("lat", "f8", ("lat",))[:] = np.arange(3) + i
+                    f.createVariable("time", "f8", ("time",))[:] = np.arange(i + 2)
+                    f.createVariable("tas", "f4", ("time", "lat"))[:] = np.zeros((i + 2, 3))
+
+            collector = Nc3Collector(homogeneous=True)
+            records = [collector.collect_record(fname) for fname in fnames]
+            self.assertEqual(len(collector.prototypes), 1)
+            for fname, record in zip(fnames, records):
+                expected = Nc3Collector().collect_record(fname)
+                self.assertEqual((record.size, record.attrs), (expected.size, expected.attrs))
+                for v, e in zip(record.variables, expected.variables):
+                    self.assertEqual((v.name, v.dtype, v.attrs, v.fingerprint),
+                                     (e.name, e.dtype, e.attrs, e.fingerprint))
+                    self.assertEqual([(d.size, d.chunk_count, d.chunk_shape, d.scales) for d in v.dimensions],
+                                     [(d.size, d.chunk_count, d.chunk_shape, d.scales) for d in e.dimensions])
+                    self.assertEqual(list(v.chunks), list(e.chunks))
+
+
+class TestHomogeneousAttributes(unittest.TestCase):
+    def test_units(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            for fmt, cls in [("NETCDF4", Nc4Collector), ("NETCDF4", NcCollector), ("NETCDF3_CLASSIC", Nc3Collector),
+                             ("NETCDF3_CLASSIC", NcCollector)]:
+                fnames = [os.path.join(tmp, "tas_{}.nc".format(i)) for i in range(2)]
+                for fname, units in zip(fnames, ["days since 1850-01-01", "days since 1900-01-01"]):
+                    with netCDF4.Dataset(fname, "w", format=fmt) as f:
+                        f.createDimension("time", 2)
+                        time = f.createVariable("time", "f8", ("time",))
+                        time[:] = np.arange(2)
+                        time.units = units
+
+                collector = cls(homogeneous=True)
+                records = [collector.collect_record(fname) for fname in fnames]
+                self.assertEqual([dict(r.variables[0].attrs)["units"] for r in records],
+                                 ["days since 1850-01-01", "days since 1900-01-01"], cls.__name__)
+
+
+class TestCoordinateFingerprints(unittest.TestCase):
+    def test_grid_check(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            grids = [("f8", np.arange(3.), "NETCDF4"), ("f4", np.arange(3.), "NETCDF3_CLASSIC"),
+                     ("f8", np.arange(3.) + 0.5, "NETCDF4")]
+            fnames = list()
+            for i, (dtype, lat, fmt) in enumerate(grids):
+                fname = os.path.join(tmp, "tas_{}.nc".format(i))
+                with netCDF4.Dataset(fname, "w", format=fmt) as f:
+                    f.createDimension("time", None)
+                    f.createDimension("lat", 3)
+                    f.createVariable("lat", dtype, ("lat",))[:] = lat
+                    time = f.createVariable("time", "f8", ("time",))
+                    time[:] = np.arange(2) + 2 * i
+                    time.units = "days since 2000-01-01"
+                    f.createVariable("tas", "f4", ("time", "lat"))[:] = np.zeros((2, 3))
+                    f.createVariable("area", "f4", ("time", "lat"))[:] = np.ones((2, 3))
+                    f["tas"].coordinates = "area"
+                fnames.append(fname)
+
+            records = [Nc4Collector().collect_record(fnames[0]), Nc3Collector().collect_record(fnames[1]),
+                       NcCollector().collect_record(fnames[2])]
+            fingerprints = [{v.name: v.fingerprint for v in record.variables} for record in records]
+            self.assertIsNone(fingerprints[0]["tas"])
+            # two dimensional auxiliary coordinates are not read
+            self.assertEqual([f["area"] for f in fingerprints], [None, None, None])
+            self.assertEqual(fingerprints[0]["lat"], fingerprints[1]["lat"])
+            self.assertNotEqual(fingerprints[0]["lat"], fingerprints[2]["lat"])
+            self.assertNotEqual(fingerprints[0]["time"], fingerprints[1]["time"])
+
+            engine = create_engine("sqlite+pysqlite:///:memory:", future=True)
+            Base.metadata.create_all(engine)
+            session = Session(engine)
+            with StoreWriter(session) as writer:
+                for record in records:
+                    writer.write(record)
+
+            stores = session.query(Store).order_by(Store.id).all()
+            self.assertEqual(aggregation_coordinates(stores, ["tas"]), ["time"])
+            self.assertEqual(grid_conflicts(session, [s.id for s in stores], ["time"]), {"lat": 2})
+            self.assertEqual(grid_conflicts(session, [s.id for s in stores[:2]], ["time"]), {})
+            self.assertEqual(grid_groups(session, [s.id for s in stores], ["time"]),
+                             [[stores[0].id, stores[1].id], [stores[2].id]])
+            with self.assertRaises(ValueError):
+                Common(grid_check="reject").run(os.path.join(tmp, "common.nc"), NcCollector(), stores, ["tas"])
+            self.assertFalse(os.path.exists(os.path.join(tmp, "common.nc")))
+            with self.assertLogs("smgdatatools.etl.h5vds", "WARNING"):
+                Common(grid_check="warn").run(os.path.join(tmp, "common.nc"), NcCollector(), stores, ["tas"])
+            self.assertTrue(os.path.exists(os.path.join(tmp, "common.nc")))
+
+            session.close()
+            engine.dispose()
+
+
+def grib2_message(category, number, level_type, level, step, ni=4, nj=3, discipline=0, member=None, unit=1):
+    """A GRIB2 message with a regular latitude/longitude grid and a forecast of ``step`` hours (or other ``unit``)
+    from 2000-01-01, of an ensemble member if ``member`` is given."""
+    def section(n, body):
+        return (len(body) + 5).to_bytes(4, "big") + bytes([n]) + body
+
+    identification = section(1, bytes(7) + (2000).to_bytes(2, "big") + bytes([1, 1, 0, 0, 0, 0, 1]))
+    grid = section(3, bytes(1) + (ni * nj).to_bytes(4, "big") + bytes(2) + (0).to_bytes(2, "big") + bytes(16) +
+                   ni.to_bytes(4, "big") + nj.to_bytes(4, "big") + bytes(34))
+    template = 0 if member is None else 1
+    product = section(4, bytes(2) + template.to_bytes(2, "big") + bytes([category, number]) + bytes(6) +
+                      bytes([unit]) + step.to_bytes(4, "big") + bytes([level_type, 0]) + level.to_bytes(4, "big") +
+                      bytes(6) + (bytes([0, member, 10]) if member is not None else bytes()))
+    representation = section(5, (ni * nj).to_bytes(4, "big") + bytes(12))
+    data = section(7, bytes(range(ni * nj)))
+    sections = identification + grid + product + representation + data + b"7777"
+
+    return b"GRIB" + bytes([0, 0, discipline, 2]) + (16 + len(sections)).to_bytes(8, "big") + sections
+
+
+class TestGrib2Collector(unittest.TestCase):
+    def test_scan(self):
+        messages = [
+            grib2_message(0, 0, 100, 85000, 6),
+            grib2_message(0, 0, 100, 50000, 0),
+            grib2_message(0, 0, 100, 85000, 0),
+            grib2_message(3, 0, 1, 0, 0, ni=2, nj=2),
+            grib2_message(0, 0, 100, 50000, 6),
+            grib2_message(3, 1, 101, 0, 6),
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "era5.grib2")
+            offsets = list()
+            with open(fname, "wb") as f:
+                for message in messages:
+                    # messages may be padded
+                    f.write(bytes(3))
+                    offsets.append(f.tell())
+                    f.write(message)
+
+            store = Grib2Collector().collect_record(fname)
+            self.assertEqual([v.name for v in store.variables],
+                             ["t", "sp", "prmsl", "time", "isobaricInPa", "time_sp", "time_prmsl"])
+
+            t, sp, prmsl = store.variables[:3]
+            self.assertEqual([(d.scales, d.size, d.chunk_count) for d in t.dimensions],
+                             [(["time"], 2, 2), (["isobaricInPa"], 2, 2), (["latitude"], 3, 1),
+                              (["longitude"], 4, 1)])
+            self.assertEqual(dict(t.attrs)["GRIB_levels"], "50000,85000")
+            self.assertEqual(dict(t.attrs)["GRIB_validTimes"], "2000-01-01T00:00:00,2000-01-01T06:00:00")
+            # chunk index (time, level) to the byte range of the message
+            self.assertEqual(list(t.chunks), [(offsets[1], len(messages[1]), 0), (offsets[2], len(messages[2]), 1),
+                                              (offsets[4], len(messages[4]), 2), (offsets[0], len(messages[0]), 3)])
+            self.assertEqual([d.size for d in sp.dimensions], [1, 2, 2])
+            self.assertEqual(list(prmsl.chunks), [(offsets[5], len(messages[5]), 0)])
+
+            # coordinates have no chunks, their values come from the messages
+            time, level = store.variables[3:5]
+            self.assertEqual(len(time.chunks), 0)
+            self.assertEqual(dict(time.attrs)["units"], "seconds since 1970-01-01 00:00:00")
+            self.assertEqual([d.scales for d in prmsl.dimensions][0], ["time_prmsl"])
+            collector = Grib2Collector()
+            np.testing.assert_array_equal(collector.read_variable(fname, "time"), [946684800, 946684800 + 6 * 3600])
+            np.testing.assert_array_equal(collector.read_variable(fname, "isobaricInPa"), [50000, 85000])
+
+            store = Grib2Collector(variables=["prmsl"]).collect_record(fname)
+            self.assertEqual([v.name for v in store.variables], ["prmsl", "time_prmsl"])
+
+            # attributes are read from the fields scanned when the store was collected
+            collector = Grib2Collector()
+            collector.collect_record(fname)
+            with unittest.mock.patch.object(grib, "scan") as rescan:
+                self.assertEqual(collector.read_attributes(fname, "t"), dict(t.attrs))
+                self.assertEqual(collector.read_attributes(fname), {"GRIB_edition": "2"})
+            rescan.assert_not_called()
+
+    def test_ensemble(self):
+        messages = [grib2_message(0, 0, 1, 0, 0, member=2), grib2_message(0, 0, 1, 0, 0, member=1),
+                    grib2_message(0, 0, 1, 0, 0)]
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "ens.grib2")
+            with open(fname, "wb") as f:
+                for message in messages:
+                    f.write(message)
+
+            with self.assertLogs(level="WARNING") as logs:
+                t, time, number = Grib2Collector().collect_record(fname).variables
+            self.assertTrue(any("not an ensemble member" in line for line in logs.output))
+            self.assertEqual(dict(number.attrs)["standard_name"], "realization")
+            self.assertEqual([(d.scales, d.size) for d in t.dimensions[:2]], [(["time"], 1), (["number"], 2)])
+            self.assertEqual(dict(t.attrs)["GRIB_numbers"], "1,2")
+            self.assertEqual(list(t.chunks), [(len(messages[0]), len(messages[1]), 0), (0, len(messages[0]), 1)])
+
+    def test_time_units(self):
+        # steps of 1 day, 1 month and 13 months, and a message with an unknown unit of time range
+        messages = [grib2_message(0, 0, 1, 0, 1, unit=2), grib2_message(0, 0, 1, 0, 1, unit=3),
+                    grib2_message(0, 0, 1, 0, 13, unit=3), grib2_message(0, 0, 1, 0, 1, unit=200)]
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "monthly.grib2")
+            with open(fname, "wb") as f:
+                for message in messages:
+                    f.write(message)
+
+            with self.assertLogs(level="WARNING") as logs:
+                t, time = Grib2Collector().collect_record(fname).variables
+            self.assertTrue(any("Unknown unit of time range 200" in line for line in logs.output))
+            self.assertEqual(dict(t.attrs)["GRIB_validTimes"],
+                             "2000-01-02T00:00:00,2000-02-01T00:00:00,2001-02-01T00:00:00")
+
+    def test_invalid_lengths(self):
+        message = grib2_message(0, 0, 1, 0, 0)
+        # zero length of the identification section, length of the grid section past the end of the message
+        zero = message[:16] + bytes(4) + message[20:]
+        past = bytearray(message)
+        grid = 16 + int.from_bytes(message[16:20], "big")
+        past[grid:grid + 4] = len(message).to_bytes(4, "big")
+        with tempfile.TemporaryDirectory() as tmp:
+            fname = os.path.join(tmp, "bad.grib2")
+            for data in (zero, bytes(past), message[:40]):
+                with open(fname, "wb") as f:
+                    f.write(data)
+                with self.assertRaises(ValueError):
+                    Grib2Collector().collect_record(fname)
+
+    @unittest.skipIf(grib.eccodes is not None, "eccodes is installed")
+    def test_missing_eccodes(self):
+        with self.assertRaises(ImportError):
+            Grib2Collector().decode_chunk(None, [], grib2_message(0, 0, 1, 0, 0), 0)
+
+
+class TestPlan(unittest.TestCase):
+    def setUp(self):
+        self.inputs = [
+            "data/tas_Amon_MPI-ESM1-2-LR_historical_r1i1p1f1_gn_187001-188912.nc",
+            "data/tas_Amon_MPI-ESM1-2-LR_historical_r1i1p1f1_gn_185001-186912.nc",
+            "data/pr_Amon_MPI-ESM1-2-LR_historical_r1i1p1f1_gn_185001-186912.nc",
+            "data/tas_Amon_MPI-ESM1-2-LR_historical_r2i1p1f1_gn_185001-186912.nc",
+            "data/orog_fx_MPI-ESM1-2-LR_historical_r1i1p1f1_gn.nc",
+        ]
+        drs = r"(?P<variable_id>\w+)_(?P<table_id>\w+)_[\w-]+_historical_(?P<member>\w+)_gn"
+        self.drs = NcCollector(drs=drs).drs_pattern
+
+    def test_scan(self):
+        entries = list(scan(self.inputs, self.drs))
+        self.assertEqual(entries[0].facets, {"variable_id": "tas", "table_id": "Amon", "member": "r1i1p1f1"})
+        self.assertEqual((entries[0].start, entries[0].end), ("18700100000000", "18891299999999"))
+        self.assertEqual((entries[4].start, entries[4].end), (None, None))
+
+    def test_prune(self):
+        entries = prune(scan(self.inputs, self.drs), parse_select(["variable_id=tas,orog", "member=r1i1p1f1"]))
+        self.assertEqual([e.name for e in entries], [self.inputs[0], self.inputs[1], self.inputs[4]])
+
+        entries = prune(scan(self.inputs, self.drs), time_window=parse_time_window("1880-"))
+        self.assertEqual([e.name for e in entries], [self.inputs[0], self.inputs[4]])
+
+    def test_group(self):
+        groups = group(scan(self.inputs, self.drs), ["variable_id", "member"])
+        self.assertEqual(groups, [[self.inputs[1], self.inputs[0]], [self.inputs[2]], [self.inputs[3]],
+                                  [self.inputs[4]]])
+
+
+class TestTelemetry(unittest.TestCase):
+    def test_summary(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fnames = [os.path.join(tmp, "{}.h5".format(i)) for i in range(3)]
+            for i, fname in enumerate(fnames):
+                with h5py.File(fname, "w") as f:
+                    f.create_dataset("x", data=np.zeros((4 * (i + 1), 4)), chunks=(2, 2))
+
+            telemetry = Telemetry(total=len(fnames), interval=0.)
+            collector = Hdf5ChunkCollector()
+            for fname in fnames:
+                record = pickle.loads(pickle.dumps(collector.collect_record(fname)))
+                self.assertEqual(set(record.stats.timings), {"open", "metadata", "chunks", "total"})
+                telemetry.add(record)
+            self.assertTrue(telemetry.progress().startswith("3/3 stores (100.0%)"))
+
+            summary = telemetry.summary()
+            self.assertEqual(summary["stores"], 3)
+            self.assertEqual(summary["totals"]["chunks"], 4 + 8 + 12)
+            self.assertEqual(summary["counts"]["chunks"]["max"], 12)
+            self.assertEqual(len(summary["slowest"]), 3)
+
+            telemetry.write_json(os.path.join(tmp, "summary.json"))
+            with open(os.path.join(tmp, "summary.json")) as f:
+                self.assertEqual(json.load(f)["totals"]["variables"], 3)
+            telemetry.write_prometheus(os.path.join(tmp, "collect.prom"))
+            with open(os.path.join(tmp, "collect.prom")) as f:
+                self.assertIn("smgdatatools_collect_chunks_total 24\n", f.read())
+
+    def test_failures(self):
+        telemetry = Telemetry(total=3, interval=float("inf"))
+        telemetry.start -= 2 * 86400
+        telemetry.add_failure(FailureRecord("a.nc", "OSError()", "", 1))
+        # failures count as processed, the ETA is not wrapped after a day
+        self.assertEqual(telemetry.progress(telemetry.start + 2 * 86400),
+                         "1/3 stores (33.3%), 0.0 stores/s, 0.0 chunks/s, ETA 4 days, 0:00:00, 1 failed")
+        self.assertEqual(telemetry.summary()["failures"], 1)
+
+
+class TestWorkQueue(unittest.TestCase):
+    def test_leases(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = WorkQueue(tmp, lease_timeout=60)
+            self.assertEqual(queue.create(["a", "b", "c", "d", "e"], batch_size=2), 3)
+
+            first = queue.claim()
+            second = WorkQueue(tmp, lease_timeout=60).claim()
+            self.assertEqual((first.inputs, second.inputs), (["a", "b"], ["c", "d"]))
+
+            # the worker of the first batch stalls
+            os.utime(first.path, (0, 0))
+            second.complete()
+            self.assertEqual(queue.requeue_stale(), [first.name])
+            third, fourth = queue.claim(), queue.claim()
+            self.assertEqual((third.inputs, fourth.inputs), (["a", "b"], ["e"]))
+            self.assertIsNone(queue.claim())
+
+            for lease in [third, fourth]:
+                lease.complete()
+            # the stalled worker finishes late
+            first.complete()
+            self.assertEqual(queue.list("done"), ["00000000.txt", "00000001.txt", "00000002.txt"])
+            self.assertEqual(list(queue.leases(poll_interval=0)), [])
+
+    def test_heartbeat(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            queue = WorkQueue(tmp, lease_timeout=0.2)
+            queue.create(["a", "b"], batch_size=1)
+            lease = next(queue.leases(poll_interval=0))
+
+            # a single store longer than the lease timeout
+            time.sleep(0.5)
+            self.assertEqual(queue.requeue_stale(), [])
+            lease.complete()
+            self.assertEqual(queue.list("done"), [lease.name])
+
+            # claimed batches are never stale
+            os.utime(os.path.join(tmp, "pending", "00000001.txt"), (0, 0))
+            lease = queue.claim()
+            self.assertEqual(queue.requeue_stale(), [])
+            lease.complete()
+
+
+class TestMerge(unittest.TestCase):
+    def test_merge(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            fnames = [os.path.join(tmp, "{}.h5".format(i)) for i in range(3)]
+            for fname in fnames:
+                with h5py.File(fname, "w") as f:
+                    f.attrs["title"] = fname
+                    f.create_dataset("x", data=np.zeros((4, 4)), chunks=(2, 2), compression="gzip")
+                    f.create_dataset("y", data=np.zeros(4))
+
+            collector = Hdf5ChunkCollector()
+            shards = [os.path.join(tmp, "shard{}.sqlite".format(i)) for i in range(2)]
+            for shard, names in zip(shards, [fnames[:2], fnames[1:]]):
+                engine = create_engine("sqlite+pysqlite:///{}".format(shard), future=True)
+                Base.metadata.create_all(engine)
+                with Session(engine) as session, StoreWriter(session) as writer:
+                    for name in names:
+                        writer.write(collector.collect_record(name))
+                engine.dispose()
+
+            engine = create_engine("sqlite+pysqlite:///{}".format(os.path.join(tmp, "merged.sqlite")), future=True)
+            Base.metadata.create_all(engine)
+            session = Session(engine)
+            merge(session, shards)
+
+            stores = session.query(Store).order_by(Store.id).all()
+            self.assertEqual([s.name for s in stores], fnames)
+            for store in stores:
+                self.assertEqual([a.value for a in store.attrs], [store.name])
+                self.assertEqual([v.name for v in store.variables], ["x", "y"])
+                x, y = store.variables
+                self.assertEqual(x.compressor.name, "gzip")
+                self.assertIsNone(y.compressor)
+                self.assertEqual([c.index for c in x.chunks], [0, 1, 2, 3])
+                self.assertEqual([len(d.chunk_shapes) for d in x.dimensions], [1, 1])
+            self.assertEqual(session.query(Compressor).count(), 3)
+
+            session.close()
+            engine.dispose()
+
+
+class FlakyCollector(Hdf5ChunkCollector):
+    """Fails with a connection error the first ``failures`` times a store is collected."""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def collect_record(self, store):
+        if self.failures > 0:
+            self.failures -= 1
+            raise ConnectionError("connection reset")
+
+        return super().collect_record(store)
+
+
+class TestFaultTolerance(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.good = os.path.join(self.tmp.name, "good.h5")
+        with h5py.File(self.good, "w") as f:
+            f.create_dataset("x", data=np.zeros(4))
+        self.bad = os.path.join(self.tmp.name, "bad.h5")
+        with open(self.bad, "w") as f:
+            f.write("not hdf5")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        init_worker(None)
+
+    def test_retries(self):
+        init_worker(FlakyCollector(2), retries=2, backoff=0.)
+        self.assertEqual(collect_record(self.good).name, self.good)
+
+        init_worker(FlakyCollector(3), retries=2, backoff=0.)
+        failure = collect_record(self.good)
+        self.assertIsInstance(failure, FailureRecord)
+        self.assertEqual(failure.attempts, 3)
+        self.assertIn("ConnectionError", failure.traceback)
+
+    def test_worker_fingerprint(self):
+        init_worker(Hdf5ChunkCollector())
+        self.assertIsNone(collect_record(self.good).mtime)
+
+        init_worker(Hdf5ChunkCollector(), fingerprint=True)
+        record = collect_record(self.good)
+        self.assertEqual(record.size, os.path.getsize(self.good))
+        self.assertEqual(record.mtime, os.path.getmtime(self.good))
+
+    def test_quarantine(self):
+        with make_pool(Hdf5ChunkCollector(), "thread", 1, 2, retries=3, backoff=0.) as pool:
+            results = list(stream(pool, collect_record, [self.bad, self.good], 2))
+        self.assertEqual(results[0].attempts, 1)
+        self.assertEqual(results[1].name, self.good)
+
+        quarantine = Quarantine(os.path.join(self.tmp.name, "quarantine.jsonl"))
+        quarantine.add(results[0])
+        with open(quarantine.path) as f:
+            self.assertEqual(json.loads(f.readline())["name"], self.bad)
+
+    def test_resume(self):
+        engine = create_engine("sqlite+pysqlite:///:memory:", future=True, poolclass=QueuePool, pool_size=1)
+        Base.metadata.create_all(engine)
+        session = Session(engine)
+        with StoreWriter(session) as writer:
+            writer.write(Hdf5ChunkCollector().collect_record(self.good))
+        self.assertEqual(committed(session), {self.good})
+        session.close()
+        engine.dispose()
+
+
 if __name__ == "__main__":
     unittest.main()